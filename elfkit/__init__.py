@@ -36,12 +36,23 @@ interface from the application described by its semantics: data items
 and actions."""
 
 
+import os
+
 from elfkit.base import *
-import elfkit.gtk as gtk
+try:
+	import elfkit.gtk as gtk
+except (ImportError, ValueError):
+	gtk = None
 
 
 def default_ui():
-	"""Get the default user interface."""
+	"""Get the default user interface. This is the terminal if the
+	environment variable ELFKIT_UI is "term", if GTK is not available
+	or if there is no display. Otherwise, GTK is used."""
+	if gtk == None or os.environ.get("ELFKIT_UI") == "term" \
+	or ("DISPLAY" not in os.environ and "WAYLAND_DISPLAY" not in os.environ):
+		import elfkit.term as term
+		return term.DRIVER
 	return gtk.DRIVER
 
 
@@ -80,6 +91,18 @@ class Application(Entity, Context):
 		required from the user. Default does nothing."""
 		return True
 	
+	def save_session(self, name = "session"):
+		"""Save the values of the variables of the application in
+		a session file (see elfkit.session)."""
+		import elfkit.session as session
+		return session.save(self, session.get_path(self, name))
+
+	def restore_session(self, name = "session"):
+		"""Restore the values of the variables saved by save_session()
+		and return the number of changed variables."""
+		import elfkit.session as session
+		return session.restore(self, session.get_path(self, name))
+
 	def run(self, pane = None):
 		"""Run the main loop of the application. The behaviour of this
 		function depends a lot on the underlying UI implementation).
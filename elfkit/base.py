@@ -30,7 +30,18 @@
 #	along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #
 
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import copy
+import inspect
 import sys
+import threading
+import time
+import weakref
+
+from elfkit import trace
 
 NO_TYPE = 0
 STANDARD = 1
@@ -40,6 +51,12 @@ RECORD = 4
 COLLECT = 5
 
 
+# message levels
+INFO = 0
+WARNING = 1
+ERROR = 2
+
+
 class Monitor:
 	"""A monitor is in charge of implementing dialog with the human user
 	in the better way according to the current UI."""
@@ -56,14 +73,22 @@ class Monitor:
 		"""Display the given message as an error."""
 		sys.stderr.write("ERROR: %s\n" % msg)
 
-	def start_job(self, name, help="", icon=""):
+	def start_job(self, name, help="", icon="", cancel=None, job=None):
 		"""Start a job: all messages will be grouped and displayed
-		in a grouped way to the user, under the label name."""
+		in a grouped way to the user, under the label name. If given,
+		cancel is a function the user interface may call to cancel
+		the job. job, if any, identifies the job when several jobs
+		have the same name."""
 		sys.stderr.write("STARTING: %s\n" % name)
 	
-	def end_job(self, name):
+	def end_job(self, name, job=None):
 		"""Called to end the current job."""
 		sys.stderr.write("ENDED:\n")
+
+	def set_progress(self, name, ratio, job=None):
+		"""Display the progress of the job name as a ratio in [0, 1].
+		Default implementation does nothing."""
+		pass
 	
 	def ask_yesno(self, question, deflt=False, help = "", icon=""):
 		"""Ask a question to the user with answer YES or NO.
@@ -124,6 +149,52 @@ class Monitor:
 TEXT_MONITOR = Monitor()
 
 
+def call_now(fun, *args):
+	"""Default UI caller: just call the function."""
+	fun(*args)
+
+UI_CALLER = [call_now]
+
+def set_ui_caller(caller):
+	"""Set the function used to call a function in the thread of the
+	user interface. It is called with the function and its arguments."""
+	UI_CALLER[0] = caller
+
+def call_ui(fun, *args):
+	"""Call the function fun with the given arguments in the thread
+	of the user interface. May be called from any thread."""
+	UI_CALLER[0](fun, *args)
+
+
+TASKS = set()
+
+def spawn(coro, mon = None):
+	"""Run the given coroutine in the running asyncio loop, that is,
+	in the thread of the user interface. If there is no running loop,
+	the coroutine is run to completion. Exceptions are reported
+	to the monitor mon if any."""
+	try:
+		loop = asyncio.get_running_loop()
+	except RuntimeError:
+		loop = None
+	if loop == None:
+		try:
+			asyncio.run(coro)
+		except Exception as e:
+			if mon == None:
+				raise
+			mon.error(str(e))
+		return None
+	task = loop.create_task(coro)
+	TASKS.add(task)
+	def done(task):
+		TASKS.discard(task)
+		if not task.cancelled() and task.exception() != None and mon != None:
+			mon.error(str(task.exception()))
+	task.add_done_callback(done)
+	return task
+
+
 class Context:
 	"""A context represents the aggregation of diffrerent resources
 	facilities encompassing, but not limited to, tranlations, configuration.
@@ -161,11 +232,69 @@ class Subject:
 	def trigger(self, type, fun):
 		"""Trigger an event on all observers of the given type using the
 		function fun that is called with the observer as parameter."""
+		if trace.ENABLED:
+			return trace.trigger(self, type, fun)
 		for obs in self.obss:
 			if isinstance(obs, type):
 				fun(obs)
 
 
+class Message:
+	"""A message recorded in a message store. count is the number of
+	times the message has been received and time the date of the last
+	one."""
+
+	def __init__(self, level, text):
+		self.level = level
+		self.text = text
+		self.count = 1
+		self.time = time.time()
+
+
+class MessageObserver:
+	"""Base class to be implemented for a message store observer."""
+
+	def on_message(self, store, msg):
+		"""Called when a message is added to the store."""
+		pass
+
+
+class MessageStore(Subject):
+	"""A bounded store of messages. Identical messages are collapsed
+	into one message with a counter. When the store is full, the least
+	recently received messages are dropped. Adding a message is O(1)."""
+
+	def __init__(self, size = 1000):
+		Subject.__init__(self)
+		self.size = size
+		self.messages = collections.OrderedDict()
+
+	def add(self, level, text):
+		"""Add a message and return it."""
+		key = (level, text)
+		try:
+			msg = self.messages[key]
+			msg.count = msg.count + 1
+			msg.time = time.time()
+			self.messages.move_to_end(key)
+		except KeyError:
+			msg = Message(level, text)
+			self.messages[key] = msg
+			if len(self.messages) > self.size:
+				self.messages.popitem(last = False)
+		self.trigger(MessageObserver, lambda obs: obs.on_message(self, msg))
+		return msg
+
+	def get_messages(self):
+		"""Get the messages, from the oldest to the most recent."""
+		return list(self.messages.values())
+
+	def clear(self):
+		"""Remove all messages."""
+		self.messages.clear()
+		self.trigger(MessageObserver, lambda obs: obs.on_message(self, None))
+
+
 class EntityObserver:
 	"""Base class to be implemented for an entity change observer."""
 	
@@ -286,10 +415,10 @@ class StandardType(Type):
 	"""Type representing standard types of Python."""
 	
 	def __init__(self, type, **args):
-		Type.__init__(STANDARD, **args)
+		Type.__init__(self, STANDARD, **args)
 		self.type = type
 
-	def is_standard(self, t):
+	def is_standard(self, t = None):
 		return t == None or self.type == t
 
 	def get_default(self):
@@ -310,16 +439,87 @@ class EnumValue(Entity):
 		return self.value
 
 
+class EnumIndex:
+	"""Index over the labels of an enumerated type supporting fast
+	case-insensitive prefix and substring lookup. Results are returned
+	as positions in the list of values."""
+
+	def __init__(self, values):
+		labels = [v.get_label().lower() for v in values]
+		self.order = sorted(range(len(labels)), key=lambda i: labels[i])
+		self.keys = [labels[i] for i in self.order]
+		self.text = "\n".join(labels)
+		self.starts = []
+		p = 0
+		for l in labels:
+			self.starts.append(p)
+			p = p + len(l) + 1
+
+	def prefix(self, text, limit = None):
+		"""Get the positions of values whose label starts with text,
+		in label order."""
+		text = text.lower()
+		res = []
+		i = bisect.bisect_left(self.keys, text)
+		while i < len(self.keys) and self.keys[i].startswith(text):
+			if limit != None and len(res) >= limit:
+				break
+			res.append(self.order[i])
+			i = i + 1
+		return res
+
+	def search(self, text, limit = None):
+		"""Get the positions of values whose label contains text.
+		Prefix matches come first, followed by the other matches
+		in value order."""
+		text = text.lower()
+		res = self.prefix(text, limit)
+		if text == "" or "\n" in text:
+			return res
+		found = set(res)
+		p = self.text.find(text)
+		while p >= 0 and (limit == None or len(res) < limit):
+			i = bisect.bisect_right(self.starts, p) - 1
+			if i not in found:
+				found.add(i)
+				res.append(i)
+			if i + 1 >= len(self.starts):
+				break
+			p = self.text.find(text, self.starts[i + 1])
+		return res
+
+
 class EnumType(Type):
-	"""An enumerated type."""
+	"""An enumerated type. The label index and the value map are only
+	built on demand, so that large enumerations are cheap to declare."""
 	
 	def __init__(self, values, **args):
 		Type.__init__(self, ENUM, **args)
 		self.values = values
+		self.index = None
+		self.positions = None
 	
 	def get_values(self):
 		return self.values
 
+	def get_index(self):
+		"""Get the label index of the enumerated values."""
+		if self.index == None:
+			self.index = EnumIndex(self.values)
+		return self.index
+
+	def position_of(self, value):
+		"""Get the position of the given value in the value list
+		or -1 if it is not found."""
+		if self.positions == None:
+			self.positions = {}
+			for i in range(len(self.values) - 1, -1, -1):
+				self.positions[self.values[i].get_value()] = i
+		try:
+			return self.positions[value]
+		except (KeyError, TypeError):
+			return -1
+
 	def is_enum(self):
 		return True
 
@@ -385,6 +585,34 @@ class CollectType(Type):
 		return "[" + ", ".join([self.type.as_text(i) for i in val]) + "]"
 
 
+# update policies
+UPDATE_LIVE = 0
+UPDATE_THROTTLE = 1
+UPDATE_DEBOUNCE = 2
+UPDATE_RELEASE = 3
+
+
+class UpdatePolicy:
+	"""An update policy describes how an entry propagates to its variable
+	the intermediate values produced while the user is editing it
+	(typically dragging a slider). mode may be one of:
+	* UPDATE_LIVE -- each value is set,
+	* UPDATE_THROTTLE -- at most rate values per second are set,
+	the last one being always set,
+	* UPDATE_DEBOUNCE -- the value is set when it stays unchanged
+	for delay seconds,
+	* UPDATE_RELEASE -- the value is set when the user releases the entry.
+	If preview is a variable, it receives every intermediate value."""
+
+	def __init__(self, mode = UPDATE_LIVE, rate = 30., delay = .2, preview = None):
+		self.mode = mode
+		self.rate = rate
+		self.delay = delay
+		self.preview = preview
+
+LIVE_POLICY = UpdatePolicy()
+
+
 class VarObserver:
 	"""Base class to be implemented for a variable change observer."""
 	
@@ -413,6 +641,7 @@ class AbstractVar(Entity):
 		Entity.__init__(self, **args)
 		Subject.__init__(self)
 		self.type = type
+		self.policy = LIVE_POLICY
 
 	def trigger_update(self, val):
 		self.trigger(VarObserver, lambda obs: obs.on_update(self, val))
@@ -426,6 +655,27 @@ class AbstractVar(Entity):
 		Entity.copy(self, v)
 		return v
 
+	def set_policy(self, policy):
+		"""Set the update policy (see UpdatePolicy) used by the entries
+		editing this variable."""
+		self.policy = policy
+
+	def get_policy(self):
+		"""Get the update policy of the variable."""
+		return self.policy
+
+	def snapshot(self):
+		"""Get a snapshot of the current value that may be given back
+		to restore(). The value is deeply copied as records and
+		collections may be modified in place."""
+		return copy.deepcopy(self.get())
+
+	def restore(self, snap):
+		"""Restore a value obtained by snapshot(). Observers are only
+		notified if the value actually changed."""
+		if self.get() != snap:
+			self.set(snap)
+
 	def __add__(self, op):
 		return self.get().__add__(op)
 	
@@ -453,6 +703,8 @@ class Var(AbstractVar):
 		return self.val
 	
 	def set(self, val):
+		if JOURNAL != []:
+			JOURNAL[0].record(self, self.val, val)
 		self.val = val
 		self.trigger_update(self.get())
 	
@@ -465,6 +717,36 @@ class Var(AbstractVar):
 		return v
 
 
+class FieldVar(AbstractVar):
+	"""A variable giving access to a field of a record variable."""
+
+	def __init__(self, var, field):
+		AbstractVar.__init__(self, field.type,
+			label = field.label if field.label != "" else field.name,
+			icon = field.icon, help = field.help, ctx = field.ctx)
+		self.var = var
+		self.field = field
+
+	def get(self):
+		return self.var.get()[self.field.name]
+
+	def set(self, val):
+		if JOURNAL != []:
+			JOURNAL[0].record(self, self.get(), val)
+		self.var.get()[self.field.name] = val
+		self.trigger_update(val)
+		self.var.trigger_update(self.var.get())
+
+
+class ActionObserver:
+	"""Base class to be implemented for an action observer."""
+
+	def on_check(self, action):
+		"""Called when the availability of the action may have
+		changed."""
+		pass
+
+
 class AbstractAction(Entity, Subject):
 	"""An action is used to identify the possible actions of a user and
 	to trigger this action. In addition, it provides a check function to
@@ -493,6 +775,11 @@ class AbstractAction(Entity, Subject):
 		"""Get the dependencies of the action."""
 		return self.deps
 
+	def trigger_check(self):
+		"""Signal observers that the availability of the action
+		may have changed."""
+		self.trigger(ActionObserver, lambda obs: obs.on_check(self))
+
 	def observe(self, obs):
 		"""The given observer starts to observe the dependencies
 		of the action."""
@@ -527,7 +814,407 @@ class Action(AbstractAction):
 		self.cfun = cfun
 	
 	def apply(self, con):
-		self.afun(con)
+		"""Call afun. If afun is a coroutine function (async def),
+		the coroutine is spawned in the asyncio loop of the UI.
+		If a journal is active, the changes of variables performed
+		by afun are grouped as one undoable change."""
+		journal = JOURNAL[0] if JOURNAL != [] else None
+		if journal != None:
+			journal.begin(self.label)
+		start = time.perf_counter() if trace.ENABLED else None
+		try:
+			r = self.afun(con)
+		finally:
+			if journal != None:
+				journal.end()
+		task = None
+		if inspect.isawaitable(r):
+			task = spawn(r, con if isinstance(con, Monitor) else None)
+		if start != None:
+			name = "apply:%s" % self.label
+			if task == None:
+				trace.add("action", name, start, time.perf_counter())
+			else:
+				task.add_done_callback(lambda task:
+					trace.add("action", name, start, time.perf_counter()))
 	
 	def check(self):
+		if trace.ENABLED:
+			return trace.call("action", "check:%s" % self.label, self.cfun)
 		return self.cfun()
+
+
+class Cancelled(Exception):
+	"""Raised by a job that has been cancelled."""
+	pass
+
+
+class Job:
+	"""A job is a run of a background action. The function of the action
+	may use it to report progress and to check for cancellation."""
+
+	def __init__(self, action, mon):
+		self.action = action
+		self.mon = mon
+		self.cancelled = False
+		self.future = None
+
+	def cancel(self):
+		"""Ask the job to stop. If it has not started yet, it is
+		simply dropped."""
+		self.cancelled = True
+		if self.future != None:
+			self.future.cancel()
+
+	def is_cancelled(self):
+		"""Test if the job has been cancelled."""
+		return self.cancelled
+
+	def check_cancel(self):
+		"""Raise Cancelled if the job has been cancelled."""
+		if self.cancelled:
+			raise Cancelled()
+
+	def progress(self, ratio):
+		"""Report the progress of the job as a ratio in [0, 1]."""
+		call_ui(self.mon.set_progress, self.action.get_label(), ratio, self)
+
+
+EXECUTOR = []
+
+def get_executor():
+	"""Get the default executor of background actions."""
+	if EXECUTOR == []:
+		EXECUTOR.append(concurrent.futures.ThreadPoolExecutor())
+	return EXECUTOR[0]
+
+
+class BackgroundAction(Action):
+	"""An action whose function runs out of the user interface thread,
+	in the given executor (default to a shared thread pool). afun is
+	called with a Job as parameter to report progress and check for
+	cancellation. With a process pool executor, afun must be picklable
+	and is called with None as the job cannot be shared between
+	processes. At most max_runs runs of the action may be active at
+	the same time: the action is not available in between."""
+
+	def __init__(self, afun, cfun = no_check, executor = None, max_runs = 1, **args):
+		Action.__init__(self, afun, cfun, **args)
+		self.executor = executor
+		self.max_runs = max_runs
+		self.jobs = []
+		self.lock = threading.Lock()
+
+	def get_executor(self):
+		"""Get the executor of the action."""
+		if self.executor == None:
+			return get_executor()
+		else:
+			return self.executor
+
+	def check(self):
+		return len(self.jobs) < self.max_runs and self.cfun()
+
+	def apply(self, con):
+		"""Start the action and return its job (None if too many runs
+		are active). con is the monitor used to display the progress
+		and the errors."""
+		if not isinstance(con, Monitor):
+			con = TEXT_MONITOR
+		job = Job(self, con)
+		with self.lock:
+			if len(self.jobs) >= self.max_runs:
+				return None
+			self.jobs.append(job)
+		self.trigger_check()
+		con.start_job(self.get_label(), self.get_help(), self.get_icon(), job.cancel, job)
+		executor = self.get_executor()
+		if isinstance(executor, concurrent.futures.ProcessPoolExecutor):
+			job.future = executor.submit(self.afun, None)
+		else:
+			job.future = executor.submit(self.afun, job)
+		job.future.add_done_callback(lambda f: call_ui(self.end, job))
+		return job
+
+	def end(self, job):
+		"""Called in the user interface thread when a job ends (or in the
+		worker thread if there is no user interface)."""
+		with self.lock:
+			self.jobs.remove(job)
+		try:
+			job.future.result()
+		except (Cancelled, concurrent.futures.CancelledError):
+			job.mon.warn("%s cancelled." % self.get_label())
+		except Exception as e:
+			job.mon.error("%s: %s" % (self.get_label(), e))
+		job.mon.end_job(self.get_label(), job)
+		self.trigger_check()
+
+	def cancel(self):
+		"""Cancel all active runs of the action."""
+		for job in self.jobs:
+			job.cancel()
+
+
+JOURNAL = []
+
+def set_journal(journal):
+	"""Set the journal recording the changes of variables (None to
+	stop recording)."""
+	JOURNAL[:] = [] if journal == None else [journal]
+
+def get_journal():
+	"""Get the active journal, if any."""
+	return JOURNAL[0] if JOURNAL != [] else None
+
+
+def get_value_size(val):
+	"""Estimate the memory used by a value (items of lists and tuples
+	included)."""
+	size = sys.getsizeof(val)
+	if isinstance(val, (list, tuple)):
+		for item in val:
+			size = size + sys.getsizeof(item)
+	return size
+
+# values compared by equality to detect changes that change nothing
+IMMUTABLE_TYPES = (type(None), bool, int, float, complex, str, bytes, tuple, frozenset)
+
+
+class Change:
+	"""A change of a variable recorded in a journal. For collections,
+	only the replaced slice is stored: removed items at start were
+	replaced by inserted ones. Else old and new are the values."""
+	__slots__ = ("var", "old", "new", "start", "size")
+
+	def __init__(self, var, old, new, start = None):
+		self.var = var
+		self.old = old
+		self.new = new
+		self.start = start
+		self.size = get_value_size(old) + get_value_size(new)
+
+	def undo(self):
+		"""Get the value of the variable before the change."""
+		if self.start == None:
+			return self.old
+		val = self.var.get()
+		return val[:self.start] + self.old + val[self.start + len(self.new):]
+
+	def redo(self):
+		"""Get the value of the variable after the change."""
+		if self.start == None:
+			return self.new
+		val = self.var.get()
+		return val[:self.start] + self.new + val[self.start + len(self.old):]
+
+
+class ChangeGroup:
+	"""Group of changes undone and redone together."""
+
+	def __init__(self, label):
+		self.label = label
+		self.changes = []
+		self.size = 0
+
+
+class Journal:
+	"""Journal recording the changes of variables to undo and redo them.
+	Changes are grouped by Action.apply() or batch(); other changes are
+	each a group. The journal keeps at most max_groups groups using about
+	max_size bytes, the oldest groups being dropped first.
+
+	Collections (CollectType) are recorded as deltas: to compute them,
+	the journal keeps a shallow copy of the last value of each collection
+	variable, so collections may be modified in place before set(),
+	except before their first recorded change. These copies are counted
+	in max_size.
+
+	Setting a variable to the same value is not recorded."""
+
+	def __init__(self, max_groups = 1000, max_size = 64 << 20):
+		self.max_groups = max_groups
+		self.max_size = max_size
+		self.undos = collections.deque()
+		self.redos = []
+		self.size = 0
+		self.group = None
+		self.depth = 0
+		self.marks = []
+		self.replaying = False
+		self.shadows = weakref.WeakKeyDictionary()
+		self.undo_action = Action(lambda con: self.undo(), self.can_undo, label = "Undo")
+		self.redo_action = Action(lambda con: self.redo(), self.can_redo, label = "Redo")
+
+	def begin(self, label = ""):
+		"""Start a group of changes. Groups may be nested: only the
+		outer one is recorded."""
+		if self.depth == 0:
+			self.group = ChangeGroup(label)
+		self.marks.append(len(self.group.changes))
+		self.depth = self.depth + 1
+
+	def end(self):
+		"""End a group of changes."""
+		self.marks.pop()
+		self.depth = self.depth - 1
+		if self.depth == 0:
+			group = self.group
+			self.group = None
+			if group.changes != []:
+				self.push(group)
+
+	def cancel(self):
+		"""End a group of changes, forgetting the changes recorded
+		since the matching begin(). The variables are expected to be
+		restored by the caller."""
+		dropped = self.group.changes[self.marks[-1]:]
+		del self.group.changes[self.marks[-1]:]
+		self.group.size = self.group.size - sum(c.size for c in dropped)
+		self.end()
+
+	def batch(self, label = ""):
+		"""Get a context manager grouping the changes performed in
+		a with statement."""
+		return JournalBatch(self, label)
+
+	def record(self, var, old, new):
+		"""Record the change of a variable from old to new value."""
+		if self.replaying:
+			return
+		if not var.type.is_collect() and (old is new
+		or (isinstance(old, IMMUTABLE_TYPES) and type(old) == type(new) and old == new)):
+			return
+		change = self.make_change(var, old, new)
+		if change == None:
+			return
+		if self.group != None:
+			self.group.changes.append(change)
+			self.group.size = self.group.size + change.size
+		else:
+			group = ChangeGroup(var.get_label())
+			group.changes.append(change)
+			group.size = change.size
+			self.push(group)
+
+	def make_change(self, var, old, new):
+		"""Build the change of a variable, None if there is no change."""
+		if not var.type.is_collect():
+			return Change(var, old, new)
+		old = self.shadows.get(var, (old, 0))[0]
+		self.set_shadow(var, new)
+		if not isinstance(old, list) or not isinstance(new, list):
+			return Change(var, old, new)
+		n, m = len(old), len(new)
+		s = 0
+		while s < n and s < m and (old[s] is new[s] or old[s] == new[s]):
+			s = s + 1
+		e = 0
+		while e < n - s and e < m - s and (old[n - 1 - e] is new[m - 1 - e] or old[n - 1 - e] == new[m - 1 - e]):
+			e = e + 1
+		if s == n and s == m:
+			return None
+		return Change(var, old[s:n - e], new[s:m - e], s)
+
+	def push(self, group):
+		"""Add a group to the journal, dropping the redoable ones and
+		the oldest ones if the journal is full."""
+		self.undos.append(group)
+		self.size = self.size + group.size
+		self.redos = []
+		shadow_size = sum(size for (_, size) in self.shadows.values())
+		while len(self.undos) > self.max_groups \
+		or (self.size + shadow_size > self.max_size and len(self.undos) > 1):
+			self.size = self.size - self.undos.popleft().size
+		self.trigger_check()
+
+	def apply(self, change, val):
+		"""Set a variable without recording it."""
+		self.replaying = True
+		try:
+			change.var.set(val)
+		finally:
+			self.replaying = False
+		if change.start != None:
+			self.set_shadow(change.var, val)
+
+	def set_shadow(self, var, val):
+		"""Keep a copy of the value of a collection variable."""
+		shadow = list(val)
+		self.shadows[var] = (shadow, get_value_size(shadow))
+
+	def is_recording(self):
+		"""Test if a group is open and has already recorded changes:
+		undo and redo are refused to not mix them with the group."""
+		return self.group != None and self.group.changes != []
+
+	def can_undo(self):
+		"""Test if there is a change to undo."""
+		return not self.is_recording() and len(self.undos) > 0
+
+	def can_redo(self):
+		"""Test if there is a change to redo."""
+		return not self.is_recording() and self.redos != []
+
+	def undo(self):
+		"""Undo the last group of changes."""
+		if not self.can_undo():
+			return
+		group = self.undos.pop()
+		self.size = self.size - group.size
+		for change in reversed(group.changes):
+			self.apply(change, change.undo())
+		self.redos.append(group)
+		self.trigger_check()
+
+	def redo(self):
+		"""Redo the last undone group of changes."""
+		if not self.can_redo():
+			return
+		group = self.redos.pop()
+		for change in group.changes:
+			self.apply(change, change.redo())
+		self.undos.append(group)
+		self.size = self.size + group.size
+		self.trigger_check()
+
+	def get_undo_label(self):
+		"""Get the label of the group to undo, None if there is none."""
+		return self.undos[-1].label if self.undos else None
+
+	def get_redo_label(self):
+		"""Get the label of the group to redo, None if there is none."""
+		return self.redos[-1].label if self.redos else None
+
+	def refresh(self, var):
+		"""Update the copy of a collection variable kept to compute
+		deltas after its value was changed without being recorded."""
+		if var in self.shadows:
+			self.set_shadow(var, var.val)
+
+	def clear(self):
+		"""Forget all changes."""
+		self.undos.clear()
+		self.redos = []
+		self.size = 0
+		self.trigger_check()
+
+	def trigger_check(self):
+		self.undo_action.trigger_check()
+		self.redo_action.trigger_check()
+
+
+class JournalBatch:
+	"""Context manager returned by Journal.batch()."""
+
+	def __init__(self, journal, label):
+		self.journal = journal
+		self.label = label
+
+	def __enter__(self):
+		self.journal.begin(self.label)
+		return self.journal
+
+	def __exit__(self, type, value, tb):
+		self.journal.end()
+		return False
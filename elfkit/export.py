@@ -0,0 +1,129 @@
+#
+#	ElfKit offscreen export.
+#	Copyright (C) 2019  Hugues Casse <hug.casse@gmail.com>
+#
+#	This file is part of ElfKit.
+#
+#	ElfKit is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	ElfKit is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with ElfKit.  If not, see <https://www.gnu.org/licenses/>.
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+
+"""Offscreen rendering of painters to image files, without any display.
+The format of a file is given by its extension: PNG, PDF, SVG or PS.
+Many renderings may be run in parallel by a pool of processes."""
+
+import multiprocessing
+import os.path
+
+import cairo
+
+from elfkit import paint
+
+
+class Job:
+	"""A rendering job: the painter is painted on an area of size
+	(w, h) and written to path. If params are given, painter is called
+	with them as keyword arguments to build the actual painter: it is
+	usually a painter class or a factory function. Job, painter and
+	parameters must be picklable to be run in a process pool."""
+
+	def __init__(self, painter, path, w, h, params = None, format = None):
+		self.painter = painter
+		self.path = path
+		self.w = w
+		self.h = h
+		self.params = params
+		self.format = format
+
+
+def get_format(path, format = None):
+	"""Get the format of an image file from its extension."""
+	if format != None:
+		return format.lower()
+	return os.path.splitext(path)[1][1:].lower()
+
+
+def render(painter, path, w, h, format = None, background = None):
+	"""Paint the painter on an area of size (w, h) and write the result
+	to path. background, if any, is the RGB color the area is filled
+	with before painting."""
+	format = get_format(path, format)
+	if format == "png":
+		surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+	elif format == "pdf":
+		surface = cairo.PDFSurface(path, w, h)
+	elif format == "svg":
+		surface = cairo.SVGSurface(path, w, h)
+	elif format == "ps":
+		surface = cairo.PSSurface(path, w, h)
+	else:
+		raise ValueError("unsupported format: %s" % format)
+	cr = cairo.Context(surface)
+	if background != None:
+		cr.set_source_rgb(*background)
+		cr.paint()
+	painter.paint(paint.CairoPort(cr), 0, 0, w, h)
+	if format == "png":
+		surface.write_to_png(path)
+	surface.finish()
+
+
+def run_job(job):
+	"""Run a job and return (path, error) where error is None
+	if the job succeeded, else the error message."""
+	try:
+		painter = job.painter
+		if job.params != None:
+			painter = painter(**job.params)
+		render(painter, job.path, job.w, job.h, job.format)
+		return (job.path, None)
+	except Exception as e:
+		return (job.path, "%s: %s" % (e.__class__.__name__, e))
+
+
+def render_batch(jobs, processes = None, method = "spawn", chunksize = 1):
+	"""Run the given jobs in a pool of processes (default to the number
+	of cores) and generate the pair (path, error) of each job as soon as
+	it is done (in any order)."""
+	with multiprocessing.get_context(method).Pool(processes) as pool:
+		for res in pool.imap_unordered(run_job, jobs, chunksize):
+			yield res
+
+
+def export_batch(jobs, mon, processes = None):
+	"""Run the given jobs in parallel and report their progress and
+	their errors on the given monitor. Return the number of failed
+	jobs."""
+	jobs = list(jobs)
+	failed = 0
+	mon.start_job("export")
+	for (i, (path, error)) in enumerate(render_batch(jobs, processes)):
+		if error != None:
+			mon.error("%s: %s" % (path, error))
+			failed = failed + 1
+		mon.set_progress("export", (i + 1) / len(jobs))
+	mon.end_job("export")
+	return failed
@@ -30,5 +30,600 @@
 #	along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #
 
-class MapView:
-	"""A view displaying a 2D map."""
+"""Facilities for 2D games and animations: a fixed-timestep game loop,
+a spatial index of objects, a vectorized collision broadphase and a map
+view painting layers. The collision facilities require numpy."""
+
+import array
+import math
+
+from elfkit import ui
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+class GameLoop:
+	"""Game loop running the simulation with a fixed time step while
+	the rendering follows the frames of the display. Update functions
+	are called with the time step and are registered in priority
+	buckets: lower priorities are updated first. When the display is
+	late, at most max_updates updates are performed per frame and the
+	remaining time is dropped instead of accumulating. Painters may use
+	get_alpha() to interpolate between the two last simulation states."""
+
+	def __init__(self, step = 1. / 60, max_updates = 5):
+		self.step = step
+		self.max_updates = max_updates
+		self.buckets = {}
+		self.priorities = []
+		self.canvases = []
+		self.acc = 0.
+		self.last = None
+		self.alpha = 0.
+		self.time = 0.
+		self.ticks = 0
+		self.dropped = 0.
+		self.running = True
+
+	def add_update(self, fun, priority = 0):
+		"""Add a function called at each step with the step duration."""
+		try:
+			self.buckets[priority].append(fun)
+		except KeyError:
+			self.buckets[priority] = [fun]
+			self.priorities = sorted(self.buckets.keys())
+
+	def remove_update(self, fun, priority = 0):
+		"""Remove an update function."""
+		self.buckets[priority].remove(fun)
+		if self.buckets[priority] == []:
+			del self.buckets[priority]
+			self.priorities = sorted(self.buckets.keys())
+
+	def attach(self, canvas):
+		"""Drive the loop with the frames of the given canvas. The canvas
+		is refreshed after each frame."""
+		id = canvas.add_ticker(self.tick)
+		self.canvases.append((canvas, id))
+
+	def detach(self, canvas):
+		"""Stop driving the loop with the given canvas."""
+		for (c, id) in self.canvases:
+			if c == canvas:
+				c.remove_ticker(id)
+				self.canvases.remove((c, id))
+				break
+
+	def start(self):
+		"""Start or resume the simulation."""
+		self.running = True
+		self.last = None
+
+	def stop(self):
+		"""Pause the simulation."""
+		self.running = False
+
+	def update(self):
+		"""Perform one simulation step."""
+		for p in self.priorities:
+			for fun in list(self.buckets[p]):
+				fun(self.step)
+		self.time = self.time + self.step
+		self.ticks = self.ticks + 1
+
+	def tick(self, now):
+		"""Called at each frame with the date of the frame in seconds."""
+		if not self.running:
+			return
+		if self.last != None:
+			self.acc = self.acc + now - self.last
+		self.last = now
+		n = 0
+		while self.acc >= self.step and n < self.max_updates:
+			self.update()
+			self.acc = self.acc - self.step
+			n = n + 1
+		if self.acc >= self.step:
+			rest = self.acc % self.step
+			if rest >= self.step:
+				rest = 0.
+			self.dropped = self.dropped + self.acc - rest
+			self.acc = rest
+		self.alpha = self.acc / self.step
+		for (canvas, id) in self.canvases:
+			canvas.refresh()
+
+	def get_alpha(self):
+		"""Get the position of the rendered frame between the two last
+		simulation steps, in [0, 1["""
+		return self.alpha
+
+	def interpolate(self, prev, cur):
+		"""Interpolate a value between its previous and its current
+		simulation state."""
+		return prev + (cur - prev) * self.alpha
+
+
+class GridIndex:
+	"""Spatial index of rectangular objects based on a uniform grid
+	of cells of size cell. Each object is recorded in the cells covered
+	by its rectangle: objects moving inside the same cells only update
+	their position. Objects are identified by a slot (see get_slot())
+	that may be used with bulk_move() to move many objects at once:
+	if numpy is available, this operation is vectorized and only the
+	objects changing cells are processed one by one."""
+
+	def __init__(self, cell = 64):
+		self.cell = float(cell)
+		self.cells = {}
+		self.slots = {}
+		self.objs = []
+		self.free = []
+		self.x = array.array("d")
+		self.y = array.array("d")
+		self.w = array.array("d")
+		self.h = array.array("d")
+		self.cover = array.array("q")
+
+	def __len__(self):
+		return len(self.slots)
+
+	def __iter__(self):
+		return iter(self.slots.keys())
+
+	def get_slot(self, obj):
+		"""Get the slot of an object."""
+		return self.slots[obj]
+
+	def get_box(self, obj):
+		"""Get the rectangle (x, y, w, h) of an object."""
+		k = self.slots[obj]
+		return (self.x[k], self.y[k], self.w[k], self.h[k])
+
+	def cells_of(self, x, y, w, h):
+		"""Get the cells covered by a rectangle as (i0, j0, i1, j1)."""
+		c = self.cell
+		return (math.floor(x / c), math.floor(y / c),
+			math.floor((x + w) / c), math.floor((y + h) / c))
+
+	def link(self, k, cover):
+		i0, j0, i1, j1 = cover
+		for i in range(i0, i1 + 1):
+			for j in range(j0, j1 + 1):
+				try:
+					self.cells[(i, j)].add(k)
+				except KeyError:
+					self.cells[(i, j)] = {k}
+
+	def unlink(self, k, cover):
+		i0, j0, i1, j1 = cover
+		for i in range(i0, i1 + 1):
+			for j in range(j0, j1 + 1):
+				cell = self.cells[(i, j)]
+				cell.discard(k)
+				if not cell:
+					del self.cells[(i, j)]
+
+	def get_cover(self, k):
+		return tuple(self.cover[4 * k : 4 * k + 4])
+
+	def set_cover(self, k, cover):
+		self.cover[4 * k : 4 * k + 4] = array.array("q", cover)
+
+	def add(self, obj, x, y, w = 0, h = 0):
+		"""Add an object with the given rectangle and return its slot."""
+		if self.free != []:
+			k = self.free.pop()
+			self.objs[k] = obj
+			self.x[k] = x
+			self.y[k] = y
+			self.w[k] = w
+			self.h[k] = h
+		else:
+			k = len(self.objs)
+			self.objs.append(obj)
+			self.x.append(x)
+			self.y.append(y)
+			self.w.append(w)
+			self.h.append(h)
+			self.cover.extend((0, 0, 0, 0))
+		self.slots[obj] = k
+		cover = self.cells_of(x, y, w, h)
+		self.set_cover(k, cover)
+		self.link(k, cover)
+		return k
+
+	def remove(self, obj):
+		"""Remove an object."""
+		k = self.slots.pop(obj)
+		self.unlink(k, self.get_cover(k))
+		self.objs[k] = None
+		self.free.append(k)
+
+	def move(self, obj, x, y, w = None, h = None):
+		"""Move an object and possibly change its size."""
+		k = self.slots[obj]
+		self.x[k] = x
+		self.y[k] = y
+		if w != None:
+			self.w[k] = w
+		if h != None:
+			self.h[k] = h
+		self.rehash(k, self.cells_of(x, y, self.w[k], self.h[k]))
+
+	def rehash(self, k, cover):
+		old = self.get_cover(k)
+		if old != cover:
+			self.unlink(k, old)
+			self.link(k, cover)
+			self.set_cover(k, cover)
+
+	def bulk_move(self, slots, xs, ys):
+		"""Move the objects of the given slots to the positions in xs
+		and ys (sequences or numpy arrays)."""
+		if numpy == None:
+			for (k, x, y) in zip(slots, xs, ys):
+				self.x[k] = x
+				self.y[k] = y
+				self.rehash(k, self.cells_of(x, y, self.w[k], self.h[k]))
+			return
+		slots = numpy.asarray(slots, dtype = numpy.int64)
+		xs = numpy.asarray(xs, dtype = numpy.float64)
+		ys = numpy.asarray(ys, dtype = numpy.float64)
+		X = numpy.frombuffer(self.x, dtype = numpy.float64)
+		Y = numpy.frombuffer(self.y, dtype = numpy.float64)
+		W = numpy.frombuffer(self.w, dtype = numpy.float64)
+		H = numpy.frombuffer(self.h, dtype = numpy.float64)
+		C = numpy.frombuffer(self.cover, dtype = numpy.int64).reshape(-1, 4)
+		X[slots] = xs
+		Y[slots] = ys
+		new = numpy.floor(numpy.stack([xs, ys, xs + W[slots], ys + H[slots]], axis = 1)
+			/ self.cell).astype(numpy.int64)
+		changed = numpy.any(C[slots] != new, axis = 1)
+		for (k, cover) in zip(slots[changed].tolist(), new[changed].tolist()):
+			old = tuple(C[k].tolist())
+			self.unlink(k, old)
+			self.link(k, cover)
+		C[slots] = new
+
+	def query_rect(self, x, y, w, h):
+		"""Get the objects whose rectangle intersects the given one. If
+		the rectangle covers more cells than the occupied ones, these
+		ones are scanned instead."""
+		i0, j0, i1, j1 = self.cells_of(x, y, w, h)
+		found = set()
+		if (i1 - i0 + 1) * (j1 - j0 + 1) > len(self.cells):
+			for ((i, j), cell) in self.cells.items():
+				if i0 <= i <= i1 and j0 <= j <= j1:
+					found.update(cell)
+		else:
+			for i in range(i0, i1 + 1):
+				for j in range(j0, j1 + 1):
+					try:
+						found.update(self.cells[(i, j)])
+					except KeyError:
+						pass
+		X, Y, W, H = self.x, self.y, self.w, self.h
+		return [self.objs[k] for k in found
+			if X[k] <= x + w and x <= X[k] + W[k] and Y[k] <= y + h and y <= Y[k] + H[k]]
+
+	def query_point(self, x, y):
+		"""Get the objects whose rectangle contains the given point."""
+		c = self.cell
+		try:
+			cell = self.cells[(math.floor(x / c), math.floor(y / c))]
+		except KeyError:
+			return []
+		X, Y, W, H = self.x, self.y, self.w, self.h
+		return [self.objs[k] for k in cell
+			if X[k] <= x <= X[k] + W[k] and Y[k] <= y <= Y[k] + H[k]]
+
+
+def need_numpy():
+	"""Raise an ImportError if numpy is not available."""
+	if numpy == None:
+		raise ImportError("numpy is required by the collision facilities of elfkit.game2d")
+
+
+class EntityStore:
+	"""Storage of entities as a structure of arrays: position (x, y),
+	size (w, h) of the bounding box, radius r and velocity (vx, vy).
+	The arrays grow by doubling; removed entities are marked as dead
+	and their index is reused."""
+
+	def __init__(self, capacity = 1024):
+		need_numpy()
+		self.count = 0
+		self.free = []
+		self.x = numpy.zeros(capacity)
+		self.y = numpy.zeros(capacity)
+		self.w = numpy.zeros(capacity)
+		self.h = numpy.zeros(capacity)
+		self.r = numpy.zeros(capacity)
+		self.vx = numpy.zeros(capacity)
+		self.vy = numpy.zeros(capacity)
+		self.alive = numpy.zeros(capacity, dtype = bool)
+
+	ARRAYS = ["x", "y", "w", "h", "r", "vx", "vy", "alive"]
+
+	def reserve(self, n):
+		"""Ensure the arrays can store n entities."""
+		cap = len(self.x)
+		if n <= cap:
+			return
+		while cap < n:
+			cap = cap * 2
+		for a in self.ARRAYS:
+			old = getattr(self, a)
+			new = numpy.zeros(cap, dtype = old.dtype)
+			new[:len(old)] = old
+			setattr(self, a, new)
+
+	def add(self, x, y, w = 0., h = 0., r = 0., vx = 0., vy = 0.):
+		"""Add an entity and return its index."""
+		if self.free != []:
+			i = self.free.pop()
+		else:
+			self.reserve(self.count + 1)
+			i = self.count
+			self.count = self.count + 1
+		self.x[i], self.y[i], self.w[i], self.h[i] = x, y, w, h
+		self.r[i], self.vx[i], self.vy[i] = r, vx, vy
+		self.alive[i] = True
+		return i
+
+	def add_many(self, x, y, w = 0., h = 0., r = 0., vx = 0., vy = 0.):
+		"""Add entities from arrays (or scalars broadcast to the arrays)
+		and return their indexes."""
+		n = len(x)
+		self.reserve(self.count + n)
+		s = slice(self.count, self.count + n)
+		self.x[s], self.y[s], self.w[s], self.h[s] = x, y, w, h
+		self.r[s], self.vx[s], self.vy[s] = r, vx, vy
+		self.alive[s] = True
+		self.count = self.count + n
+		return numpy.arange(s.start, s.stop)
+
+	def remove(self, i):
+		"""Remove an entity."""
+		self.alive[i] = False
+		self.free.append(i)
+
+	def indexes(self):
+		"""Get the indexes of the living entities."""
+		return numpy.flatnonzero(self.alive[:self.count])
+
+	def integrate(self, dt):
+		"""Move the entities according to their velocity during dt."""
+		n = self.count
+		self.x[:n] += self.vx[:n] * dt
+		self.y[:n] += self.vy[:n] * dt
+
+	def pairs(self, method = "grid", cell = None, shape = "aabb"):
+		"""Get the pairs of colliding living entities as two arrays
+		of indexes. method is "grid" or "sweep" for the broadphase,
+		shape is "aabb", "circle" (centered on (x, y)) or None
+		to skip the narrowphase."""
+		ids = self.indexes()
+		if shape == "circle":
+			r = self.r[ids]
+			x, y, w, h = self.x[ids] - r, self.y[ids] - r, 2 * r, 2 * r
+		else:
+			x, y, w, h = self.x[ids], self.y[ids], self.w[ids], self.h[ids]
+		if method == "sweep":
+			a, b = sweep_pairs(x, y, w, h)
+		else:
+			a, b = grid_pairs(x, y, w, h, cell)
+		a, b = ids[a], ids[b]
+		if shape == "circle":
+			keep = circle_overlap(a, b, self.x, self.y, self.r)
+		elif shape == "aabb":
+			keep = aabb_overlap(a, b, self.x, self.y, self.w, self.h)
+		else:
+			return (a, b)
+		return (a[keep], b[keep])
+
+
+def expand_ranges(starts, ends):
+	"""For each i, generate the pairs (i, j) with j in [starts[i], ends[i][.
+	Return the arrays of i and j."""
+	counts = numpy.maximum(ends - starts, 0)
+	total = int(counts.sum())
+	owners = numpy.repeat(numpy.arange(len(starts)), counts)
+	offsets = numpy.arange(total) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+	return (owners, numpy.repeat(starts, counts) + offsets)
+
+
+def sweep_pairs(x, y, w, h):
+	"""Sort-and-sweep broadphase: get the pairs (a, b) of boxes whose
+	projections overlap on both axes, as two arrays of indexes."""
+	need_numpy()
+	order = numpy.argsort(x, kind = "stable")
+	x0 = x[order]
+	x1 = x0 + w[order]
+	n = len(x0)
+	ends = numpy.searchsorted(x0, x1, side = "right")
+	i, j = expand_ranges(numpy.arange(1, n + 1), ends)
+	a = order[i]
+	b = order[j]
+	keep = (y[a] <= y[b] + h[b]) & (y[b] <= y[a] + h[a])
+	return (a[keep], b[keep])
+
+
+NEIGHBOURS = [(0, 0), (1, -1), (1, 0), (1, 1), (0, 1)]
+
+def grid_pairs(x, y, w, h, cell = None):
+	"""Grid broadphase: boxes are bucketed by the cell of their lower
+	corner and compared with the boxes of the neighbour cells. The cell
+	size must be at least the size of the biggest box (default to it).
+	Return the pairs (a, b) of overlapping boxes as two arrays of
+	indexes."""
+	need_numpy()
+	n = len(x)
+	empty = numpy.zeros(0, dtype = numpy.int64)
+	if n == 0:
+		return (empty, empty)
+	if cell == None:
+		cell = max(float(w.max()), float(h.max()), 1e-9)
+	ci = numpy.floor((x - x.min()) / cell).astype(numpy.int64)
+	cj = numpy.floor((y - y.min()) / cell).astype(numpy.int64)
+	stride = int(cj.max()) + 3
+	keys = ci * stride + cj + 1
+	order = numpy.argsort(keys, kind = "stable")
+	skeys = keys[order]
+	res_a = []
+	res_b = []
+	for (di, dj) in NEIGHBOURS:
+		nkeys = skeys + di * stride + dj
+		starts = numpy.searchsorted(skeys, nkeys, side = "left")
+		ends = numpy.searchsorted(skeys, nkeys, side = "right")
+		if di == 0 and dj == 0:
+			starts = numpy.arange(1, n + 1)
+		i, j = expand_ranges(starts, ends)
+		res_a.append(order[i])
+		res_b.append(order[j])
+	a = numpy.concatenate(res_a)
+	b = numpy.concatenate(res_b)
+	keep = (x[a] <= x[b] + w[b]) & (x[b] <= x[a] + w[a]) \
+		& (y[a] <= y[b] + h[b]) & (y[b] <= y[a] + h[a])
+	return (a[keep], b[keep])
+
+
+def aabb_overlap(a, b, x, y, w, h):
+	"""Narrowphase for boxes: get the mask of pairs (a, b) whose boxes
+	overlap."""
+	return (x[a] <= x[b] + w[b]) & (x[b] <= x[a] + w[a]) \
+		& (y[a] <= y[b] + h[b]) & (y[b] <= y[a] + h[a])
+
+
+def circle_overlap(a, b, x, y, r):
+	"""Narrowphase for circles centered on (x, y) with radius r:
+	get the mask of pairs (a, b) whose circles overlap."""
+	dx = x[a] - x[b]
+	dy = y[a] - y[b]
+	rr = r[a] + r[b]
+	return dx * dx + dy * dy <= rr * rr
+
+
+class Sprite:
+	"""An object displayed by a sprite layer. Default implementation
+	paints a box of the given color or, if any, the image."""
+
+	def __init__(self, w, h, color = (1., 1., 1.), image = None):
+		self.w = w
+		self.h = h
+		self.color = color
+		self.image = image
+
+	def paint(self, draw, x, y):
+		"""Paint the sprite at (x, y)."""
+		if self.image != None:
+			draw.draw_image(self.image, x, y)
+		else:
+			draw.set_color(self.color)
+			draw.fill_box(x, y, self.w, self.h)
+
+
+class SpriteLayer(ui.Painter):
+	"""Layer of a map view displaying sprites. Sprites are kept in a
+	spatial index to only paint the visible ones and to find the sprites
+	under a point."""
+
+	def __init__(self, cell = 64):
+		self.index = GridIndex(cell)
+
+	def add(self, sprite, x, y):
+		"""Add a sprite at the given position."""
+		return self.index.add(sprite, x, y, sprite.w, sprite.h)
+
+	def remove(self, sprite):
+		"""Remove a sprite."""
+		self.index.remove(sprite)
+
+	def move(self, sprite, x, y):
+		"""Move a sprite."""
+		self.index.move(sprite, x, y, sprite.w, sprite.h)
+
+	def get_position(self, sprite):
+		"""Get the position of a sprite."""
+		return self.index.get_box(sprite)[:2]
+
+	def pick(self, x, y):
+		"""Get the sprites under the point (x, y)."""
+		return self.index.query_point(x, y)
+
+	def pick_rect(self, x, y, w, h):
+		"""Get the sprites intersecting the given rectangle."""
+		return self.index.query_rect(x, y, w, h)
+
+	def is_retained(self, layer):
+		return False
+
+	def paint(self, draw, x, y, w, h):
+		index = self.index
+		for sprite in index.query_rect(x, y, w, h):
+			k = index.slots[sprite]
+			sprite.paint(draw, index.x[k], index.y[k])
+
+
+class TileLayer(ui.Painter):
+	"""Layer of a map view displaying the level 0 of a tile store
+	(tiles.TileStore) at (x, y): only the visible tiles are read, the
+	other ones stay on disk."""
+
+	def __init__(self, store, x = 0, y = 0):
+		self.store = store
+		self.x = x
+		self.y = y
+
+	def is_retained(self, layer):
+		return False
+
+	def paint(self, draw, x, y, w, h):
+		T = self.store.tile
+		x, y = x - self.x, y - self.y
+		for ty in range(max(int(y) // T, 0), min(int(math.ceil((y + h) / T)), self.store.rows[0])):
+			for tx in range(max(int(x) // T, 0), min(int(math.ceil((x + w) / T)), self.store.cols[0])):
+				surface = self.store.get_surface(0, tx, ty)
+				if surface != None:
+					draw.draw_image(surface, self.x + tx * T, self.y + ty * T)
+
+
+class MapView(ui.Painter):
+	"""A view displaying a 2D map, made of layers painted from the
+	first to the last. Layers are painters."""
+
+	def __init__(self, layers = None, loop = None):
+		self.layers = [] if layers == None else layers
+		self.loop = loop
+
+	def add_layer(self, layer):
+		"""Add a layer over the existing ones."""
+		self.layers.append(layer)
+
+	def remove_layer(self, layer):
+		"""Remove a layer."""
+		self.layers.remove(layer)
+
+	def get_loop(self):
+		"""Get the game loop animating the view, if any."""
+		return self.loop
+
+	def paint(self, draw, x, y, w, h):
+		for layer in self.layers:
+			layer.paint(draw, x, y, w, h)
+
+	def get_layers(self):
+		return self.layers
+
+	def paint_layer(self, draw, layer, x, y, w, h):
+		layer.paint(draw, x, y, w, h)
+
+	def get_deps(self, layer):
+		return layer.get_deps(None)
+
+	def is_retained(self, layer):
+		return layer.is_retained(None)
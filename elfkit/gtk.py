@@ -44,9 +44,16 @@ This module should not be called by usual applications.
 #	https://developer.gnome.org/pygtk/stable/gtk-stock-items.html
 
 
+import asyncio
+import collections
+import hashlib
 import inspect
+import json
+import math
 import os.path
+import selectors
 import sys
+import time
 
 import gi
 gi.require_version('Gtk', '3.0')
@@ -57,7 +64,9 @@ from gi.repository import GLib
 import cairo
 
 import elfkit.base as base
+from elfkit import trace
 import elfkit.ui as ui
+from elfkit import paint
 from elfkit import view
 
 STOCK_MAP = {
@@ -84,11 +93,45 @@ ICON_SIZE_MAP = {
 }
 
 
+# enumerations with more values use a searchable entry
+LAZY_ENUM_SIZE = 1000
+
+# maximal number of completions displayed by a searchable entry
+LAZY_ENUM_MATCHES = 50
+
+# number of rows displayed by a form page before scrolling
+FORM_ROWS = 20
+
+# label of the page gathering variables out of records
+FORM_MAIN_PAGE = "General"
+
+# refresh period of the statistics overlay of canvases (in ms)
+OVERLAY_PERIOD = 500
+
+# number of dialogs kept by a frame for reuse
+DIALOG_CACHE_SIZE = 8
+
+# maximal number of refreshes per second of message panels
+MESSAGE_RATE = 4.
+
+MESSAGE_TYPE_MAP = {
+	base.INFO:		Gtk.MessageType.INFO,
+	base.WARNING:	Gtk.MessageType.WARNING,
+	base.ERROR:		Gtk.MessageType.ERROR
+}
+
+MESSAGE_ICON_MAP = {
+	base.INFO:		"dialog-information",
+	base.WARNING:	"dialog-warning",
+	base.ERROR:		"dialog-error"
+}
+
+
 def error(msg):
 	sys.stderr.write("ERROR: %s\n" % msg)
 
 
-class MenuObserver:
+class MenuObserver(base.ActionObserver):
 	
 	def __init__(self, item, action, con):
 		self.item = item
@@ -96,7 +139,10 @@ class MenuObserver:
 		self.con = con
 	
 	def on_update(self, var, val):
-		self.item.set_sensitivie(self.action())
+		self.item.set_sensitive(self.action.check())
+
+	def on_check(self, action):
+		self.on_update(None, None)
 
 	def activate(self, item):
 		self.action.apply(self.con)
@@ -119,6 +165,7 @@ def make_menu_action(action, menu, win):
 	obs = MenuObserver(item, action, win)
 	for dep in action.get_deps():
 		dep.add_observer(obs)
+	action.add_observer(obs)
 	item.connect("activate", obs.activate)
 
 
@@ -179,7 +226,42 @@ class EnumMenuObserver:
 			self.updating = False
 
 
-def make_enum_menu(var, menu):
+class LazyEnumMenuObserver:
+
+	def __init__(self, var, item, win):
+		self.var = var
+		self.item = item
+		self.win = win
+		self.on_update(var, var.get())
+
+	def activate(self, item):
+		self.win.ask_dialog(self.var.label, [self.var], self.var.help)
+
+	def on_update(self, var, val):
+		i = var.type.position_of(val)
+		if i >= 0:
+			self.item.set_label("%s: %s" % (var.label, var.type.get_values()[i].label))
+		else:
+			self.item.set_label("%s..." % var.label)
+
+
+def make_lazy_enum_menu(var, menu, win):
+	"""Make a menu item for a large enumerated variable: instead of one
+	radio item per value, the item opens a dialog with a searchable
+	entry."""
+	item = Gtk.MenuItem("")
+	menu.append(item)
+	if var.help != "":
+		item.set_tooltip_text(var.help)
+	obs = LazyEnumMenuObserver(var, item, win)
+	item.connect("activate", obs.activate)
+	var.add_observer(obs)
+
+
+def make_enum_menu(var, menu, win = None):
+	if win != None and len(var.type.get_values()) > LAZY_ENUM_SIZE:
+		make_lazy_enum_menu(var, menu, win)
+		return
 	group = []
 	for val in var.type.get_values():
 		
@@ -209,6 +291,14 @@ def make_enum_menu(var, menu):
 
 def build_menu(menu, win):
 	"""Build the given menu."""
+	if trace.ENABLED:
+		with trace.Span("build", "menu"):
+			return make_menubar(menu, win)
+	return make_menubar(menu, win)
+
+
+def make_menubar(menu, win):
+	"""Build the menu bar of the given menu."""
 	menubar = Gtk.MenuBar()
 	for (name, items) in menu:
 		top_item = Gtk.MenuItem(name)
@@ -221,7 +311,7 @@ def build_menu(menu, win):
 				continue
 			elif isinstance(item, base.AbstractVar):
 				if item.type.is_enum():
-					make_enum_menu(item, top_menu)
+					make_enum_menu(item, top_menu, win)
 					continue
 				elif item.type.is_standard(bool):
 					make_checked_menu(item, top_menu)
@@ -231,78 +321,467 @@ def build_menu(menu, win):
 
 
 class RangeEntryObserver:
+	"""Observer of a range entry. The values are propagated to the
+	variable according to the update policy of the entry or, if None,
+	of the variable."""
 	
-	def __init__(self, var):
+	def __init__(self, var, entry, policy = None):
 		self.var = var
+		self.entry = entry
+		self.policy = policy
+		self.pending = None
+		self.timer = None
+		self.last = 0.
+		self.pressed = False
+
+	def get_policy(self):
+		if self.policy != None:
+			return self.policy
+		else:
+			return self.var.get_policy()
 	
 	def on_change_value(self, range, scrol, value):
-		self.var.set(int(value))
-		
+		value = max(self.var.type.low, min(self.var.type.up, int(value)))
+		policy = self.get_policy()
+		if policy.preview != None and policy.preview.get() != value:
+			policy.preview.set(value)
+		self.pending = value
+		if policy.mode == base.UPDATE_THROTTLE:
+			now = time.monotonic()
+			wait = self.last + 1. / policy.rate - now
+			if wait <= 0:
+				self.commit()
+			elif self.timer == None:
+				self.timer = GLib.timeout_add(int(wait * 1000) + 1, self.on_timeout)
+		elif policy.mode == base.UPDATE_DEBOUNCE:
+			self.cancel()
+			self.timer = GLib.timeout_add(int(policy.delay * 1000), self.on_timeout)
+		elif policy.mode == base.UPDATE_RELEASE:
+			if not self.pressed:
+				self.commit()
+		else:
+			self.commit()
+		return False
+
+	def on_press(self, widget, event):
+		self.pressed = True
+		return False
+
+	def on_release(self, widget, event):
+		self.pressed = False
+		self.commit()
+		return False
+
+	def on_timeout(self):
+		self.timer = None
+		self.commit()
+		return False
+
+	def cancel(self):
+		"""Cancel the current timer if any."""
+		if self.timer != None:
+			GLib.source_remove(self.timer)
+			self.timer = None
+
+	def discard(self):
+		"""Drop the pending value, if any."""
+		self.cancel()
+		self.pending = None
+
+	def commit(self):
+		"""Set the pending value, if any, to the variable."""
+		self.cancel()
+		if self.pending != None:
+			value = self.pending
+			self.pending = None
+			self.last = time.monotonic()
+			if value != self.var.get():
+				self.var.set(value)
+
+	def bind(self, var):
+		self.commit()
+		self.var = var
+		self.entry.get_adjustment().configure(var.get(),
+			var.type.low, var.type.up, 1, 10, 0)
 
-def build_range_entry(var, win):
-	"""Build a range entry."""
+
+def make_range_entry(var, win, policy = None):
+	"""Build the observer of a range entry. If policy is given, it
+	overrides the update policy of the variable."""
 	entry = Gtk.Scale.new(Gtk.Orientation.HORIZONTAL,
 		Gtk.Adjustment(var.get(), var.type.low, var.type.up))
 	entry.set_value(var.get())
 	entry.set_digits(0)
 	entry.set_hexpand(True)
-	obs = RangeEntryObserver(var)
+	obs = RangeEntryObserver(var, entry, policy)
 	entry.connect("change-value", obs.on_change_value)
-	return entry
+	entry.connect("button-press-event", obs.on_press)
+	entry.connect("button-release-event", obs.on_release)
+	return obs
+
+
+def build_range_entry(var, win, policy = None):
+	"""Build a range entry."""
+	return make_range_entry(var, win, policy).entry
 
 
 class EnumEntryObserver:
 	
-	def __init__(self, var):
+	def __init__(self, var, entry):
 		self.var = var
+		self.entry = entry
+		self.type = None
+		self.updating = False
 	
 	def on_changed(self, cbox):
-		self.var.set(self.var.type.get_values()[cbox.get_active()].get_value())
-	
+		if not self.updating:
+			self.var.set(self.var.type.get_values()[cbox.get_active()].get_value())
 
-def build_enum_entry(var, win):
-	"""Builf an enumerated entry."""
-	store = Gtk.ListStore(str)
-	i = 0
-	for val in var.type.get_values():
-		if val.get_value() == var.get():
-			i = len(store)
-		store.append([val.label])
-	entry = Gtk.ComboBox.new_with_model(store)
+	def bind(self, var):
+		self.updating = True
+		self.var = var
+		if var.type != self.type:
+			self.type = var.type
+			store = self.entry.get_model()
+			store.clear()
+			for val in var.type.get_values():
+				store.append([val.label])
+		self.entry.set_active(max(var.type.position_of(var.get()), 0))
+		self.updating = False
+
+
+def make_enum_entry(var, win):
+	"""Build the observer of an enumerated entry."""
+	entry = Gtk.ComboBox.new_with_model(Gtk.ListStore(str))
 	renderer = Gtk.CellRendererText()
 	entry.pack_start(renderer, True)
 	entry.add_attribute(renderer, "text", 0)
-	entry.set_active(i)
-	obs = EnumEntryObserver(var)
+	obs = EnumEntryObserver(var, entry)
+	obs.bind(var)
 	entry.connect("changed", obs.on_changed)
-	return entry
+	return obs
 
 
-def build_entry(var, win):
-	"""Build an entry to be embedded in a form."""
+def build_enum_entry(var, win):
+	"""Builf an enumerated entry."""
+	return make_enum_entry(var, win).entry
+
+
+class LazyEnumEntryObserver:
+
+	def __init__(self, var, entry):
+		self.var = var
+		self.entry = entry
+		self.store = Gtk.ListStore(str, int)
+		self.updating = False
+
+	def set_text(self, val):
+		self.updating = True
+		i = self.var.type.position_of(val)
+		if i >= 0:
+			self.entry.set_text(self.var.type.get_values()[i].label)
+		else:
+			self.entry.set_text("")
+		self.updating = False
+
+	def on_changed(self, entry):
+		if self.updating:
+			return
+		self.store.clear()
+		text = entry.get_text()
+		if text != "":
+			values = self.var.type.get_values()
+			for i in self.var.type.get_index().search(text, LAZY_ENUM_MATCHES):
+				self.store.append([values[i].label, i])
+
+	def on_match_selected(self, completion, model, iter):
+		self.select(model[iter][1])
+		return True
+
+	def on_activate(self, entry):
+		if len(self.store) > 0:
+			self.select(self.store[0][1])
+		else:
+			self.set_text(self.var.get())
+
+	def on_focus_out(self, entry, event):
+		self.set_text(self.var.get())
+		return False
+
+	def select(self, i):
+		self.var.set(self.var.type.get_values()[i].get_value())
+		self.set_text(self.var.get())
+
+	def bind(self, var):
+		self.var = var
+		self.store.clear()
+		self.set_text(var.get())
+
+
+def make_lazy_enum_entry(var, win):
+	"""Build the observer of an enumerated entry for large enumerations.
+	Instead of loading all values in a combo box, the user types in
+	a text entry and only the values matching the text are loaded
+	as completions."""
+	entry = Gtk.Entry()
+	entry.set_hexpand(True)
+	obs = LazyEnumEntryObserver(var, entry)
+	completion = Gtk.EntryCompletion()
+	completion.set_model(obs.store)
+	completion.set_text_column(0)
+	completion.set_match_func(lambda c, k, i, d: True, None)
+	entry.set_completion(completion)
+	obs.set_text(var.get())
+	entry.connect("changed", obs.on_changed)
+	entry.connect("activate", obs.on_activate)
+	entry.connect("focus-out-event", obs.on_focus_out)
+	completion.connect("match-selected", obs.on_match_selected)
+	return obs
+
+
+def build_lazy_enum_entry(var, win):
+	"""Build an enumerated entry for large enumerations."""
+	return make_lazy_enum_entry(var, win).entry
+
+
+class LabelEntryObserver:
+
+	def __init__(self, var, entry):
+		self.var = var
+		self.entry = entry
+
+	def bind(self, var):
+		self.var = var
+		self.entry.set_text(var.label)
+
+
+def make_label_entry(var, win):
+	"""Build the observer of an entry for non-editable types."""
+	return LabelEntryObserver(var, Gtk.Label(var.label))
+
+
+def entry_maker(var):
+	"""Get the function building the entry observer for the given
+	variable."""
 	if var.type.is_range():
-		entry = build_range_entry(var, win)
+		return make_range_entry
 	elif var.type.is_enum():
-		entry = build_enum_entry(var, win)
+		if len(var.type.get_values()) > LAZY_ENUM_SIZE:
+			return make_lazy_enum_entry
+		else:
+			return make_enum_entry
 	else:
-		entry = Gtk.Label(var.label)
+		return make_label_entry
+
+
+def make_entry(var, win):
+	"""Build the observer of an entry for the given variable. The widget
+	itself is in the entry attribute of the observer."""
+	return entry_maker(var)(var, win)
+
+
+def build_entry(var, win):
+	"""Build an entry to be embedded in a form."""
+	entry = make_entry(var, win).entry
 	if var.help != "":
 		entry.set_tooltip_text(var.help)
 	return entry
 
+
+class FormRow:
+	"""A row of a form, made of a label and an entry. The row may be
+	bound successively to different variables: the entries are kept
+	by kind and reused."""
+
+	def __init__(self, grid, i, win):
+		self.win = win
+		self.label = Gtk.Label("")
+		self.label.set_xalign(1.)
+		grid.attach(self.label, 0, i, 1, 1)
+		self.slot = Gtk.Box()
+		self.slot.set_hexpand(True)
+		grid.attach(self.slot, 1, i, 1, 1)
+		self.entries = {}
+		self.current = None
+
+	def bind(self, var):
+		"""Display the given variable in the row. If var is None,
+		the row is hidden."""
+		if var == None:
+			self.label.hide()
+			self.slot.hide()
+			return
+		self.label.set_text(var.label)
+		maker = entry_maker(var)
+		try:
+			obs = self.entries[maker]
+			obs.bind(var)
+		except KeyError:
+			obs = maker(var, self.win)
+			self.entries[maker] = obs
+		if obs != self.current:
+			if self.current != None:
+				self.slot.remove(self.current.entry)
+			self.slot.pack_start(obs.entry, True, True, 0)
+			self.current = obs
+		obs.entry.set_tooltip_text(var.help if var.help != "" else None)
+		obs.entry.show()
+		self.label.show()
+		self.slot.show()
+
+
+class FormPage:
+	"""A page of a form. The widgets of the page are only built when
+	the page is displayed the first time. If the page contains more than
+	FORM_ROWS variables, only FORM_ROWS rows are built and recycled
+	as the page is scrolled. The variables may be given as a list or
+	as a record variable whose fields are displayed."""
+
+	def __init__(self, label, win, vars = None, record = None):
+		self.label = label
+		self.win = win
+		self.vars = vars
+		self.record = record
+		self.rows = []
+		self.adjustment = None
+		self.widget = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
+
+	def get_vars(self):
+		"""Get the variables of the page."""
+		if self.vars == None:
+			self.vars = [base.FieldVar(self.record, f)
+				for f in self.record.type.fields]
+		return self.vars
+
+	def build(self):
+		"""Build the widgets of the page if not already done."""
+		if self.rows != []:
+			return
+		vars = self.get_vars()
+		grid = Gtk.Grid(column_spacing=8, row_spacing=8)
+		grid.set_hexpand(True)
+		for i in range(min(len(vars), FORM_ROWS)):
+			self.rows.append(FormRow(grid, i, self.win))
+		if len(vars) <= FORM_ROWS:
+			self.widget.pack_start(grid, True, True, 0)
+		else:
+			events = Gtk.EventBox()
+			events.add(grid)
+			events.add_events(Gdk.EventMask.SCROLL_MASK
+				| Gdk.EventMask.SMOOTH_SCROLL_MASK)
+			events.connect("scroll-event", self.on_scroll)
+			self.widget.pack_start(events, True, True, 0)
+			self.adjustment = Gtk.Adjustment(0, 0, len(vars), 1,
+				FORM_ROWS, FORM_ROWS)
+			self.adjustment.connect("value-changed", self.on_value_changed)
+			bar = Gtk.Scrollbar.new(Gtk.Orientation.VERTICAL, self.adjustment)
+			self.widget.pack_start(bar, False, False, 0)
+		self.widget.show_all()
+		self.on_value_changed(self.adjustment)
+
+	def on_value_changed(self, adjustment):
+		if adjustment == None:
+			offset = 0
+		else:
+			offset = int(adjustment.get_value())
+		for i in range(len(self.rows)):
+			if offset + i < len(self.vars):
+				self.rows[i].bind(self.vars[offset + i])
+			else:
+				self.rows[i].bind(None)
+
+	def on_scroll(self, widget, event):
+		if event.direction == Gdk.ScrollDirection.UP:
+			d = -3
+		elif event.direction == Gdk.ScrollDirection.DOWN:
+			d = 3
+		elif event.direction == Gdk.ScrollDirection.SMOOTH:
+			d = event.get_scroll_deltas()[2] * 3
+		else:
+			return False
+		v = self.adjustment.get_value() + d
+		v = min(v, self.adjustment.get_upper() - self.adjustment.get_page_size())
+		self.adjustment.set_value(max(v, 0))
+		return True
+
+
+def make_pages(vars, win):
+	"""Group the variables in pages. Each record variable gives a page
+	with its fields while the other consecutive variables are gathered
+	in a common page."""
+	pages = []
+	current = None
+	for v in vars:
+		if v.type.is_record():
+			pages.append(FormPage(v.label, win, record = v))
+			current = None
+		else:
+			if current == None:
+				current = FormPage(FORM_MAIN_PAGE, win, vars = [])
+				pages.append(current)
+			current.vars.append(v)
+	return pages
+
+
+class Form:
+	"""A form to edit variables. Variables are displayed by pages
+	(see make_pages()), which are built lazily when they become visible
+	so that the cost of opening a form does not depend on the number
+	of variables."""
+
+	def __init__(self, vars, win):
+		self.pages = make_pages(vars, win)
+		if len(self.pages) == 0:
+			self.widget = Gtk.Box()
+		elif len(self.pages) == 1:
+			self.widget = self.pages[0].widget
+		else:
+			self.widget = Gtk.Notebook()
+			self.widget.set_scrollable(True)
+			for page in self.pages:
+				self.widget.append_page(page.widget, Gtk.Label(page.label))
+			self.widget.connect("switch-page", self.on_switch_page)
+		if self.pages != []:
+			self.pages[0].build()
+		self.widget.show_all()
+
+	def on_switch_page(self, notebook, widget, num):
+		self.pages[num].build()
+
+	def refresh(self):
+		"""Update the built pages with the current values of the
+		variables."""
+		for page in self.pages:
+			if page.rows != []:
+				page.on_value_changed(page.adjustment)
+
+	def flush(self, keep):
+		"""Set to their variables (keep is True) or drop (keep is False)
+		the values held by the entries with a delayed update policy."""
+		for page in self.pages:
+			for row in page.rows:
+				for obs in row.entries.values():
+					if isinstance(obs, RangeEntryObserver):
+						if keep:
+							obs.commit()
+						else:
+							obs.discard()
+
+	def get_widget(self):
+		"""Get the corresponding GTK widget."""
+		return self.widget
+
+
 def build_form(vars, win):
 	"""Build a form for the given variables."""
-	grid = Gtk.Grid(column_spacing=8, row_spacing=8)
-	i = 0
-	for v in vars:
-		label = Gtk.Label(v.label)
-		label.set_xalign(1.)
-		grid.attach(label, 0, i, 1, 1)
-		item = build_entry(v, win)
-		grid.attach_next_to(item, label, Gtk.PositionType.RIGHT, 1, 1)
-		i = i + 1
-	grid.show_all()
-	return grid
+	return make_form(vars, win).get_widget()
+
+
+def make_form(vars, win):
+	"""Build a Form object for the given variables."""
+	if trace.ENABLED:
+		return trace.call("build", "form", Form, vars, win)
+	return Form(vars, win)
 
 
 class Widget:
@@ -312,34 +791,46 @@ class Widget:
 		return None
 
 
-class DrawingPort:
-
-	def get_rgb(self, r, g, b):
-		if isinstance(r, int):
-			return (r / 255., g / 255., b / 255.)
-		else:
-			return (r, g, b)
-	
-	def set_color(self, color):
-		self.color = color
-	
-	def box(self, x, y, w, h):
-		r, g, b = self.color
-		cr.set_source_rgb(r, g, b)
-		cr.new_path()
-		rectangle(x, y, w, h)
-		cr.stroke()
-	
-	def fill_box(self, x, y, w, h):
-		r, g, b = self.color
-		cr.set_source_rgb(r, g, b)
-		cr.new_path()
-		rectangle(x, y, w, h)
-		cr.fill()
+class DrawingPort(paint.CairoPort):
+	"""Drawing area on a cairo context supporting also GDK pixbufs
+	as images."""
 	
 	def draw_image(self, image, x, y):
-		Gdk.cairo_set_source_pixbuf(cr, image, x, y)
-		cr.paint()
+		if isinstance(image, GdkPixbuf.Pixbuf):
+			Gdk.cairo_set_source_pixbuf(self.cr, image, x, y)
+			self.cr.paint()
+		else:
+			paint.CairoPort.draw_image(self, image, x, y)
+
+
+class LayerObserver(base.VarObserver):
+	"""Observer invalidating a layer of a canvas."""
+
+	def __init__(self, canvas, layer):
+		self.canvas = canvas
+		self.layer = layer
+
+	def on_update(self, var, val):
+		self.canvas.invalidate(self.layer)
+
+
+SCROLL_MAP = {
+	Gdk.ScrollDirection.UP:		(0, -1),
+	Gdk.ScrollDirection.DOWN:	(0, 1),
+	Gdk.ScrollDirection.LEFT:	(-1, 0),
+	Gdk.ScrollDirection.RIGHT:	(1, 0)
+}
+
+def get_mods(state):
+	"""Convert a GDK modifier state into ui.MOD_XXX."""
+	mods = 0
+	if state & Gdk.ModifierType.SHIFT_MASK:
+		mods = mods | ui.MOD_SHIFT
+	if state & Gdk.ModifierType.CONTROL_MASK:
+		mods = mods | ui.MOD_CONTROL
+	if state & Gdk.ModifierType.MOD1_MASK:
+		mods = mods | ui.MOD_ALT
+	return mods
 
 
 class Canvas(ui.Canvas, Widget):
@@ -360,6 +851,24 @@ class Canvas(ui.Canvas, Widget):
 		self.w = 0
 		self.h = 0
 		self.port = DrawingPort()
+		self.stats = None
+		self.overlay = False
+		self.overlay_timer = None
+		self.overlay_rect = (0, 0, 0, 0)
+		self.overlay_only = False
+		self.queued = None
+		self.retained = False
+		self.records = {}
+		self.observers = []
+		self.tiles = None
+		self.transform = (1., 0., 0.)
+		self.handler = None
+		self.handler_connected = False
+		self.motion = None
+		self.motion_history = []
+		self.motion_tick = None
+		self.area.connect("destroy", lambda w: self.set_tiled(False))
+		self.area.connect("size-allocate", self.on_allocate)
 	
 	def get_widget(self):
 		return self.scroll
@@ -368,16 +877,386 @@ class Canvas(ui.Canvas, Widget):
 		self.w = w
 		self.h = h
 		self.area.set_size_request(self.w, self.h)
+		self.records = {}
+		if self.tiles != None:
+			self.tiles.set_size(w, h)
+
+	def set_tiled(self, tiled, processes = None):
+		"""Enable or disable the tiled mode: the painter is run in
+		processes worker processes (default to the number of cores)
+		painting tiles that are displayed as soon as they are ready.
+		The painter must be picklable."""
+		if tiled and self.tiles == None:
+			self.tiles = paint.TileRenderer(self.painter,
+				self.queue_draw, processes)
+			self.tiles.set_size(*self.get_paint_size())
+		elif not tiled and self.tiles != None:
+			self.tiles.close()
+			self.tiles = None
+		self.queue_draw()
+
+	def set_retained(self, retained):
+		if retained == self.retained:
+			return
+		self.retained = retained
+		if retained:
+			for layer in self.painter.get_layers():
+				obs = LayerObserver(self, layer)
+				for var in self.painter.get_deps(layer):
+					var.add_observer(obs)
+					self.observers.append((var, obs))
+		else:
+			for (var, obs) in self.observers:
+				var.remove_observer(obs)
+			self.observers = []
+		self.invalidate()
+
+	def invalidate(self, layer = None):
+		if layer == None:
+			self.records = {}
+		else:
+			self.records.pop(layer, None)
+		if self.tiles != None:
+			self.tiles.invalidate()
+		self.queue_draw()
+
+	def get_paint_size(self):
+		"""Get the size of the painted area: the size set by set_size()
+		or, if none, the allocated size."""
+		w = self.w if self.w > 0 else self.area.get_allocated_width()
+		h = self.h if self.h > 0 else self.area.get_allocated_height()
+		return (w, h)
+
+	def on_allocate(self, widget, alloc):
+		self.records = {}
+		if self.tiles != None:
+			self.tiles.set_size(*self.get_paint_size())
+
+	def get_record_area(self):
+		"""Get the painter area recorded in retained mode: the whole
+		canvas or, with a transformation, its visible part."""
+		w, h = self.get_paint_size()
+		if self.transform == (1., 0., 0.):
+			return (0, 0, w, h)
+		zoom, ox, oy = self.transform
+		return (int(math.floor(ox)), int(math.floor(oy)),
+			int(math.ceil(self.area.get_allocated_width() / zoom)) + 1,
+			int(math.ceil(self.area.get_allocated_height() / zoom)) + 1)
+
+	def record_layer(self, layer):
+		"""Record the output of a layer in a recording surface. Return
+		the surface and the recorded area."""
+		x, y, w, h = self.get_record_area()
+		surface = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA,
+			cairo.Rectangle(0, 0, w, h))
+		port = DrawingPort()
+		port.cr = cairo.Context(surface)
+		port.cr.translate(-x, -y)
+		self.paint_layer(port, layer, x, y, w, h)
+		self.records[layer] = (surface, x, y)
+		return self.records[layer]
+
+	def paint_layer(self, port, layer, x, y, w, h):
+		"""Paint a layer of the painter."""
+		if trace.ENABLED:
+			trace.call("paint", "%s:%s" % (self.painter.__class__.__name__, layer),
+				self.painter.paint_layer, port, layer, x, y, w, h)
+		else:
+			self.painter.paint_layer(port, layer, x, y, w, h)
+
+	def paint_retained(self, cr, x, y, w, h):
+		"""Paint the layers, replaying the recorded ones."""
+		for layer in self.painter.get_layers():
+			if not self.painter.is_retained(layer):
+				self.paint_layer(self.port, layer, x, y, w, h)
+				continue
+			try:
+				surface, rx, ry = self.records[layer]
+			except KeyError:
+				surface, rx, ry = self.record_layer(layer)
+			cr.save()
+			cr.set_source_surface(surface, rx, ry)
+			cr.paint()
+			cr.restore()
+
+	def enable_stats(self, overlay = False):
+		if self.stats == None:
+			self.stats = ui.FrameStats()
+		self.overlay = overlay
+		if overlay and self.overlay_timer == None:
+			self.overlay_timer = GLib.timeout_add(OVERLAY_PERIOD, self.on_overlay_timeout)
+		self.queue_draw()
+
+	def disable_stats(self):
+		self.stats = None
+		self.overlay = False
+		self.queue_draw()
+
+	def get_stats(self):
+		return self.stats
+
+	def refresh(self):
+		self.queue_draw()
+
+	def set_transform(self, zoom, x = 0., y = 0.):
+		self.transform = (zoom, x, y)
+		self.records = {}
+		if self.tiles != None:
+			self.tiles.invalidate()
+		self.queue_draw()
+
+	def get_transform(self):
+		return self.transform
+
+	def set_handler(self, handler):
+		if not self.handler_connected and handler != None:
+			self.handler_connected = True
+			self.area.add_events(Gdk.EventMask.POINTER_MOTION_MASK
+				| Gdk.EventMask.BUTTON_PRESS_MASK | Gdk.EventMask.BUTTON_RELEASE_MASK
+				| Gdk.EventMask.SCROLL_MASK | Gdk.EventMask.SMOOTH_SCROLL_MASK
+				| Gdk.EventMask.KEY_PRESS_MASK | Gdk.EventMask.KEY_RELEASE_MASK)
+			self.area.set_can_focus(True)
+			self.area.connect("motion-notify-event", self.on_motion)
+			self.area.connect("button-press-event", self.on_button)
+			self.area.connect("button-release-event", self.on_button)
+			self.area.connect("scroll-event", self.on_scroll)
+			self.area.connect("key-press-event", self.on_key)
+			self.area.connect("key-release-event", self.on_key)
+			self.area.connect("realize", lambda w: self.set_compression())
+		self.handler = handler
+		self.motion = None
+		self.motion_history = []
+		self.set_compression()
+
+	def set_compression(self):
+		"""GDK compresses motion events by default: it is disabled
+		if the handler needs the full history."""
+		window = self.area.get_window()
+		if window != None:
+			window.set_event_compression(self.handler == None or not self.handler.history)
+
+	def on_motion_tick(self, widget, clock):
+		self.motion_tick = None
+		self.flush_motion()
+		return False
+
+	def flush_motion(self):
+		"""Deliver the pending motion events to the handler."""
+		if self.motion_tick != None:
+			self.area.remove_tick_callback(self.motion_tick)
+			self.motion_tick = None
+		if self.handler != None and self.motion != None:
+			if self.motion_history != []:
+				history = self.motion_history
+				self.motion_history = []
+				self.handler.on_motion_history(self, history)
+			x, y, mods = self.motion
+			self.motion = None
+			self.handler.on_motion(self, x, y, mods)
+
+	def on_motion(self, widget, event):
+		if self.handler == None:
+			return False
+		self.motion = (event.x, event.y, get_mods(event.state))
+		if self.handler.history:
+			self.motion_history.append((event.x, event.y, event.time))
+		if self.motion_tick == None:
+			self.motion_tick = self.area.add_tick_callback(self.on_motion_tick)
+		return True
+
+	def on_button(self, widget, event):
+		if self.handler == None or event.type not in (Gdk.EventType.BUTTON_PRESS, Gdk.EventType.BUTTON_RELEASE):
+			return False
+		self.flush_motion()
+		if event.type == Gdk.EventType.BUTTON_PRESS:
+			self.area.grab_focus()
+			self.handler.on_press(self, event.button, event.x, event.y, get_mods(event.state))
+		else:
+			self.handler.on_release(self, event.button, event.x, event.y, get_mods(event.state))
+		return True
+
+	def on_scroll(self, widget, event):
+		if self.handler == None:
+			return False
+		self.flush_motion()
+		if event.direction == Gdk.ScrollDirection.SMOOTH:
+			_, dx, dy = event.get_scroll_deltas()
+		else:
+			dx, dy = SCROLL_MAP[event.direction]
+		self.handler.on_scroll(self, dx, dy, event.x, event.y, get_mods(event.state))
+		return True
+
+	def on_key(self, widget, event):
+		if self.handler == None:
+			return False
+		self.flush_motion()
+		return self.handler.on_key(self, Gdk.keyval_name(event.keyval),
+			event.type == Gdk.EventType.KEY_PRESS, get_mods(event.state))
+
+	def add_ticker(self, fun):
+		return self.area.add_tick_callback(
+			lambda w, clock: fun(clock.get_frame_time() / 1e6) or True)
+
+	def remove_ticker(self, id):
+		self.area.remove_tick_callback(id)
 
 	def do_draw(self, w, cr):
 		(todo, rect) = Gdk.cairo_get_clip_rectangle(cr)
 		if not todo:
 			return
 		self.port.cr = cr
-		self.painter.paint(self.port, rect.x, rect.y, rect.width, rect.height)
-
+		if self.stats != None:
+			start = time.perf_counter()
+		if self.tiles != None:
+			self.tiles.paint(cr, rect.x, rect.y, rect.width, rect.height)
+		else:
+			zoom, ox, oy = self.transform
+			x, y, w, h = rect.x, rect.y, rect.width, rect.height
+			if self.transform != (1., 0., 0.):
+				cr.save()
+				cr.scale(zoom, zoom)
+				cr.translate(-ox, -oy)
+				x, y = int(math.floor(ox + x / zoom)), int(math.floor(oy + y / zoom))
+				w, h = int(math.ceil(w / zoom)) + 1, int(math.ceil(h / zoom)) + 1
+			if self.retained:
+				self.paint_retained(cr, x, y, w, h)
+			elif trace.ENABLED:
+				trace.call("paint", self.painter.__class__.__name__, self.painter.paint,
+					self.port, x, y, w, h)
+			else:
+				self.painter.paint(self.port, x, y, w, h)
+			if self.transform != (1., 0., 0.):
+				cr.restore()
+		if self.stats != None:
+			# redraws of the overlay alone are not frames of the painter
+			if not (self.overlay_only and self.in_overlay(rect)):
+				self.record_frame(start, time.perf_counter() - start, rect)
+			self.overlay_only = False
+			if self.overlay:
+				self.paint_overlay(cr)
+		self.port.cr = None
+
+	def record_frame(self, start, duration, rect):
+		"""Record the statistics of a frame. Dropped frames are counted
+		against the frame clock: a redraw queued by the canvas is
+		expected to be painted by the next frame, each refresh interval
+		elapsed in between is counted as dropped."""
+		self.stats.add_frame(start, duration,
+			(rect.x, rect.y, rect.width, rect.height),
+			self.painter.__class__.__name__)
+		queued = self.queued
+		self.queued = None
+		clock = self.area.get_frame_clock()
+		if clock == None or queued == None:
+			return
+		now = clock.get_frame_time()
+		interval = clock.get_refresh_info(now)[0]
+		if interval > 0:
+			n = (now - queued) // interval
+			if n > 0:
+				self.stats.add_dropped(n)
+
+	def queue_draw(self, x = None, y = None, w = None, h = None):
+		"""Queue the redraw of the canvas or of the area (x, y, w, h),
+		remembering the date of the first pending redraw to count
+		dropped frames."""
+		if self.stats != None and self.queued == None:
+			self.queued = GLib.get_monotonic_time()
+		if x == None:
+			self.area.queue_draw()
+		else:
+			self.area.queue_draw_area(x, y, w, h)
+
+	def paint_overlay(self, cr):
+		"""Paint the statistics over the visible part of the canvas."""
+		mean, max = self.stats.get_paint_time()
+		lines = [
+			"%.1f fps  %d dropped" % (self.stats.get_fps(), self.stats.dropped),
+			"paint %.2f ms (mean %.2f, max %.2f)" % (self.stats.get_last() * 1e3, mean * 1e3, max * 1e3),
+			"clip %d,%d %dx%d" % self.stats.clip
+		]
+		painters = self.stats.get_painters()
+		if painters != []:
+			lines.append("%s: %.1f ms" % (painters[0][0], painters[0][2] * 1e3))
+		x = self.scroll.get_hadjustment().get_value()
+		y = self.scroll.get_vadjustment().get_value()
+		cr.save()
+		cr.reset_clip()
+		cr.set_source_rgba(0, 0, 0, .6)
+		cr.rectangle(x, y, 260, 14 * len(lines) + 8)
+		cr.fill()
+		cr.set_source_rgb(1, 1, 1)
+		cr.select_font_face("monospace")
+		cr.set_font_size(11)
+		for i, line in enumerate(lines):
+			cr.move_to(x + 4, y + 14 * (i + 1))
+			cr.show_text(line)
+		cr.restore()
+		self.overlay_rect = (int(x), int(y), 260, 14 * len(lines) + 8)
+
+	def in_overlay(self, rect):
+		"""Test if the given clip rectangle is inside the overlay."""
+		x, y, w, h = self.overlay_rect
+		return x <= rect.x and y <= rect.y \
+			and rect.x + rect.width <= x + w and rect.y + rect.height <= y + h
+
+	def on_overlay_timeout(self):
+		if not self.overlay:
+			self.overlay_timer = None
+			return False
+		x, y, w, h = self.overlay_rect
+		self.overlay_only = True
+		self.area.queue_draw_area(x, y, w, h)
+		return True
+
+
+class MessagePanel(Widget, base.MessageObserver):
+	"""Non-modal panel displaying the messages of a message store.
+	The panel is refreshed at most MESSAGE_RATE times per second
+	whatever the number of received messages."""
+
+	def __init__(self, store):
+		self.store = store
+		self.model = Gtk.ListStore(str, str, str)
+		self.view = Gtk.TreeView(model = self.model, headers_visible = False)
+		self.view.append_column(Gtk.TreeViewColumn("", Gtk.CellRendererPixbuf(), icon_name = 0))
+		self.view.append_column(Gtk.TreeViewColumn("", Gtk.CellRendererText(), text = 1))
+		self.view.append_column(Gtk.TreeViewColumn("", Gtk.CellRendererText(), text = 2))
+		scroll = Gtk.ScrolledWindow(None, None)
+		scroll.set_min_content_height(80)
+		scroll.add(self.view)
+		self.expander = Gtk.Expander(label = "Messages")
+		self.expander.add(scroll)
+		self.timer = None
+		self.last = 0.
+		store.add_observer(self)
 
-class ActionButton(view.Observer):
+	def get_widget(self):
+		return self.expander
+
+	def on_message(self, store, msg):
+		if self.timer == None:
+			wait = max(self.last + 1. / MESSAGE_RATE - time.monotonic(), 0)
+			self.timer = GLib.timeout_add(int(wait * 1000), self.refresh)
+
+	def refresh(self):
+		"""Rebuild the displayed list from the store."""
+		self.timer = None
+		self.last = time.monotonic()
+		self.model.clear()
+		msgs = self.store.get_messages()
+		for msg in reversed(msgs):
+			self.model.append([
+				MESSAGE_ICON_MAP[msg.level],
+				"" if msg.count == 1 else "\u00d7%d" % msg.count,
+				msg.text])
+		self.expander.set_label("Messages (%d)" % len(msgs))
+		if msgs != [] and msgs[-1].level >= base.WARNING:
+			self.expander.set_expanded(True)
+		return False
+
+
+class ActionButton(view.Observer, base.ActionObserver):
 
 	def __init__(self, action, view):
 		self.action = action
@@ -400,6 +1279,7 @@ class ActionButton(view.Observer):
 				if image != None:
 					self.button.set_image(image)
 			self.button.connect("clicked", self.on_click)
+			self.action.add_observer(self)
 			self.on_update(None)
 		return self.button
 
@@ -408,13 +1288,16 @@ class ActionButton(view.Observer):
 		self.on_update(None)
 
 	def on_hide(self, view):
-		self.ignore(self)
+		self.action.ignore(self)
 
 	def on_update(self, var):
 		self.button.set_sensitive(self.action.check())
 
+	def on_check(self, action):
+		self.on_update(None)
+
 	def on_click(self, button):
-		self.action.apply(self.frame.get_context(self.action))
+		self.action.apply(self.frame)
 
 	
 def build_view(frame, box, _view):
@@ -434,6 +1317,13 @@ class Frame(ui.Frame, base.Monitor):
 		self.title = app.get_label()
 		self.menu = []
 		self.view = view
+		self.dialogs = collections.OrderedDict()
+		self.job_box = None
+		self.jobs = {}
+		self.messages = base.MessageStore()
+		self.modal_level = base.ERROR
+		self.modal = None
+		self.modal_more = 0
 
 	def set_title(self, title):
 		self.title = title
@@ -447,7 +1337,7 @@ class Frame(ui.Frame, base.Monitor):
 
 		# build the GTK window
 		self.win = Gtk.Window()
-		self.win.connect("destroy", self.driver.quit)
+		self.win.connect("destroy", self.on_destroy)
 		self.win.set_title(self.title)
 		self.win.set_resizable(True)
 		box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
@@ -460,9 +1350,18 @@ class Frame(ui.Frame, base.Monitor):
 		# set the main content
 		if self.view != None:
 			build_view(self, box, self.view)
+
+		# add the job area and the message panel
+		self.job_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+		box.pack_end(self.job_box, False, False, 0)
+		box.pack_end(MessagePanel(self.messages).get_widget(), False, False, 0)
 		self.win.add(box)
 		box.show_all()
 		
+	def on_destroy(self, win):
+		self.clear_dialogs()
+		self.driver.quit(self)
+
 	def open(self):
 		if self.win == None:
 			self.init()
@@ -474,41 +1373,83 @@ class Frame(ui.Frame, base.Monitor):
 		self.win.hide()
 		if self.view != None:
 			self.view.hide()
-
-	def info(self, msg):
-		dialog = Gtk.MessageDialog(
+		self.clear_dialogs()
+
+	def message(self, level, msg):
+		"""Display a message of the given level. The message is recorded
+		in the message panel and, if its level is at least modal_level,
+		displayed in a modal dialog. Only one such dialog is open at
+		a time: the messages received meanwhile are only counted in it."""
+		self.messages.add(level, msg)
+		if level < self.modal_level and self.win != None:
+			return
+		if self.modal != None:
+			self.modal_more = self.modal_more + 1
+			self.modal.format_secondary_text(
+				"%d more message(s) in the message panel." % self.modal_more)
+			return
+		self.modal = Gtk.MessageDialog(
+				transient_for=self.win,
 				text=msg,
-				message_type=Gtk.MessageType.INFO,
+				message_type=MESSAGE_TYPE_MAP[level],
 				buttons=Gtk.ButtonsType.CLOSE
 			)
-		dialog.run()
-		dialog.hide()
+		self.modal_more = 0
+		try:
+			self.modal.run()
+		finally:
+			self.modal.destroy()
+			self.modal = None
+
+	def set_modal_level(self, level):
+		"""Set the minimal level of messages displayed in a modal
+		dialog."""
+		self.modal_level = level
+
+	def info(self, msg):
+		self.message(base.INFO, msg)
 
 	def warn(self, msg):
-		dialog = Gtk.MessageDialog(
-				text=msg,
-				message_type=Gtk.MessageType.WARNING,
-				buttons=Gtk.ButtonsType.CLOSE
-			)
-		dialog.run()
-		dialog.hide()
+		self.message(base.WARNING, msg)
 
 	def error(self, msg):
-		dialog = Gtk.MessageDialog(
-				text=msg,
-				message_type=Gtk.MessageType.ERROR,
-				buttons=Gtk.ButtonsType.CLOSE
-			)
-		dialog.run()
-		dialog.hide()
+		self.message(base.ERROR, msg)
 
-	def start_job(self, name, help="", icon=""):
-		# TODO
-		pass
+	def start_job(self, name, help="", icon="", cancel=None, job=None):
+		if self.win == None:
+			return
+		box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=8)
+		label = Gtk.Label(name)
+		if help != "":
+			label.set_tooltip_text(help)
+		box.pack_start(label, False, False, 0)
+		bar = Gtk.ProgressBar()
+		bar.set_valign(Gtk.Align.CENTER)
+		box.pack_start(bar, True, True, 0)
+		if cancel != None:
+			button = Gtk.Button.new_from_stock(Gtk.STOCK_CANCEL)
+			button.connect("clicked", lambda b: (b.set_sensitive(False), cancel()))
+			box.pack_start(button, False, False, 0)
+		self.job_box.pack_start(box, False, False, 0)
+		box.show_all()
+		self.jobs.setdefault(name if job == None else job, []).append((box, bar))
 
-	def end_job(self, name):
-		# TODO
-		pass
+	def end_job(self, name, job=None):
+		key = name if job == None else job
+		try:
+			box, bar = self.jobs[key].pop()
+			if self.jobs[key] == []:
+				del self.jobs[key]
+			box.destroy()
+		except KeyError:
+			pass
+
+	def set_progress(self, name, ratio, job=None):
+		try:
+			box, bar = self.jobs[name if job == None else job][-1]
+			bar.set_fraction(ratio)
+		except KeyError:
+			pass
 	
 	def ask_yesno(self, question, deflt=False, help = "", icon=""):
 		dialog = Gtk.MessageDialog(
@@ -524,31 +1465,58 @@ class Frame(ui.Frame, base.Monitor):
 		pass
 
 	def ask_dialog(self, title="", vars=[], help=""):
-		"""Open a dialog and ask the user to enter the given variables."""
+		"""Open a dialog and ask the user to enter the given variables.
+		The variables are edited in place and restored from a snapshot
+		if the dialog is cancelled. Built dialogs are cached by title
+		and variables to be reused by the next calls."""
 		
+		# get the dialog
+		key = (title, tuple(vars))
+		try:
+			dialog, form = self.dialogs.pop(key)
+			form.refresh()
+		except KeyError:
+			form = make_form(vars, self)
+			dialog = Gtk.Dialog(
+				title,
+				self.win,
+				Gtk.DialogFlags.MODAL,
+				buttons = [Gtk.STOCK_OK, Gtk.ResponseType.OK, Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL])
+			dialog.get_content_area().pack_start(form.get_widget(), True, True, 0)
+			if len(self.dialogs) >= DIALOG_CACHE_SIZE:
+				old, _ = self.dialogs.popitem(last = False)[1]
+				old.destroy()
+		self.dialogs[key] = (dialog, form)
+
 		# save current values
-		avars = []
-		for v in vars:
-			avars.append(v.copy())
+		snaps = [v.snapshot() for v in vars]
+		journal = base.get_journal()
+		if journal != None:
+			journal.begin(title)
 		
 		# manage the dialog
-		form = build_form(avars, self)
-		dialog = Gtk.Dialog(
-			title,
-			self.win,
-			Gtk.DialogFlags.MODAL,
-			buttons = [Gtk.STOCK_OK, Gtk.ResponseType.OK, Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL])
-		dialog.get_content_area().pack_start(form, True, True, 0)
-		res = dialog.run()
-		dialog.hide()
+		res = Gtk.ResponseType.CANCEL
+		try:
+			res = dialog.run()
+			dialog.hide()
+			form.flush(res == Gtk.ResponseType.OK)
 		
-		# if cancelled, reset the variables
-		if res != Gtk.ResponseType.OK:
-			return False
-		else:
-			for i in range(0, len(vars)):
-				vars[i].set(avars[i].get())
-			return True
+			# if cancelled, reset the variables
+			if res != Gtk.ResponseType.OK:
+				for i in range(0, len(vars)):
+					vars[i].restore(snaps[i])
+		finally:
+			if journal != None and res == Gtk.ResponseType.OK:
+				journal.end()
+			elif journal != None:
+				journal.cancel()
+		return res == Gtk.ResponseType.OK
+
+	def clear_dialogs(self):
+		"""Destroy the cached dialogs."""
+		for dialog, form in self.dialogs.values():
+			dialog.destroy()
+		self.dialogs.clear()
 
 	def make_image(self, path):
 		"""Obtain an image from the given path."""
@@ -563,6 +1531,221 @@ class Frame(ui.Frame, base.Monitor):
 		self.content = widget
 
 
+READ_CONDITION = GLib.IOCondition.IN | GLib.IOCondition.HUP | GLib.IOCondition.ERR
+WRITE_CONDITION = GLib.IOCondition.OUT | GLib.IOCondition.ERR
+
+class GLibSelector(selectors.BaseSelector):
+	"""Selector waiting for file events inside the GLib main context.
+	Used by an asyncio event loop, GLib sources (and therefore GTK events)
+	are dispatched while the loop waits, without any polling."""
+
+	def __init__(self):
+		self.keys = {}
+		self.sources = {}
+		self.ready = {}
+		self.timer = None
+		self.context = GLib.MainContext.default()
+
+	def fd_of(self, fileobj):
+		if isinstance(fileobj, int):
+			return fileobj
+		else:
+			return fileobj.fileno()
+
+	def register(self, fileobj, events, data = None):
+		fd = self.fd_of(fileobj)
+		if fd in self.keys:
+			raise KeyError("%s is already registered" % fileobj)
+		key = selectors.SelectorKey(fileobj, fd, events, data)
+		cond = 0
+		if events & selectors.EVENT_READ:
+			cond = cond | READ_CONDITION
+		if events & selectors.EVENT_WRITE:
+			cond = cond | WRITE_CONDITION
+		self.keys[fd] = key
+		self.sources[fd] = GLib.unix_fd_add_full(GLib.PRIORITY_DEFAULT,
+			fd, cond, self.on_fd)
+		return key
+
+	def unregister(self, fileobj):
+		fd = self.fd_of(fileobj)
+		key = self.keys.pop(fd)
+		GLib.source_remove(self.sources.pop(fd))
+		self.ready.pop(fd, None)
+		return key
+
+	def get_key(self, fileobj):
+		try:
+			return self.keys[self.fd_of(fileobj)]
+		except KeyError:
+			raise KeyError("%s is not registered" % fileobj) from None
+
+	def get_map(self):
+		return self.keys
+
+	def on_fd(self, fd, cond):
+		events = 0
+		if cond & READ_CONDITION:
+			events = events | selectors.EVENT_READ
+		if cond & WRITE_CONDITION:
+			events = events | selectors.EVENT_WRITE
+		self.ready[fd] = self.ready.get(fd, 0) | (events & self.keys[fd].events)
+		return True
+
+	def on_timeout(self):
+		self.timer = None
+		return False
+
+	def select(self, timeout = None):
+		if self.ready == {}:
+			if timeout == None:
+				self.context.iteration(True)
+			elif timeout <= 0:
+				self.context.iteration(False)
+			else:
+				self.timer = GLib.timeout_add(int(math.ceil(timeout * 1000)), self.on_timeout)
+				self.context.iteration(True)
+				if self.timer != None:
+					GLib.source_remove(self.timer)
+					self.timer = None
+		res = [(self.keys[fd], events) for (fd, events) in self.ready.items() if events != 0]
+		self.ready = {}
+		return res
+
+	def close(self):
+		for source in self.sources.values():
+			GLib.source_remove(source)
+		self.sources = {}
+		self.keys = {}
+		self.ready = {}
+
+
+class GLibEventLoop(asyncio.SelectorEventLoop):
+	"""asyncio event loop running on the GLib main context: coroutines
+	and GTK callbacks run in the same thread."""
+
+	def __init__(self):
+		asyncio.SelectorEventLoop.__init__(self, GLibSelector())
+
+
+def call_idle(fun, *args):
+	"""Call a function from the GTK main loop."""
+	def call():
+		fun(*args)
+		return False
+	GLib.idle_add(call)
+
+
+# number of icons per row of an atlas
+ATLAS_COLUMNS = 16
+
+# default sizes of precomputed atlases
+ATLAS_SIZES = (ui.MENU_ICON_SIZE, ui.BUTTON_ICON_SIZE)
+
+
+class IconAtlas:
+	"""Atlas packing the icons of a size and a scale factor into one
+	surface, on shelves, as they are added. Icons added after the surface
+	is built are blitted into it on the next use (the surface is
+	reallocated only if it has to grow). An atlas may be saved into
+	and reloaded from a cache directory."""
+
+	def __init__(self, driver, size, scale = 1):
+		self.driver = driver
+		self.size = size
+		self.scale = scale
+		self.px = Gtk.icon_size_lookup(ICON_SIZE_MAP[size])[1] * scale
+		self.width = self.px * ATLAS_COLUMNS
+		self.height = 0
+		self.shelf = (0, 0, 0)
+		self.rects = {}
+		self.pixbufs = {}
+		self.missing = set()
+		self.surface = None
+
+	def place(self, w, h):
+		"""Find room for a rectangle of size (w, h)."""
+		x, y, sh = self.shelf
+		if x + w > self.width:
+			x, y, sh = 0, y + sh, 0
+		self.shelf = (x + w, y, max(sh, h))
+		self.height = max(self.height, y + h)
+		return (x, y, w, h)
+
+	def add(self, name, con = None):
+		"""Add an icon to the atlas. Return False if it cannot be
+		found."""
+		if name in self.rects:
+			return True
+		if name in self.missing:
+			return False
+		pixbuf = self.driver.load_pixbuf(name, con, self.px, self.scale)
+		if pixbuf == None:
+			self.missing.add(name)
+			return False
+		self.rects[name] = self.place(pixbuf.get_width(), pixbuf.get_height())
+		self.pixbufs[name] = pixbuf
+		return True
+
+	def get_surface(self):
+		"""Get the surface of the atlas, blitting the icons added since
+		the last call."""
+		if self.pixbufs:
+			if self.surface == None or self.surface.get_height() < self.height:
+				surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.width, self.height)
+				cr = cairo.Context(surface)
+				if self.surface != None:
+					cr.set_source_surface(self.surface, 0, 0)
+					cr.paint()
+				self.surface = surface
+			else:
+				cr = cairo.Context(self.surface)
+			for (name, pixbuf) in self.pixbufs.items():
+				x, y, w, h = self.rects[name]
+				Gdk.cairo_set_source_pixbuf(cr, pixbuf, x, y)
+				cr.rectangle(x, y, w, h)
+				cr.fill()
+			self.surface.flush()
+			self.pixbufs = {}
+		return self.surface
+
+	def get_image(self, name, con = None):
+		"""Get the icon as a paint.SubImage of the atlas, or None."""
+		if not self.add(name, con):
+			return None
+		x, y, w, h = self.rects[name]
+		return paint.SubImage(self.get_surface(), x, y, w, h, self.scale)
+
+	def save(self, path):
+		"""Save the atlas as path.png and path.json."""
+		surface = self.get_surface()
+		if surface == None:
+			return
+		os.makedirs(os.path.dirname(path), exist_ok = True)
+		surface.write_to_png(path + ".png")
+		with open(path + ".json", "w") as out:
+			json.dump({
+				"height": self.height,
+				"shelf": self.shelf,
+				"icons": [[name] + list(r) for (name, r) in self.rects.items()]
+			}, out)
+
+	def load(self, path):
+		"""Load the atlas saved in path. Return True for success."""
+		try:
+			with open(path + ".json") as input:
+				desc = json.load(input)
+			surface = cairo.ImageSurface.create_from_png(path + ".png")
+		except (OSError, ValueError, cairo.Error):
+			return False
+		self.surface = surface
+		self.height = desc["height"]
+		self.shelf = tuple(desc["shelf"])
+		self.rects = {i[0]: tuple(i[1:]) for i in desc["icons"]}
+		self.pixbufs = {}
+		return True
+
+
 class Driver(ui.Driver):
 	"""UI interface for GTK implementation."""
 	
@@ -570,51 +1753,151 @@ class Driver(ui.Driver):
 		ui.Driver.__init__(self)
 		self.quit_action = \
 			base.Action(self.quit, label="Quit", icon=ui.QUIT_ICON, help="Leave the application.")
-		self.icons = {
-			ui.QUIT_ICON: Gtk.STOCK_QUIT
-		}
+		self.atlases = {}
+		self.scale = None
 		self.image_paths = [os.path.dirname(inspect.getmodule(self).__file__)]
+		self.loop = None
 
 	def open(self, app, pane = None, **args):
 		return Frame(app, self, pane, **args)
 	
+	def get_loop(self):
+		"""Get the asyncio loop of the driver, running on the GLib
+		main context."""
+		if self.loop == None:
+			self.loop = GLibEventLoop()
+			asyncio.set_event_loop(self.loop)
+		return self.loop
+
 	def run(self):
-		Gtk.main()
+		"""Run the GTK main loop as an asyncio loop: coroutines may be
+		used in actions or spawned with base.spawn(). While the loop
+		runs, calls from other threads go through the GLib idle
+		queue."""
+		base.set_ui_caller(call_idle)
+		try:
+			self.get_loop().run_forever()
+		finally:
+			base.set_ui_caller(base.call_now)
 
 	def quit(self, con):
-		Gtk.main_quit()
+		if self.loop != None and self.loop.is_running():
+			self.loop.stop()
+		else:
+			Gtk.main_quit()
+
+	def get_scale(self):
+		"""Get the scale factor of the display (2 for HiDPI)."""
+		if self.scale == None:
+			display = Gdk.Display.get_default()
+			if display != None and display.get_n_monitors() > 0:
+				self.scale = display.get_monitor(0).get_scale_factor()
+			else:
+				self.scale = 1
+		return self.scale
+
+	def get_atlas(self, size = None, scale = None):
+		"""Get the icon atlas for the given size and scale factor
+		(default to the display scale factor)."""
+		if size == None:
+			size = ui.BUTTON_ICON_SIZE
+		if scale == None:
+			scale = self.get_scale()
+		try:
+			return self.atlases[(size, scale)]
+		except KeyError:
+			atlas = IconAtlas(self, size, scale)
+			self.atlases[(size, scale)] = atlas
+			return atlas
 
 	def get_icon(self, name, con = None, size = None):
+		image = self.get_icon_image(name, con, size)
+		if image == None:
+			return None
+		return Gtk.Image.new_from_surface(image.extract())
+
+	def get_icon_image(self, name, con = None, size = None, scale = None):
+		"""Get an icon as a sub-image of its atlas, to be drawn on
+		a canvas with draw_image(). Return None if it cannot be found."""
+		atlas = self.get_atlas(size, scale)
+		if trace.ENABLED and name not in atlas.rects:
+			return trace.call("icon", str(name), atlas.get_image, name, con)
+		return atlas.get_image(name, con)
+
+	def prepare_icons(self, names, con = None, sizes = ATLAS_SIZES, scales = None, cache = True):
+		"""Precompute the atlases of the given icons for the given sizes
+		and scale factors (default to the display one). If cache is True,
+		atlases are reloaded from the user cache directory while their
+		icons and source files are unchanged, else they are built
+		and saved there."""
+		if scales == None:
+			scales = [self.get_scale()]
+		for size in sizes:
+			for scale in scales:
+				atlas = self.get_atlas(size, scale)
+				path = None
+				if cache:
+					path = os.path.join(GLib.get_user_cache_dir(), "elfkit",
+						"atlas-%s" % self.get_atlas_key(names, con, atlas))
+					if not atlas.rects and atlas.load(path):
+						continue
+				for name in names:
+					atlas.add(name, con)
+				if path != None:
+					atlas.save(path)
+
+	def get_atlas_key(self, names, con, atlas):
+		"""Compute a key identifying the content of an atlas."""
+		key = [atlas.size, atlas.scale, atlas.px]
+		for name in names:
+			path = self.find_icon(name, con)
+			key.append((name, path, os.path.getmtime(path) if path != None else 0))
+		return hashlib.sha1(repr(key).encode()).hexdigest()
+
+	def find_icon(self, name, con):
+		"""Find the file of an icon. Return None for stock and
+		theme icons or if it is not found."""
+		if isinstance(name, int):
+			return None
+		elif name.startswith("local:"):
+			if con != None:
+				path = os.path.join(con.get_path(), name[6:])
+				if os.path.exists(path):
+					return path
+		else:
+			for p in self.image_paths:
+				path = os.path.join(p, name)
+				if os.path.exists(path):
+					return path
+		return None
+
+	def load_pixbuf(self, name, con, px, scale):
+		"""Load an icon as a pixbuf of px pixels (scale factor included).
+		Return None if it cannot be found."""
 		try:
-			return self.icons[(name, size)]
-		except KeyError:
-			image = None
 
 			# stock icon
 			if isinstance(name, int):
-				try:
-					image = Gtk.Image.new_from_stock(STOCK_MAP[name], ICON_SIZE_MAP[size])
-				except KeyError:
-					pass
-
-			# local icon
-			elif name.startswith("local:"):
-				if con != None:
-					path = os.path.join(con.get_path(), name[6:])
-					image = Gtk.Image.new_from_file(path)
-
-			# global icon
-			else:
-				for p in self.image_paths:
-					path = os.path.join(p, name)
-					if os.path.exists(p):
-						image = Gtk.Image.new_from_file(path)
-						break
-
-			# record it
-			if image != None:
-				self.icons[(name, size)] = image
-			return image
+				if name not in STOCK_MAP:
+					return None
+				pixbuf = Gtk.Invisible().render_icon_pixbuf(STOCK_MAP[name], Gtk.IconSize.DIALOG)
+				if pixbuf != None and pixbuf.get_width() != px:
+					pixbuf = pixbuf.scale_simple(px, px, GdkPixbuf.InterpType.BILINEAR)
+				return pixbuf
+
+			# file icon
+			path = self.find_icon(name, con)
+			if path != None:
+				return GdkPixbuf.Pixbuf.new_from_file_at_scale(path, px, px, True)
+
+			# theme icon
+			if not name.startswith("local:"):
+				return Gtk.IconTheme.get_default().load_icon_for_scale(name,
+					px // scale, scale, Gtk.IconLookupFlags.FORCE_SIZE)
+
+		except GLib.Error:
+			pass
+		return None
 
 	def get_console(self):
 		return self
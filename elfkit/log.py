@@ -0,0 +1,175 @@
+#
+#	ElfKit structured log monitor.
+#	Copyright (C) 2019  Hugues Casse <hug.casse@gmail.com>
+#
+#	This file is part of ElfKit.
+#
+#	ElfKit is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	ElfKit is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with ElfKit.  If not, see <https://www.gnu.org/licenses/>.
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+
+"""Monitor writing structured records for headless and batch runs.
+Records are written as JSON Lines by a background thread so that
+logging costs little to the code doing the work."""
+
+import json
+import queue
+import sys
+import threading
+import time
+
+from elfkit import base
+
+# backpressure policies
+BLOCK = 0
+DROP_NEW = 1
+DROP_OLD = 2
+
+LEVEL_NAMES = {
+	base.INFO: "info",
+	base.WARNING: "warning",
+	base.ERROR: "error"
+}
+
+STOP = None
+
+
+class LogMonitor(base.Monitor):
+	"""Monitor writing one JSON object per line to out (default to
+	standard error). Records are queued and written in batches of at
+	most batch records by a writer thread. When the queue of size
+	records is full, policy decides whether the caller blocks (BLOCK),
+	the new record is dropped (DROP_NEW) or the oldest queued record
+	is dropped (DROP_OLD); dropped records are counted and reported
+	by a "dropped" record.
+
+	Records have the fields "time", "event" ("message", "start", "end"
+	or "dropped") and "job", the path of the current jobs separated
+	by "/". Messages also have "level" and "msg", end of jobs has
+	"elapsed" in seconds."""
+
+	def __init__(self, out = None, size = 10000, batch = 256, policy = BLOCK):
+		self.out = sys.stderr if out == None else out
+		self.batch = batch
+		self.policy = policy
+		self.queue = queue.Queue(size)
+		self.jobs = []
+		self.lock = threading.Lock()
+		self.dropped = 0
+		self.thread = threading.Thread(target = self.write, daemon = True)
+		self.thread.start()
+
+	def post(self, rec):
+		"""Queue a record according to the backpressure policy."""
+		if self.policy == BLOCK:
+			self.queue.put(rec)
+			return
+		while True:
+			try:
+				self.queue.put_nowait(rec)
+				return
+			except queue.Full:
+				with self.lock:
+					self.dropped = self.dropped + 1
+				if self.policy == DROP_NEW:
+					return
+				try:
+					self.queue.get_nowait()
+					self.queue.task_done()
+				except queue.Empty:
+					pass
+
+	def get_job(self):
+		"""Get the path of the current jobs."""
+		with self.lock:
+			return "/".join([name for (name, start) in self.jobs])
+
+	def message(self, level, msg):
+		self.post({"time": time.time(), "event": "message",
+			"level": LEVEL_NAMES[level], "job": self.get_job(), "msg": str(msg)})
+
+	def info(self, msg):
+		self.message(base.INFO, msg)
+
+	def warn(self, msg):
+		self.message(base.WARNING, msg)
+
+	def error(self, msg):
+		self.message(base.ERROR, msg)
+
+	def start_job(self, name, help="", icon="", cancel=None, job=None):
+		with self.lock:
+			self.jobs.append((name, time.monotonic()))
+			job = "/".join([n for (n, s) in self.jobs])
+		self.post({"time": time.time(), "event": "start", "job": job})
+
+	def end_job(self, name, job=None):
+		with self.lock:
+			job = "/".join([n for (n, s) in self.jobs])
+			for i in range(len(self.jobs) - 1, -1, -1):
+				if self.jobs[i][0] == name:
+					start = self.jobs.pop(i)[1]
+					break
+			else:
+				return
+		self.post({"time": time.time(), "event": "end", "job": job,
+			"elapsed": time.monotonic() - start})
+
+	def write(self):
+		"""Body of the writer thread."""
+		stop = False
+		while not stop:
+			recs = [self.queue.get()]
+			while len(recs) < self.batch:
+				try:
+					recs.append(self.queue.get_nowait())
+				except queue.Empty:
+					break
+			with self.lock:
+				dropped = self.dropped
+				self.dropped = 0
+			lines = []
+			if dropped != 0:
+				lines.append(json.dumps({"time": time.time(), "event": "dropped", "count": dropped}))
+			for rec in recs:
+				if rec is STOP:
+					stop = True
+				else:
+					lines.append(json.dumps(rec))
+			if lines != []:
+				self.out.write("\n".join(lines) + "\n")
+				self.out.flush()
+			for rec in recs:
+				self.queue.task_done()
+
+	def flush(self):
+		"""Wait for all queued records to be written."""
+		self.queue.join()
+
+	def close(self):
+		"""Write the queued records and stop the writer thread."""
+		self.queue.put(STOP)
+		self.thread.join()
@@ -0,0 +1,657 @@
+#
+#	ElfKit cairo painting.
+#	Copyright (C) 2019  Hugues Casse <hug.casse@gmail.com>
+#
+#	This file is part of ElfKit.
+#
+#	ElfKit is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	ElfKit is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with ElfKit.  If not, see <https://www.gnu.org/licenses/>.
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+
+"""Painting facilities based on cairo, independent of any UI toolkit:
+a drawing area working on any cairo context, a cache of text layouts,
+a renderer painting tiles in parallel worker processes and mipmapped
+pyramids of big images."""
+
+import collections
+import math
+import multiprocessing
+from multiprocessing import shared_memory
+
+import cairo
+try:
+	import gi
+	gi.require_version('Pango', '1.0')
+	gi.require_version('PangoCairo', '1.0')
+	from gi.repository import Pango
+	from gi.repository import PangoCairo
+except (ImportError, ValueError):
+	Pango = None
+
+from elfkit import base
+from elfkit import ui
+
+# size of tiles painted by worker processes
+TILE_SIZE = 256
+
+# default font of texts
+DEFAULT_FONT = "Sans 10"
+
+# number of shaped text layouts kept in the cache
+TEXT_CACHE_SIZE = 1024
+
+# number of rasterized texts kept in the cache
+RUN_CACHE_SIZE = 256
+
+# number of uses of a text before it is rasterized
+HOT_TEXT = 4
+
+
+class TextLayout:
+	"""A shaped text with its logical size (w, h) and its ink
+	rectangle (ix, iy, iw, ih) relative to the top-left corner."""
+
+	def __init__(self, layout, w, h, ink):
+		self.layout = layout
+		self.w = w
+		self.h = h
+		self.ink = ink
+		self.uses = 0
+
+
+class TextCache:
+	"""Cache of shaped text layouts, keyed by (text, font, width, align)
+	and evicted in LRU order. Texts drawn often, like axis ticks, are
+	also rasterized once as an alpha mask (a run) that is then blitted
+	in any color while the cairo transformation is a translation and
+	the target has no device scale (HiDPI).
+	Without Pango, the cairo toy text API is used and texts are neither
+	wrapped nor aligned."""
+
+	def __init__(self, size = TEXT_CACHE_SIZE, run_size = RUN_CACHE_SIZE, hot = HOT_TEXT):
+		self.size = size
+		self.run_size = run_size
+		self.hot = hot
+		self.layouts = collections.OrderedDict()
+		self.runs = collections.OrderedDict()
+		self.fonts = {}
+		self.context = None
+
+	def get_context(self):
+		"""Get the context used to shape the texts."""
+		if self.context == None:
+			if Pango != None:
+				self.context = PangoCairo.FontMap.get_default().create_context()
+			else:
+				self.context = cairo.Context(cairo.ImageSurface(cairo.FORMAT_A8, 1, 1))
+		return self.context
+
+	def get_font(self, font):
+		"""Get the font description from its string."""
+		try:
+			return self.fonts[font]
+		except KeyError:
+			if Pango != None:
+				desc = Pango.FontDescription.from_string(font)
+			else:
+				words = font.split()
+				size = 10.
+				if words and words[-1].replace(".", "", 1).isdigit():
+					size = float(words.pop())
+				weight = cairo.FONT_WEIGHT_NORMAL
+				if "Bold" in words:
+					words.remove("Bold")
+					weight = cairo.FONT_WEIGHT_BOLD
+				desc = (" ".join(words) or "Sans", weight, size * 96. / 72.)
+			self.fonts[font] = desc
+			return desc
+
+	def get_layout(self, text, font, width, align):
+		"""Get the layout of a text, shaping it if needed."""
+		key = (text, font, width, align)
+		try:
+			layout = self.layouts[key]
+			self.layouts.move_to_end(key)
+		except KeyError:
+			layout = self.make_layout(text, font, width, align)
+			self.layouts[key] = layout
+			if len(self.layouts) > self.size:
+				self.layouts.popitem(last = False)
+		return layout
+
+	def make_layout(self, text, font, width, align):
+		"""Shape a text."""
+		cx = self.get_context()
+		desc = self.get_font(font)
+		if Pango != None:
+			layout = Pango.Layout.new(cx)
+			layout.set_font_description(desc)
+			if width != -1:
+				layout.set_width(int(width * Pango.SCALE))
+				layout.set_wrap(Pango.WrapMode.WORD_CHAR)
+			layout.set_alignment([Pango.Alignment.LEFT,
+				Pango.Alignment.CENTER, Pango.Alignment.RIGHT][align])
+			layout.set_text(text, -1)
+			ink, logical = layout.get_pixel_extents()
+			return TextLayout(layout, logical.width, logical.height,
+				(ink.x, ink.y, ink.width, ink.height))
+		else:
+			family, weight, size = desc
+			cx.select_font_face(family, cairo.FONT_SLANT_NORMAL, weight)
+			cx.set_font_size(size)
+			ascent, descent, height, _, _ = cx.font_extents()
+			bx, by, bw, bh, adv, _ = cx.text_extents(text)
+			return TextLayout(desc + (text,), int(adv + .5), int(height + .5),
+				(int(bx), int(ascent + by), int(bw + 1.5), int(bh + 1.5)))
+
+	def measure(self, text, font = None, width = -1, align = ui.ALIGN_LEFT):
+		"""Get the size (w, h) of a text."""
+		layout = self.get_layout(text, font or DEFAULT_FONT, width, align)
+		return (layout.w, layout.h)
+
+	def show(self, cr, layout, x, y, update = True):
+		"""Draw a layout at (x, y) with the current source of cr. If
+		update is True, the layout is first adapted to the font options
+		of cr."""
+		if Pango != None:
+			cr.move_to(x, y)
+			if update:
+				PangoCairo.update_layout(cr, layout.layout)
+			PangoCairo.show_layout(cr, layout.layout)
+		else:
+			family, weight, size, text = layout.layout
+			cr.select_font_face(family, cairo.FONT_SLANT_NORMAL, weight)
+			cr.set_font_size(size)
+			cr.move_to(x, y + cr.font_extents()[0])
+			cr.show_text(text)
+
+	def get_run(self, key, layout):
+		"""Get the rasterized run of a layout as an alpha mask."""
+		try:
+			run = self.runs[key]
+			self.runs.move_to_end(key)
+		except KeyError:
+			ix, iy, iw, ih = layout.ink
+			run = cairo.ImageSurface(cairo.FORMAT_A8, iw, ih)
+			cr = cairo.Context(run)
+			cr.set_source_rgb(0, 0, 0)
+			self.show(cr, layout, -ix, -iy, False)
+			run.flush()
+			self.runs[key] = run
+			if len(self.runs) > self.run_size:
+				self.runs.popitem(last = False)
+		return run
+
+	def draw(self, cr, color, text, x, y, font = None, width = -1, align = ui.ALIGN_LEFT):
+		"""Draw a text with its top-left corner at (x, y) on the cairo
+		context in the given RGB color."""
+		key = (text, font or DEFAULT_FONT, width, align)
+		layout = self.get_layout(*key)
+		layout.uses = layout.uses + 1
+		cr.set_source_rgb(*color)
+		m = cr.get_matrix()
+		if layout.uses < self.hot or m.xx != 1 or m.yy != 1 or m.xy != 0 or m.yx != 0 \
+		or cr.get_target().get_device_scale() != (1., 1.):
+			self.show(cr, layout, x, y)
+		elif layout.ink[2] > 0 and layout.ink[3] > 0:
+			run = self.get_run(key, layout)
+			x = round(x + layout.ink[0] + m.x0) - m.x0
+			y = round(y + layout.ink[1] + m.y0) - m.y0
+			cr.mask_surface(run, x, y)
+
+	def clear(self):
+		"""Empty the cache."""
+		self.layouts.clear()
+		self.runs.clear()
+
+TEXT_CACHE = TextCache()
+
+
+class SubImage:
+	"""Image made of the rectangle (x, y, w, h) of a cairo surface, for
+	instance an icon in an atlas. scale is the number of surface pixels
+	per drawn pixel (2 for HiDPI variants)."""
+
+	def __init__(self, surface, x, y, w, h, scale = 1):
+		self.surface = surface
+		self.x = x
+		self.y = y
+		self.w = w
+		self.h = h
+		self.scale = scale
+
+	def get_size(self):
+		"""Get the drawn size of the image."""
+		return (self.w / self.scale, self.h / self.scale)
+
+	def extract(self):
+		"""Copy the image into its own surface, with the device scale
+		set for HiDPI displays."""
+		surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.w, self.h)
+		cr = cairo.Context(surface)
+		cr.set_source_surface(self.surface, -self.x, -self.y)
+		cr.paint()
+		surface.set_device_scale(self.scale, self.scale)
+		return surface
+
+
+class CairoPort(ui.DrawingArea):
+	"""Drawing area painting on a cairo context."""
+
+	def __init__(self, cr = None):
+		self.cr = cr
+		self.color = (1., 1., 1.)
+
+	def get_rgb(self, r, g, b):
+		if isinstance(r, int):
+			return (r / 255., g / 255., b / 255.)
+		else:
+			return (r, g, b)
+
+	def set_color(self, color):
+		self.color = color
+
+	def box(self, x, y, w, h):
+		r, g, b = self.color
+		self.cr.set_source_rgb(r, g, b)
+		self.cr.new_path()
+		self.cr.rectangle(x, y, w, h)
+		self.cr.stroke()
+
+	def fill_box(self, x, y, w, h):
+		r, g, b = self.color
+		self.cr.set_source_rgb(r, g, b)
+		self.cr.new_path()
+		self.cr.rectangle(x, y, w, h)
+		self.cr.fill()
+
+	def draw_image(self, image, x, y):
+		if isinstance(image, SubImage):
+			w, h = image.get_size()
+			self.cr.save()
+			self.cr.rectangle(x, y, w, h)
+			self.cr.clip()
+			self.cr.translate(x, y)
+			self.cr.scale(1. / image.scale, 1. / image.scale)
+			self.cr.set_source_surface(image.surface, -image.x, -image.y)
+			self.cr.paint()
+			self.cr.restore()
+		else:
+			self.cr.set_source_surface(image, x, y)
+			self.cr.paint()
+
+	def draw_text(self, text, x, y, font = None, width = -1, align = ui.ALIGN_LEFT):
+		TEXT_CACHE.draw(self.cr, self.color, text, x, y, font, width, align)
+
+	def measure_text(self, text, font = None, width = -1, align = ui.ALIGN_LEFT):
+		return TEXT_CACHE.measure(text, font, width, align)
+
+
+PAINTER = []
+
+def init_worker(painter):
+	"""Initialize a worker process with the painter to use."""
+	PAINTER[:] = [painter]
+
+
+def render_tile(name, x, y, w, h, stride, gen):
+	"""Paint the area (x, y, w, h) in the shared memory of the given
+	name, in a worker process."""
+	shm = shared_memory.SharedMemory(name = name)
+	try:
+		surface = cairo.ImageSurface.create_for_data(shm.buf, cairo.FORMAT_ARGB32, w, h, stride)
+		cr = cairo.Context(surface)
+		cr.translate(-x, -y)
+		PAINTER[0].paint(CairoPort(cr), x, y, w, h)
+		surface.flush()
+		surface.finish()
+		del cr, surface
+	finally:
+		shm.close()
+	return (x, y, gen)
+
+
+class Tile:
+	"""A tile whose pixels are in shared memory."""
+
+	def __init__(self, x, y, w, h):
+		self.x = x
+		self.y = y
+		self.w = w
+		self.h = h
+		self.stride = cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_ARGB32, w)
+		self.shm = None
+		self.surface = None
+		self.next = None
+		self.gen = -1
+
+	def alloc(self):
+		"""Allocate a buffer to render the tile."""
+		self.next = shared_memory.SharedMemory(create = True, size = self.stride * self.h)
+		return self.next.name
+
+	def swap(self):
+		"""Display the rendered buffer."""
+		self.release(self.shm)
+		self.shm = self.next
+		self.next = None
+		self.surface = cairo.ImageSurface.create_for_data(self.shm.buf,
+			cairo.FORMAT_ARGB32, self.w, self.h, self.stride)
+
+	def release(self, shm):
+		"""Release a buffer of the tile. The surface displaying it
+		is dropped first as it holds an export of the buffer that
+		prevents to close it."""
+		if shm != None:
+			if shm == self.shm:
+				surface = self.surface
+				self.surface = None
+				surface.finish()
+				del surface
+			shm.close()
+			shm.unlink()
+
+	def free(self):
+		"""Release the buffers of the tile."""
+		self.release(self.shm)
+		self.shm = None
+		self.release(self.next)
+		self.next = None
+
+
+class TileRenderer:
+	"""Renderer painting with a pool of processes. The area to paint
+	is split into tiles of TILE_SIZE pixels, each one painted by a worker
+	process into a shared memory buffer that is displayed without copy.
+	Tiles are displayed as soon as they are ready: on_ready is called
+	(in the UI thread) with the area of the tile. The painter must be
+	picklable as it is sent to the worker processes. Tiles dropped
+	by a resize keep the buffer being rendered until the rendering
+	ends, the result being then ignored."""
+
+	def __init__(self, painter, on_ready, processes = None, method = "spawn"):
+		self.painter = painter
+		self.on_ready = on_ready
+		self.processes = processes
+		self.context = multiprocessing.get_context(method)
+		self.pool = None
+		self.tiles = {}
+		self.gen = 0
+		self.size = (0, 0)
+
+	def get_pool(self):
+		if self.pool == None:
+			self.pool = self.context.Pool(self.processes,
+				initializer = init_worker, initargs = (self.painter,))
+		return self.pool
+
+	def set_painter(self, painter):
+		"""Change the painter: the worker processes are restarted."""
+		self.painter = painter
+		self.close()
+
+	def set_size(self, w, h):
+		"""Set the size of the painted area."""
+		if (w, h) == self.size:
+			return
+		self.size = (w, h)
+		for tile in self.tiles.values():
+			tile.release(tile.shm)
+			tile.shm = None
+		self.tiles = {}
+		self.invalidate()
+
+	def invalidate(self):
+		"""Ask to render again all tiles. The current content is displayed
+		until the new one is ready."""
+		self.gen = self.gen + 1
+
+	def paint(self, cr, x, y, w, h):
+		"""Paint the area (x, y, w, h) on the cairo context with the
+		available tiles and launch the rendering of missing or outdated
+		tiles."""
+		W, H = self.size
+		for ty in range(y // TILE_SIZE * TILE_SIZE, min(y + h, H), TILE_SIZE):
+			for tx in range(x // TILE_SIZE * TILE_SIZE, min(x + w, W), TILE_SIZE):
+				try:
+					tile = self.tiles[(tx, ty)]
+				except KeyError:
+					tile = Tile(tx, ty, min(TILE_SIZE, W - tx), min(TILE_SIZE, H - ty))
+					self.tiles[(tx, ty)] = tile
+				if tile.gen != self.gen and tile.next == None:
+					self.launch(tile)
+				if tile.surface != None:
+					cr.set_source_surface(tile.surface, tx, ty)
+					cr.rectangle(tx, ty, tile.w, tile.h)
+					cr.fill()
+		# do not keep the last tile alive as source of the context
+		cr.set_source_rgb(0, 0, 0)
+
+	def launch(self, tile):
+		"""Launch the rendering of a tile."""
+		name = tile.alloc()
+		self.get_pool().apply_async(render_tile,
+			(name, tile.x, tile.y, tile.w, tile.h, tile.stride, self.gen),
+			callback = lambda r: base.call_ui(self.done, tile, r[2]),
+			error_callback = lambda e: base.call_ui(self.failed, tile, e))
+
+	def done(self, tile, gen):
+		"""Called in the UI thread when a tile is rendered."""
+		if self.tiles.get((tile.x, tile.y)) != tile:
+			tile.free()
+			return
+		tile.swap()
+		tile.gen = gen
+		self.on_ready(tile.x, tile.y, tile.w, tile.h)
+
+	def failed(self, tile, e):
+		"""Called in the UI thread when the rendering of a tile fails."""
+		if self.tiles.get((tile.x, tile.y)) != tile:
+			tile.free()
+			return
+		tile.release(tile.next)
+		tile.next = None
+		tile.gen = self.gen
+		base.TEXT_MONITOR.error("tile rendering failed: %s" % e)
+
+	def close(self):
+		"""Stop the worker processes and release the tiles."""
+		if self.pool != None:
+			self.pool.terminate()
+			self.pool = None
+		for tile in self.tiles.values():
+			tile.free()
+		self.tiles = {}
+		self.gen = self.gen + 1
+
+
+class ImagePyramid:
+	"""Pyramid of mip levels of a big image (a cairo image surface) to
+	display it at any zoom without scaling the full image at each frame.
+	Level l is the image reduced by 2**l and is split in tiles of tile
+	pixels, built lazily in the background (in the given executor, default
+	to base.get_executor()) from the tiles of level l - 1. While a tile
+	is built, the coarser available level is displayed and on_ready is
+	called (in the UI thread) when it is ready.
+
+	Tiles are kept in store, a mapping from (level, tx, ty) to cairo
+	image surfaces (default to a dictionary); it must support get()
+	and item assignment from worker threads. The source may also be a
+	tiles.TileStore: tiles are then first looked up in it. If it is
+	opened for writing, it also keeps the built tiles, else they are
+	kept in store."""
+
+	def __init__(self, source, on_ready = None, store = None, executor = None, tile = TILE_SIZE):
+		self.tiles = None
+		if isinstance(source, cairo.ImageSurface):
+			self.source = source
+			self.w = source.get_width()
+			self.h = source.get_height()
+		else:
+			self.source = None
+			self.w, self.h = source.get_size()
+			tile = source.tile
+			self.tiles = source
+			if store == None and source.write:
+				store = source
+		self.on_ready = on_ready
+		self.store = {} if store == None else store
+		self.executor = executor
+		self.tile = tile
+		self.pending = set()
+		self.levels = 0
+		while max(self.w, self.h) > tile << self.levels:
+			self.levels = self.levels + 1
+
+	def get_level(self, zoom):
+		"""Get the level to display at the given zoom."""
+		if zoom >= 1:
+			return 0
+		return min(int(math.floor(math.log2(1. / zoom))), self.levels)
+
+	def get_size(self, level):
+		"""Get the size in pixels of a level."""
+		return (-(-self.w >> level), -(-self.h >> level))
+
+	def get_tile_size(self, level, tx, ty):
+		"""Get the size in pixels of a tile."""
+		w, h = self.get_size(level)
+		return (min(self.tile, w - tx * self.tile), min(self.tile, h - ty * self.tile))
+
+	def get_tile(self, level, tx, ty):
+		"""Get a built tile, or None."""
+		surface = self.store.get((level, tx, ty))
+		if surface == None and self.tiles != None and self.tiles is not self.store:
+			surface = self.tiles.get((level, tx, ty))
+		return surface
+
+	def build(self, level, tx, ty):
+		"""Build and store a tile of a level above 0, building the
+		missing tiles of the finer levels."""
+		T = self.tile
+		tw, th = self.get_tile_size(level, tx, ty)
+		surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, tw, th)
+		cr = cairo.Context(surface)
+		cr.scale(.5, .5)
+		if level == 1 and self.source != None:
+			parts = [(self.source, -2 * tx * T, -2 * ty * T)]
+		else:
+			w, h = self.get_size(level - 1)
+			parts = []
+			for j in range(2):
+				for i in range(2):
+					cx, cy = 2 * tx + i, 2 * ty + j
+					if cx * T < w and cy * T < h:
+						child = self.get_tile(level - 1, cx, cy)
+						if child == None and level > 1:
+							child = self.build(level - 1, cx, cy)
+						if child != None:
+							parts.append((child, i * T, j * T))
+		for (image, x, y) in parts:
+			cr.set_source_surface(image, x, y)
+			cr.get_source().set_filter(cairo.FILTER_GOOD)
+			cr.paint()
+		surface.flush()
+		self.store[(level, tx, ty)] = surface
+		return surface
+
+	def request(self, level, tx, ty):
+		"""Launch the building of a tile in the background."""
+		key = (level, tx, ty)
+		if key in self.pending:
+			return
+		self.pending.add(key)
+		executor = self.executor if self.executor != None else base.get_executor()
+		future = executor.submit(self.build, level, tx, ty)
+		future.add_done_callback(lambda f: base.call_ui(self.done, key, f))
+
+	def done(self, key, future):
+		"""Called in the UI thread when a tile is built."""
+		self.pending.discard(key)
+		if future.exception() != None:
+			base.TEXT_MONITOR.error("tile building failed: %s" % future.exception())
+		elif self.on_ready != None:
+			self.on_ready()
+
+	def paint_tile(self, cr, level, tx, ty, surface, clip):
+		"""Paint a tile of the given level restricted to the clip
+		rectangle in image coordinates."""
+		s = 1 << level
+		cr.save()
+		cr.rectangle(*clip)
+		cr.clip()
+		cr.scale(s, s)
+		cr.set_source_surface(surface, tx * self.tile, ty * self.tile)
+		if level != 0:
+			cr.get_source().set_filter(cairo.FILTER_GOOD)
+		cr.paint()
+		cr.restore()
+
+	def paint(self, cr, zoom, x, y, w, h):
+		"""Paint the area (x, y, w, h), in image coordinates, on the
+		cairo context displaying the image at the given zoom."""
+		level = self.get_level(zoom)
+		if level == 0 and self.source != None:
+			self.paint_tile(cr, 0, 0, 0, self.source, (x, y, w, h))
+			return
+		span = self.tile << level
+		lw, lh = self.get_size(level)
+		for ty in range(max(y // span, 0), min(-(-(y + h) // span), -(-lh // self.tile))):
+			for tx in range(max(x // span, 0), min(-(-(x + w) // span), -(-lw // self.tile))):
+				tw, th = self.get_tile_size(level, tx, ty)
+				clip = (tx * span, ty * span, tw << level, th << level)
+				surface = self.get_tile(level, tx, ty)
+				if surface != None:
+					self.paint_tile(cr, level, tx, ty, surface, clip)
+					continue
+				if level == 0:
+					continue
+				self.request(level, tx, ty)
+				for l in range(level + 1, self.levels + 1):
+					cx, cy = tx >> (l - level), ty >> (l - level)
+					surface = self.get_tile(l, cx, cy)
+					if surface != None:
+						self.paint_tile(cr, l, cx, cy, surface, clip)
+						break
+
+
+class PyramidPainter(ui.Painter):
+	"""Painter displaying an image pyramid: the level is chosen
+	according to the scale of the drawing context, as set by the zoom
+	of the canvas."""
+
+	def __init__(self, pyramid):
+		self.pyramid = pyramid
+
+	def paint(self, draw, x, y, w, h):
+		self.pyramid.paint(draw.cr, draw.cr.get_matrix().xx, int(x), int(y),
+			int(math.ceil(w)), int(math.ceil(h)))
+
+	def is_retained(self, layer):
+		"""The pyramid already keeps its tiles and the level depends
+		on the zoom: a recording, made without it, would hold the full
+		resolution area."""
+		return False
@@ -0,0 +1,179 @@
+#
+#	ElfKit session snapshots.
+#	Copyright (C) 2019  Hugues Casse <hug.casse@gmail.com>
+#
+#	This file is part of ElfKit.
+#
+#	ElfKit is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	ElfKit is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with ElfKit.  If not, see <https://www.gnu.org/licenses/>.
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+
+"""Save and restore of the state of an application: the values of all
+the variables (Var) reachable from the application are stored in a
+binary file under the path of the application context.
+
+A variable is identified by the first path, in breadth-first order of
+sorted attribute names, leading to it from the application, like
+"pane.views[2].var" or "config['size']". It remains stable as long as
+the application builds its objects the same way.
+
+To keep the search fast, lists, tuples and dictionaries are only
+explored if their first item may hold variables (a variable or an
+explored object), and an application may restrict the search to some
+of its attributes by listing their names in session_roots.
+
+The file is made of the magic b"ELFSESS1" followed by the pickle of
+the dictionary of the values indexed by the variable identifiers."""
+
+import os
+import os.path
+import pickle
+import types
+
+from elfkit import base
+
+MAGIC = b"ELFSESS1"
+
+# default name of the session file
+SESSION_NAME = "session"
+
+# object types that are not explored
+SKIPPED_TYPES = (types.ModuleType, types.FunctionType, types.MethodType,
+	types.BuiltinFunctionType, type, base.Type)
+
+
+def is_explored(obj):
+	"""Test if an object is explored to find variables."""
+	if isinstance(obj, SKIPPED_TYPES):
+		return False
+	if isinstance(obj, (list, tuple, dict)):
+		if len(obj) == 0:
+			return False
+		first = next(iter(obj.values())) if isinstance(obj, dict) else obj[0]
+		return isinstance(first, base.Var) or is_explored(first)
+	return hasattr(obj, "__dict__") and not type(obj).__module__.startswith("gi.")
+
+
+def find_vars(root):
+	"""Find the variables reachable from root. Return a dictionary
+	associating the variables with their identifiers. If root has
+	a session_roots attribute, only the attributes it names are
+	explored."""
+	vars = {}
+	seen = {id(root)}
+	names = getattr(root, "session_roots", None)
+	if names == None:
+		todo = [("", root)]
+	else:
+		todo = []
+		for name in names:
+			obj = getattr(root, name)
+			seen.add(id(obj))
+			if isinstance(obj, base.Var):
+				vars[obj] = name
+			else:
+				todo.append((name, obj))
+	for (path, obj) in todo:
+		if isinstance(obj, (list, tuple)):
+			items = [("%s[%d]" % (path, i), x) for (i, x) in enumerate(obj)]
+		elif isinstance(obj, dict):
+			items = [("%s[%r]" % (path, k), obj[k]) for k in obj if isinstance(k, (str, int))]
+		else:
+			prefix = path + "." if path != "" else ""
+			items = [(prefix + k, v) for (k, v) in sorted(vars_of(obj)) if k != "obss"]
+		for (p, x) in items:
+			if id(x) in seen:
+				continue
+			if isinstance(x, base.Var):
+				seen.add(id(x))
+				vars[x] = p
+			elif is_explored(x):
+				seen.add(id(x))
+				todo.append((p, x))
+	return vars
+
+
+def vars_of(obj):
+	"""Get the attributes of an object as (name, value) pairs."""
+	try:
+		return obj.__dict__.items()
+	except AttributeError:
+		return []
+
+
+def get_path(app, name = SESSION_NAME):
+	"""Get the path of the session file of an application (in the
+	current directory if the application has no path)."""
+	return os.path.join(app.get_path() or ".", name + ".session")
+
+
+def save(app, path = None):
+	"""Save the values of the variables of the application in path
+	(default to get_path()). Return the number of saved variables."""
+	if path == None:
+		path = get_path(app)
+	values = {p: var.val for (var, p) in find_vars(app).items()}
+	tmp = path + ".tmp"
+	with open(tmp, "wb") as out:
+		out.write(MAGIC)
+		pickle.dump(values, out, pickle.HIGHEST_PROTOCOL)
+	os.replace(tmp, path)
+	return len(values)
+
+
+def restore(app, path = None):
+	"""Restore the values of the variables of the application saved
+	in path (default to get_path()). All values are assigned first,
+	without recording them in the journal, then the observers of the
+	changed variables are notified once. As the restored values are
+	not undoable, the active journal is cleared. Return the number of restored
+	variables (0 if there is no session file)."""
+	if path == None:
+		path = get_path(app)
+	try:
+		with open(path, "rb") as input:
+			if input.read(len(MAGIC)) != MAGIC:
+				raise ValueError("%s: not a session file" % path)
+			values = pickle.load(input)
+	except FileNotFoundError:
+		return 0
+	changed = []
+	for (var, p) in find_vars(app).items():
+		try:
+			val = values[p]
+		except KeyError:
+			continue
+		if var.val != val:
+			var.val = val
+			changed.append(var)
+	if changed != [] and base.JOURNAL != []:
+		journal = base.JOURNAL[0]
+		journal.clear()
+		for var in changed:
+			journal.refresh(var)
+	for var in changed:
+		var.trigger_update(var.get())
+	return len(changed)
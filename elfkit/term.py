@@ -0,0 +1,747 @@
+#
+#	ElfKit terminal driver.
+#	Copyright (C) 2019  Hugues Casse <hug.casse@gmail.com>
+#
+#	This file is part of ElfKit.
+#
+#	ElfKit is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	ElfKit is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with ElfKit.  If not, see <https://www.gnu.org/licenses/>.
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+
+"""Terminal implementation of the common user interface using ANSI
+escape sequences. The driver keeps a model of the screen and only
+sends the cells that changed since the last refresh, so that it stays
+usable over slow remote links. Changes of variables and actions are
+coalesced into one refresh per tick."""
+
+import codecs
+import os
+import queue
+import select
+import shutil
+import sys
+import termios
+import time
+import tty
+
+from elfkit import base
+from elfkit import ui
+from elfkit import view
+
+# cell attributes
+NORMAL = 0
+BOLD = 1
+REVERSE = 2
+DIM = 4
+
+# delay between two ticks (in seconds)
+TICK = 1. / 30
+
+# delay to wait for the end of an escape sequence split across reads
+# before taking its start as typed keys (in seconds)
+ESCAPE_DELAY = .2
+
+# escape sequences of special keys
+ESCAPES = [
+	("\x1b[A", "up"),
+	("\x1b[B", "down"),
+	("\x1b[C", "right"),
+	("\x1b[D", "left"),
+	("\x1bOA", "up"),
+	("\x1bOB", "down"),
+	("\x1bOC", "right"),
+	("\x1bOD", "left"),
+	("\x1b[Z", "backtab"),
+	("\x1b[21~", "f10"),
+	("\x1b[5~", "pageup"),
+	("\x1b[6~", "pagedown")
+]
+
+SIMPLE_KEYS = {
+	"\r": "enter",
+	"\n": "enter",
+	"\t": "tab",
+	"\x7f": "backspace",
+	"\x08": "backspace"
+}
+
+
+def parse_keys(text, final = True):
+	"""Split the text read from the terminal into a list of keys.
+	Special keys are named ("up", "enter", "esc", etc), other keys
+	are given as the typed character. Return the keys and the end of
+	text that may be the start of an escape sequence, to be completed
+	by the next read; if final is True, there is no such rest."""
+	keys = []
+	i = 0
+	while i < len(text):
+		if text[i] == "\x1b":
+			for (seq, key) in ESCAPES:
+				if text.startswith(seq, i):
+					keys.append(key)
+					i = i + len(seq)
+					break
+			else:
+				if not final and any(seq.startswith(text[i:]) for (seq, key) in ESCAPES):
+					return (keys, text[i:])
+				keys.append("esc")
+				i = i + 1
+		else:
+			keys.append(SIMPLE_KEYS.get(text[i], text[i]))
+			i = i + 1
+	return (keys, "")
+
+
+def sgr(attr):
+	"""Build the escape sequence selecting the given attributes."""
+	codes = ["0"]
+	if attr & BOLD:
+		codes.append("1")
+	if attr & DIM:
+		codes.append("2")
+	if attr & REVERSE:
+		codes.append("7")
+	return "\x1b[%sm" % ";".join(codes)
+
+
+BLANK = (" ", NORMAL)
+
+class Screen:
+	"""Model of the terminal screen. Drawing is performed in a back
+	buffer and flush() only writes the cells that differ from the front
+	buffer, that is, from what the terminal displays."""
+
+	def __init__(self, out, w, h):
+		self.out = out
+		self.resize(w, h)
+
+	def resize(self, w, h):
+		"""Change the size of the screen. The next flush redraws
+		everything."""
+		self.w = w
+		self.h = h
+		self.front = [[None] * w for i in range(h)]
+		self.back = [[BLANK] * w for i in range(h)]
+		self.out.write("\x1b[0m\x1b[2J")
+
+	def clear(self):
+		"""Clear the back buffer."""
+		for row in self.back:
+			row[:] = [BLANK] * self.w
+
+	def put(self, x, y, text, attr = NORMAL):
+		"""Write text at (x, y) with the given attributes. The text is
+		clipped to the screen."""
+		if y < 0 or y >= self.h:
+			return
+		row = self.back[y]
+		for c in text:
+			if 0 <= x < self.w:
+				row[x] = (c, attr)
+			x = x + 1
+
+	def fill(self, x, y, w, h, attr = NORMAL):
+		"""Fill a rectangle with blanks."""
+		for i in range(y, y + h):
+			self.put(x, i, " " * w, attr)
+
+	def flush(self):
+		"""Send the changed cells to the terminal."""
+		buf = []
+		pos = None
+		cur = None
+		for y in range(self.h):
+			front = self.front[y]
+			back = self.back[y]
+			if front == back:
+				continue
+			for x in range(self.w):
+				cell = back[x]
+				if front[x] == cell:
+					continue
+				if pos != (x, y):
+					buf.append("\x1b[%d;%dH" % (y + 1, x + 1))
+				if cell[1] != cur:
+					cur = cell[1]
+					buf.append(sgr(cur))
+				buf.append(cell[0])
+				front[x] = cell
+				pos = (x + 1, y)
+		if buf != []:
+			buf.append("\x1b[0m")
+			self.out.write("".join(buf))
+			self.out.flush()
+
+
+class Refresher(base.VarObserver, base.ActionObserver, base.MessageObserver):
+	"""Observer requesting a refresh of the driver for any change."""
+
+	def __init__(self, driver):
+		self.driver = driver
+
+	def on_update(self, var, val):
+		self.driver.invalidate()
+
+	def on_check(self, action):
+		self.driver.invalidate()
+
+	def on_message(self, store, msg):
+		self.driver.invalidate()
+
+
+class Layer:
+	"""A layer displayed by a frame. The top layer of a frame receives
+	the keys."""
+
+	def render(self, screen):
+		"""Draw the layer on the screen."""
+		pass
+
+	def on_key(self, key):
+		"""Called when a key is typed. Return True if the key has been
+		used."""
+		return False
+
+
+class SwitchLayer(Layer):
+	"""Layer displaying a switch view as a list of buttons."""
+
+	def __init__(self, frame, view):
+		self.frame = frame
+		self.view = view
+		self.focus = 0
+
+	def observe(self, obs):
+		for action in self.view.get_actions():
+			action.add_observer(obs)
+			action.observe(obs)
+
+	def render(self, screen):
+		y = 2
+		for i, action in enumerate(self.view.get_actions()):
+			attr = NORMAL if action.check() else DIM
+			if i == self.focus:
+				attr = attr | REVERSE
+			screen.put(2, y, "[ %s ]" % action.get_label(), attr)
+			if i == self.focus and action.get_help() != "":
+				screen.put(4, screen.h - 2, action.get_help(), DIM)
+			y = y + 1
+
+	def on_key(self, key):
+		n = len(self.view.get_actions())
+		if n == 0:
+			return False
+		if key in ("down", "tab"):
+			self.focus = (self.focus + 1) % n
+		elif key in ("up", "backtab"):
+			self.focus = (self.focus - 1) % n
+		elif key in ("enter", " "):
+			action = self.view.get_actions()[self.focus]
+			if action.check():
+				action.apply(self.frame)
+		else:
+			return False
+		return True
+
+
+class MenuLayer(Layer):
+	"""Layer displaying an open menu of the menu bar."""
+
+	def __init__(self, frame):
+		self.frame = frame
+		self.menu = 0
+		self.item = 0
+
+	def get_items(self):
+		return self.frame.menu[self.menu][1]
+
+	def render(self, screen):
+		x = self.frame.menu_positions[self.menu]
+		items = self.get_items()
+		w = max([len(self.item_label(i)) for i in items] + [8]) + 2
+		screen.fill(x, 1, w, len(items), REVERSE)
+		for i, item in enumerate(items):
+			attr = REVERSE if i != self.item else NORMAL
+			if isinstance(item, base.AbstractAction) and not item.check():
+				attr = attr | DIM
+			screen.put(x + 1, 1 + i, self.item_label(item), attr)
+
+	def item_label(self, item):
+		if isinstance(item, base.AbstractVar):
+			if item.type.is_standard(bool):
+				return "[%s] %s" % ("x" if item.get() else " ", item.get_label())
+			return "%s: %s..." % (item.get_label(), value_text(item))
+		return item.get_label()
+
+	def on_key(self, key):
+		items = self.get_items()
+		if key == "esc" or key == "f10":
+			self.frame.pop_layer()
+		elif key == "left":
+			self.menu = (self.menu - 1) % len(self.frame.menu)
+			self.item = 0
+		elif key == "right":
+			self.menu = (self.menu + 1) % len(self.frame.menu)
+			self.item = 0
+		elif key == "down" and items != []:
+			self.item = (self.item + 1) % len(items)
+		elif key == "up" and items != []:
+			self.item = (self.item - 1) % len(items)
+		elif key in ("enter", " ") and items != []:
+			item = items[self.item]
+			self.frame.pop_layer()
+			if isinstance(item, base.AbstractAction):
+				if item.check():
+					item.apply(self.frame)
+			elif item.type.is_standard(bool):
+				item.set(not item.get())
+			else:
+				self.frame.ask_dialog(item.get_label(), [item], item.get_help())
+		else:
+			return False
+		return True
+
+
+def value_text(var):
+	"""Get the text displaying the value of the variable."""
+	if var.type.is_enum():
+		i = var.type.position_of(var.get())
+		if i >= 0:
+			return var.type.get_values()[i].get_label()
+	elif var.type.is_standard(bool):
+		return "[x]" if var.get() else "[ ]"
+	return var.type.as_text(var.get())
+
+
+class FormLayer(Layer):
+	"""Layer displaying a form as a dialog box. The variables are edited
+	in place and restored if the form is cancelled. Left and right keys
+	change the value of ranges, enumerations and Booleans; typing on
+	an enumeration looks for the values containing the typed text."""
+
+	def __init__(self, title, vars):
+		self.title = title
+		self.vars = vars
+		self.row = 0
+		self.top = 0
+		self.search = ""
+		self.result = None
+
+	def render(self, screen):
+		rows = min(len(self.vars), screen.h - 6)
+		if self.row < self.top:
+			self.top = self.row
+		elif self.row >= self.top + rows:
+			self.top = self.row - rows + 1
+		lw = max([len(v.get_label()) for v in self.vars] + [len(self.title)])
+		w = min(screen.w - 2, lw + 40)
+		x = (screen.w - w) // 2
+		y = (screen.h - rows - 4) // 2
+		screen.fill(x, y, w, rows + 4, REVERSE)
+		screen.put(x + 1, y, " %s " % self.title, REVERSE | BOLD)
+		for i in range(rows):
+			var = self.vars[self.top + i]
+			screen.put(x + 1, y + 2 + i, var.get_label().rjust(lw), REVERSE)
+			attr = NORMAL if self.top + i == self.row else REVERSE
+			text = value_text(var)
+			if self.top + i == self.row and self.search != "":
+				text = "%s /%s" % (text, self.search)
+			screen.put(x + lw + 3, y + 2 + i, text[:w - lw - 4].ljust(w - lw - 4), attr)
+		screen.put(x + 1, y + rows + 3, "Enter: OK  Esc: cancel", REVERSE | DIM)
+
+	def change(self, var, d):
+		"""Move the value of the variable of d steps."""
+		if var.type.is_range():
+			var.set(max(var.type.low, min(var.type.up, var.get() + d)))
+		elif var.type.is_enum():
+			values = var.type.get_values()
+			i = max(var.type.position_of(var.get()), 0)
+			var.set(values[(i + d) % len(values)].get_value())
+		elif var.type.is_standard(bool):
+			var.set(not var.get())
+
+	def on_key(self, key):
+		if key == "enter":
+			self.result = True
+		elif key == "esc":
+			self.result = False
+		elif self.vars == []:
+			return False
+		else:
+			return self.on_var_key(self.vars[self.row], key)
+		return True
+
+	def on_var_key(self, var, key):
+		"""Handle a key changing the current row or its variable."""
+		if key in ("down", "tab"):
+			self.row = (self.row + 1) % len(self.vars)
+			self.search = ""
+		elif key in ("up", "backtab"):
+			self.row = (self.row - 1) % len(self.vars)
+			self.search = ""
+		elif key == "left":
+			self.change(var, -1)
+		elif key == "right" or (key == " " and not var.type.is_enum()):
+			self.change(var, 1)
+		elif key == "pageup":
+			self.change(var, -10)
+		elif key == "pagedown":
+			self.change(var, 10)
+		elif var.type.is_enum() and (len(key) == 1 or key == "backspace"):
+			if key == "backspace":
+				self.search = self.search[:-1]
+			else:
+				self.search = self.search + key
+			if self.search != "":
+				res = var.type.get_index().search(self.search, 1)
+				if res != []:
+					var.set(var.type.get_values()[res[0]].get_value())
+		else:
+			return False
+		return True
+
+
+class ChoiceLayer(Layer):
+	"""Layer asking the user to choose an item in a list."""
+
+	def __init__(self, question, items, deflt = 0, help = ""):
+		self.question = question
+		self.items = items
+		self.item = deflt
+		self.help = help
+		self.result = None
+
+	def render(self, screen):
+		w = min(screen.w - 2, max([len(str(i)) for i in self.items] + [len(self.question)]) + 6)
+		h = min(len(self.items), screen.h - 6)
+		top = max(0, self.item - h + 1)
+		x = (screen.w - w) // 2
+		y = (screen.h - h - 4) // 2
+		screen.fill(x, y, w, h + 4, REVERSE)
+		screen.put(x + 1, y, " %s " % self.question, REVERSE | BOLD)
+		for i in range(h):
+			attr = NORMAL if top + i == self.item else REVERSE
+			screen.put(x + 3, y + 2 + i, str(self.items[top + i]), attr)
+		if self.help != "":
+			screen.put(x + 1, y + h + 3, self.help, REVERSE | DIM)
+
+	def on_key(self, key):
+		if self.items == [] and key not in ("esc",):
+			return False
+		if key in ("down", "tab", "right"):
+			self.item = (self.item + 1) % len(self.items)
+		elif key in ("up", "backtab", "left"):
+			self.item = (self.item - 1) % len(self.items)
+		elif key in ("enter", " "):
+			self.result = self.item
+		elif key == "esc":
+			self.result = -1
+		else:
+			return False
+		return True
+
+
+def build_view(frame, _view):
+	"""Build the layer displaying the given view in the given frame."""
+	if isinstance(_view, view.Switch):
+		layer = SwitchLayer(frame, _view)
+		layer.observe(frame.driver.refresher)
+		frame.layers.append(layer)
+
+
+class Frame(ui.Frame, base.Monitor):
+	"""Frame displayed in the terminal: a menu bar on the first line,
+	the view and a status line on the last line. The menu is opened
+	with F10 or Escape."""
+
+	def __init__(self, app, driver, view = None):
+		ui.Frame.__init__(self, app, driver)
+		self.title = app.get_label()
+		self.menu = []
+		self.menu_positions = []
+		self.view = view
+		self.layers = []
+		self.jobs = []
+		self.messages = base.MessageStore(100)
+		self.messages.add_observer(driver.refresher)
+		if view != None:
+			build_view(self, view)
+
+	def set_title(self, title):
+		self.title = title
+		self.driver.invalidate()
+
+	def set_menu(self, menu):
+		self.menu = menu
+		for (name, items) in menu:
+			for item in items:
+				item.add_observer(self.driver.refresher)
+
+	def open(self):
+		self.driver.show(self)
+		if self.view != None:
+			self.view.show()
+
+	def close(self):
+		self.driver.hide(self)
+		if self.view != None:
+			self.view.hide()
+
+	def push_layer(self, layer):
+		"""Display a layer over the current ones."""
+		self.layers.append(layer)
+		self.driver.invalidate()
+
+	def pop_layer(self):
+		"""Remove the top layer."""
+		self.layers.pop()
+		self.driver.invalidate()
+
+	def render(self, screen):
+		"""Draw the frame on the screen."""
+		screen.clear()
+		screen.fill(0, 0, screen.w, 1, REVERSE)
+		x = 1
+		self.menu_positions = []
+		for (name, items) in self.menu:
+			self.menu_positions.append(x)
+			screen.put(x, 0, " %s " % name, REVERSE)
+			x = x + len(name) + 3
+		screen.put(screen.w - len(self.title) - 1, 0, self.title, REVERSE | BOLD)
+		for layer in self.layers:
+			layer.render(screen)
+		screen.fill(0, screen.h - 1, screen.w, 1, REVERSE)
+		status = ""
+		if self.jobs != []:
+			name, ratio, key = self.jobs[-1]
+			status = "%s %3d%% " % (name, int(ratio * 100))
+		msgs = self.messages.get_messages()
+		if msgs != []:
+			msg = msgs[-1]
+			status = status + ["", "WARNING: ", "ERROR: "][msg.level] + msg.text
+			if msg.count > 1:
+				status = status + " (x%d)" % msg.count
+		screen.put(1, screen.h - 1, status, REVERSE)
+
+	def on_key(self, key):
+		if self.layers != [] and self.layers[-1].on_key(key):
+			self.driver.invalidate()
+		elif (key == "f10" or key == "esc") and self.menu != []:
+			self.push_layer(MenuLayer(self))
+		elif key == "q" and len(self.layers) <= 1:
+			self.driver.quit(self)
+
+	def run_layer(self, layer):
+		"""Display a modal layer until it gets a result."""
+		self.push_layer(layer)
+		self.driver.loop_until(lambda: layer.result != None)
+		self.layers.remove(layer)
+		self.driver.invalidate()
+		return layer.result
+
+	def ask_dialog(self, title="", vars=[], help=""):
+		snaps = [v.snapshot() for v in vars]
+		journal = base.get_journal()
+		if journal != None:
+			journal.begin(title)
+		for v in vars:
+			v.add_observer(self.driver.refresher)
+		res = False
+		try:
+			res = self.run_layer(FormLayer(title, vars))
+		finally:
+			for v in vars:
+				v.remove_observer(self.driver.refresher)
+			if not res:
+				for i in range(len(vars)):
+					vars[i].restore(snaps[i])
+			if journal != None and res:
+				journal.end()
+			elif journal != None:
+				journal.cancel()
+		return bool(res)
+
+	def ask_yesno(self, question, deflt=False, help = "", icon=""):
+		return self.run_layer(ChoiceLayer(question, ["Yes", "No"], 0 if deflt else 1, help)) == 0
+
+	def ask_choice(self, question, list, deflt = None, help = "", icon=""):
+		i = self.run_layer(ChoiceLayer(question, list,
+			list.index(deflt) if deflt != None else 0, help))
+		return None if i < 0 else list[i]
+
+	def info(self, msg):
+		self.messages.add(base.INFO, msg)
+
+	def warn(self, msg):
+		self.messages.add(base.WARNING, msg)
+
+	def error(self, msg):
+		self.messages.add(base.ERROR, msg)
+
+	def start_job(self, name, help="", icon="", cancel=None, job=None):
+		self.jobs.append((name, 0., name if job == None else job))
+		self.driver.invalidate()
+
+	def end_job(self, name, job=None):
+		key = name if job == None else job
+		for i in range(len(self.jobs) - 1, -1, -1):
+			if self.jobs[i][2] == key:
+				del self.jobs[i]
+				break
+		self.driver.invalidate()
+
+	def set_progress(self, name, ratio, job=None):
+		key = name if job == None else job
+		for i in range(len(self.jobs) - 1, -1, -1):
+			if self.jobs[i][2] == key:
+				self.jobs[i] = (name, ratio, key)
+				break
+		self.driver.invalidate()
+
+
+
+class Driver(ui.Driver):
+	"""UI driver for ANSI terminals."""
+
+	def __init__(self, input = None, output = None):
+		ui.Driver.__init__(self)
+		self.input = sys.stdin if input == None else input
+		self.output = sys.stdout if output == None else output
+		self.quit_action = \
+			base.Action(self.quit, label="Quit", icon=ui.QUIT_ICON, help="Leave the application.")
+		self.refresher = Refresher(self)
+		self.frames = []
+		self.screen = None
+		self.dirty = True
+		self.running = False
+		self.calls = queue.SimpleQueue()
+		self.wakeup = None
+		self.decoder = codecs.getincrementaldecoder("utf-8")(errors = "replace")
+		self.pending = ""
+		self.pending_date = 0.
+
+	def open(self, app, pane = None, **args):
+		return Frame(app, self, pane, **args)
+
+	def show(self, frame):
+		"""Display the given frame."""
+		if frame not in self.frames:
+			self.frames.append(frame)
+		self.invalidate()
+
+	def hide(self, frame):
+		"""Stop displaying the given frame."""
+		if frame in self.frames:
+			self.frames.remove(frame)
+		self.invalidate()
+
+	def invalidate(self):
+		"""Request a refresh of the screen at the next tick."""
+		self.dirty = True
+
+	def call(self, fun, *args):
+		"""Call a function in the thread of the driver (see
+		base.set_ui_caller())."""
+		self.calls.put((fun, args))
+		if self.wakeup != None:
+			os.write(self.wakeup[1], b"!")
+
+	def refresh(self):
+		"""Redraw the screen if needed."""
+		size = shutil.get_terminal_size()
+		if self.screen == None:
+			self.screen = Screen(self.output, size.columns, size.lines)
+		elif (size.columns, size.lines) != (self.screen.w, self.screen.h):
+			self.screen.resize(size.columns, size.lines)
+			self.dirty = True
+		if self.dirty and self.frames != []:
+			self.dirty = False
+			self.frames[-1].render(self.screen)
+			self.screen.flush()
+
+	def tick(self):
+		"""Perform one iteration of the event loop: refresh the screen
+		and wait for keys or calls."""
+		self.refresh()
+		fd = self.input.fileno()
+		r, w, x = select.select([fd, self.wakeup[0]], [], [],
+			min(TICK, ESCAPE_DELAY) if self.pending != "" else TICK)
+		if self.wakeup[0] in r:
+			os.read(self.wakeup[0], 1024)
+		while True:
+			try:
+				fun, args = self.calls.get_nowait()
+			except queue.Empty:
+				break
+			fun(*args)
+		if fd in r:
+			keys, self.pending = parse_keys(self.pending + self.decoder.decode(os.read(fd, 1024)), False)
+			self.pending_date = time.monotonic()
+		elif self.pending != "" and time.monotonic() - self.pending_date >= ESCAPE_DELAY:
+			keys, self.pending = parse_keys(self.pending)
+		else:
+			keys = []
+		for key in keys:
+			if self.frames != []:
+				self.frames[-1].on_key(key)
+
+	def loop_until(self, cond):
+		"""Run the event loop until cond() returns True or the driver
+		is stopped."""
+		while self.running and not cond():
+			self.tick()
+
+	def run(self):
+		fd = self.input.fileno()
+		saved = termios.tcgetattr(fd)
+		self.wakeup = os.pipe()
+		base.set_ui_caller(self.call)
+		self.output.write("\x1b[?1049h\x1b[?25l")
+		try:
+			tty.setcbreak(fd)
+			self.running = True
+			self.dirty = True
+			self.loop_until(lambda: False)
+		finally:
+			termios.tcsetattr(fd, termios.TCSADRAIN, saved)
+			self.output.write("\x1b[0m\x1b[?25h\x1b[?1049l")
+			self.output.flush()
+			os.close(self.wakeup[0])
+			os.close(self.wakeup[1])
+			self.wakeup = None
+			self.screen = None
+
+	def quit(self, con = None):
+		self.running = False
+
+	def get_console(self):
+		if self.frames != []:
+			return self.frames[-1]
+		else:
+			return base.TEXT_MONITOR
+
+# implementation of the terminal UI
+DRIVER = Driver()
@@ -0,0 +1,291 @@
+#
+#	ElfKit memory-mapped tile store.
+#	Copyright (C) 2019  Hugues Casse <hug.casse@gmail.com>
+#
+#	This file is part of ElfKit.
+#
+#	ElfKit is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	ElfKit is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with ElfKit.  If not, see <https://www.gnu.org/licenses/>.
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+
+"""Store of image tiles in a memory-mapped file: huge images and maps
+are paged in and out by the OS page cache instead of being loaded in
+memory, opening a store is immediate and the used memory is
+proportional to the displayed area.
+
+A store contains the levels of a mipmapped pyramid (level l is the image
+reduced by 2**l) split in square tiles. The file layout is (integers
+are little endian):
+
+	header (64 bytes):
+		magic	8 bytes	b"ELFTILES"
+		version	u32		1
+		tile	u32		size of tiles in pixels
+		width	u64		width of level 0 in pixels
+		height	u64		height of level 0 in pixels
+		levels	u32		number of levels above level 0
+		format	u32		0 for cairo ARGB32 (premultiplied, little endian)
+		padding up to 64 bytes
+
+	flags: one byte per tile, 1 if the tile is present, for each level
+	from 0 to levels, row by row, padded to a multiple of the page size,
+
+	tiles: tile * tile * 4 bytes per tile, in the same order as the
+	flags, with rows of tile * 4 bytes; tiles at the right and bottom
+	edges are padded to the full size.
+
+Level l has ceil(width / 2**l) x ceil(height / 2**l) pixels and levels
+is the first level fitting in one tile. Missing tiles use no disk space
+as the file is created sparse.
+
+Stores may be opened in worker processes: a pickled store is reopened
+from its path. cairo is only needed to get tiles as surfaces."""
+
+import collections
+import mmap
+import struct
+import threading
+
+try:
+	import cairo
+except ImportError:
+	cairo = None
+
+MAGIC = b"ELFTILES"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQQII")
+HEADER_SIZE = 64
+ARGB32 = 0
+
+# default size of tiles
+TILE_SIZE = 256
+
+# number of tile surfaces kept by a store whose mapping is read-only
+CACHE_TILES = 64
+
+
+def get_levels(w, h, tile):
+	"""Get the number of levels above 0 of an image of size (w, h)."""
+	levels = 0
+	while max(w, h) > tile << levels:
+		levels = levels + 1
+	return levels
+
+
+def create(path, w, h, tile = TILE_SIZE):
+	"""Create an empty store for an image of size (w, h) and return it
+	opened for writing."""
+	levels = get_levels(w, h, tile)
+	with open(path, "wb") as out:
+		out.write(HEADER.pack(MAGIC, VERSION, tile, w, h, levels, ARGB32).ljust(HEADER_SIZE, b"\0"))
+		out.truncate(TileStore.get_layout(tile, w, h, levels)[-1])
+	return TileStore(path, True)
+
+
+class TileStore:
+	"""A tile store opened for reading or, if write is True, for writing.
+	As an image pyramid store, it maps (level, tx, ty) to cairo surfaces."""
+
+	def __init__(self, path, write = False):
+		self.path = path
+		self.write = write
+		self.file = open(path, "r+b" if write else "rb")
+		try:
+			magic, version, self.tile, self.w, self.h, self.levels, format = \
+				HEADER.unpack(self.file.read(HEADER.size))
+		except struct.error:
+			magic = None
+		if magic != MAGIC or version != VERSION or format != ARGB32:
+			self.file.close()
+			raise ValueError("%s: not a tile store" % path)
+		self.cols, self.rows, self.bases, self.data, size = \
+			TileStore.get_layout(self.tile, self.w, self.h, self.levels)
+		self.tile_bytes = self.tile * self.tile * 4
+		self.shared = True
+		if write:
+			self.map = mmap.mmap(self.file.fileno(), size, access = mmap.ACCESS_WRITE)
+		else:
+			# a private writable mapping lets cairo use the pages
+			# directly; it may be refused for huge files
+			try:
+				self.map = mmap.mmap(self.file.fileno(), size, access = mmap.ACCESS_COPY)
+			except OSError:
+				self.map = mmap.mmap(self.file.fileno(), size, access = mmap.ACCESS_READ)
+				self.shared = False
+		self.view = memoryview(self.map)
+		self.cache = collections.OrderedDict()
+		self.lock = threading.Lock()
+
+	@staticmethod
+	def get_layout(tile, w, h, levels):
+		"""Compute the layout of a store: columns and rows of tiles of
+		each level, index of the first tile of each level, offset of
+		the tiles and size of the file."""
+		cols, rows, bases = [], [], []
+		count = 0
+		for l in range(levels + 1):
+			cols.append(-(-(-(-w >> l)) // tile))
+			rows.append(-(-(-(-h >> l)) // tile))
+			bases.append(count)
+			count = count + cols[-1] * rows[-1]
+		data = -(-(HEADER_SIZE + count) // mmap.PAGESIZE) * mmap.PAGESIZE
+		return (cols, rows, bases, data, data + count * tile * tile * 4)
+
+	def __getstate__(self):
+		return (self.path, self.write)
+
+	def __setstate__(self, state):
+		self.__init__(*state)
+
+	def get_size(self, level = 0):
+		"""Get the size in pixels of a level."""
+		return (-(-self.w >> level), -(-self.h >> level))
+
+	def get_tile_size(self, level, tx, ty):
+		"""Get the size in pixels of a tile."""
+		w, h = self.get_size(level)
+		return (min(self.tile, w - tx * self.tile), min(self.tile, h - ty * self.tile))
+
+	def get_index(self, level, tx, ty):
+		"""Get the index of a tile, or -1 if it is out of the level."""
+		if 0 <= level <= self.levels and 0 <= tx < self.cols[level] and 0 <= ty < self.rows[level]:
+			return self.bases[level] + ty * self.cols[level] + tx
+		return -1
+
+	def has_tile(self, level, tx, ty):
+		"""Test if a tile is present."""
+		i = self.get_index(level, tx, ty)
+		return i >= 0 and self.map[HEADER_SIZE + i] != 0
+
+	def get_tile(self, level, tx, ty):
+		"""Get the pixels of a tile as a memory view (without copy), or
+		None if the tile is not present."""
+		i = self.get_index(level, tx, ty)
+		if i < 0 or self.map[HEADER_SIZE + i] == 0:
+			return None
+		offset = self.data + i * self.tile_bytes
+		return self.view[offset:offset + self.tile_bytes]
+
+	def get_surface(self, level, tx, ty):
+		"""Get a tile as a cairo surface, or None if the tile is not
+		present. The surface shares the mapped memory, except if the
+		mapping is read-only (cairo requires writable memory): the
+		surface is then a copy of the tile and the last CACHE_TILES
+		copies are kept."""
+		key = (level, tx, ty)
+		if not self.shared:
+			with self.lock:
+				surface = self.cache.get(key)
+				if surface != None:
+					self.cache.move_to_end(key)
+					return surface
+		data = self.get_tile(level, tx, ty)
+		if data == None:
+			return None
+		if not self.shared:
+			data = bytearray(data)
+		w, h = self.get_tile_size(level, tx, ty)
+		surface = cairo.ImageSurface.create_for_data(data, cairo.FORMAT_ARGB32, w, h, self.tile * 4)
+		if not self.shared:
+			with self.lock:
+				self.cache[key] = surface
+				if len(self.cache) > CACHE_TILES:
+					self.cache.popitem(last = False)
+		return surface
+
+	def put_tile(self, level, tx, ty, data, stride):
+		"""Write the pixels of a tile, with rows of stride bytes."""
+		i = self.get_index(level, tx, ty)
+		if i < 0:
+			raise IndexError("tile (%d, %d, %d) out of the store" % (level, tx, ty))
+		w, h = self.get_tile_size(level, tx, ty)
+		data = memoryview(data).cast("B")
+		offset = self.data + i * self.tile_bytes
+		n = w * 4
+		for y in range(h):
+			p = offset + y * self.tile * 4
+			self.view[p:p + n] = data[y * stride:y * stride + n]
+		self.map[HEADER_SIZE + i] = 1
+
+	def put_surface(self, level, tx, ty, surface):
+		"""Write a tile from a cairo ARGB32 image surface."""
+		surface.flush()
+		self.put_tile(level, tx, ty, surface.get_data(), surface.get_stride())
+
+	def add_image(self, surface, x = 0, y = 0):
+		"""Paint a cairo surface at (x, y) on level 0. A huge image
+		may be written piece by piece."""
+		T = self.tile
+		w, h = surface.get_width(), surface.get_height()
+		for ty in range(max(y // T, 0), min(-(-(y + h) // T), self.rows[0])):
+			for tx in range(max(x // T, 0), min(-(-(x + w) // T), self.cols[0])):
+				tw, th = self.get_tile_size(0, tx, ty)
+				offset = self.data + self.get_index(0, tx, ty) * self.tile_bytes
+				tile = cairo.ImageSurface.create_for_data(self.view[offset:offset + self.tile_bytes],
+					cairo.FORMAT_ARGB32, tw, th, T * 4)
+				cr = cairo.Context(tile)
+				cr.set_source_surface(surface, x - tx * T, y - ty * T)
+				cr.paint()
+				tile.flush()
+				del cr, tile
+				self.map[HEADER_SIZE + self.get_index(0, tx, ty)] = 1
+
+	def build_levels(self):
+		"""Build the missing tiles of the levels above 0 from level 0."""
+		from elfkit import paint
+		pyramid = paint.ImagePyramid(self)
+		for l in range(1, self.levels + 1):
+			for ty in range(self.rows[l]):
+				for tx in range(self.cols[l]):
+					if not self.has_tile(l, tx, ty):
+						pyramid.build(l, tx, ty)
+
+	def get(self, key, default = None):
+		surface = self.get_surface(*key)
+		return default if surface == None else surface
+
+	def __contains__(self, key):
+		return self.has_tile(*key)
+
+	def __setitem__(self, key, surface):
+		self.put_surface(key[0], key[1], key[2], surface)
+
+	def flush(self):
+		"""Write the modified tiles to the file."""
+		if self.write:
+			self.map.flush()
+
+	def close(self):
+		"""Close the store. The mapping stays alive while surfaces of
+		the store are used."""
+		self.flush()
+		self.cache.clear()
+		self.view.release()
+		try:
+			self.map.close()
+		except BufferError:
+			pass
+		self.file.close()
@@ -0,0 +1,202 @@
+#
+#	ElfKit instrumentation.
+#	Copyright (C) 2019  Hugues Casse <hug.casse@gmail.com>
+#
+#	This file is part of ElfKit.
+#
+#	ElfKit is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	ElfKit is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with ElfKit.  If not, see <https://www.gnu.org/licenses/>.
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+
+"""Opt-in instrumentation of ElfKit. When ENABLED is True, the
+instrumented points of ElfKit (observer dispatch, actions, painting,
+form and menu building, icon loading) are timed: durations are
+aggregated in histograms and, if recording is asked, kept as events
+that may be written in the Chrome trace format (readable by
+chrome://tracing or Perfetto). When disabled, the instrumented points
+only test the ENABLED flag."""
+
+import collections
+import json
+import os
+import threading
+import time
+
+ENABLED = False
+RECORDING = False
+
+# number of buckets of histograms: bucket i counts durations
+# in [2^(i-1), 2^i[ microseconds
+BUCKETS = 32
+
+# maximum number of recorded events, the oldest are dropped first
+MAX_EVENTS = 1000000
+
+STATS = {}
+EVENTS = collections.deque(maxlen = MAX_EVENTS)
+LOCK = threading.Lock()
+ORIGIN = time.perf_counter()
+
+
+class Histogram:
+	"""Aggregated durations of an instrumented point."""
+
+	def __init__(self):
+		self.count = 0
+		self.total = 0.
+		self.min = None
+		self.max = 0.
+		self.buckets = [0] * BUCKETS
+
+	def add(self, d):
+		"""Add a duration in seconds."""
+		self.count = self.count + 1
+		self.total = self.total + d
+		if self.min == None or d < self.min:
+			self.min = d
+		if d > self.max:
+			self.max = d
+		self.buckets[min(int(d * 1e6).bit_length(), BUCKETS - 1)] += 1
+
+	def mean(self):
+		"""Get the mean duration."""
+		return self.total / self.count if self.count != 0 else 0.
+
+	def percentile(self, p):
+		"""Get an upper bound of the p-th percentile (p in [0, 100])
+		in seconds."""
+		n = self.count * p / 100.
+		c = 0
+		for i in range(BUCKETS):
+			c = c + self.buckets[i]
+			if c >= n and c != 0:
+				return (1 << i) / 1e6
+		return self.max
+
+
+def enable(record = False):
+	"""Enable the instrumentation. If record is True, events are also
+	recorded for write_chrome()."""
+	global ENABLED, RECORDING
+	RECORDING = record
+	ENABLED = True
+
+
+def disable():
+	"""Disable the instrumentation."""
+	global ENABLED, RECORDING
+	ENABLED = False
+	RECORDING = False
+
+
+def reset():
+	"""Forget the collected statistics and events."""
+	with LOCK:
+		STATS.clear()
+		EVENTS.clear()
+
+
+def add(cat, name, start, end):
+	"""Record a duration of the instrumented point (cat, name)
+	between the perf_counter() dates start and end."""
+	with LOCK:
+		try:
+			h = STATS[(cat, name)]
+		except KeyError:
+			h = Histogram()
+			STATS[(cat, name)] = h
+		h.add(end - start)
+		if RECORDING:
+			EVENTS.append({
+				"name": name,
+				"cat": cat,
+				"ph": "X",
+				"ts": (start - ORIGIN) * 1e6,
+				"dur": (end - start) * 1e6,
+				"pid": os.getpid(),
+				"tid": threading.get_ident()
+			})
+
+
+def call(cat, name, fun, *args):
+	"""Call fun with args and record its duration."""
+	start = time.perf_counter()
+	try:
+		return fun(*args)
+	finally:
+		add(cat, name, start, time.perf_counter())
+
+
+class Span:
+	"""Context manager recording the duration of its block."""
+
+	def __init__(self, cat, name):
+		self.cat = cat
+		self.name = name
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, type, value, tb):
+		add(self.cat, self.name, self.start, time.perf_counter())
+		return False
+
+
+def trigger(subject, type, fun):
+	"""Instrumented version of Subject.trigger()."""
+	sname = subject.__class__.__name__
+	for obs in subject.obss:
+		if isinstance(obs, type):
+			call("trigger", "%s>%s" % (sname, obs.__class__.__name__), fun, obs)
+
+
+def get_stats():
+	"""Get the statistics as a dictionary (category, name) ->
+	Histogram."""
+	with LOCK:
+		return dict(STATS)
+
+
+def report(out):
+	"""Write a summary of the statistics to the given stream,
+	the most expensive points first."""
+	stats = sorted(get_stats().items(), key = lambda i: -i[1].total)
+	out.write("%-10s %-40s %8s %10s %10s %10s %10s\n" %
+		("category", "name", "count", "total ms", "mean us", "p99 us", "max us"))
+	for ((cat, name), h) in stats:
+		out.write("%-10s %-40s %8d %10.2f %10.1f %10.0f %10.1f\n" % (
+			cat, name[:40], h.count, h.total * 1e3, h.mean() * 1e6,
+			h.percentile(99) * 1e6, h.max * 1e6))
+
+
+def write_chrome(path):
+	"""Write the recorded events to the given path in Chrome trace
+	format."""
+	with LOCK:
+		events = list(EVENTS)
+	with open(path, "w") as out:
+		json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, out)
@@ -33,6 +33,8 @@
 """The UI is the common interface hiding the detail of the actual
 user interface."""
 
+import collections
+
 import elfkit.base
 
 # default icons
@@ -56,6 +58,21 @@ BUTTON_ICON_SIZE = 3
 DND_ICON_SIZE = 4
 DIALOG_ICON_SIZE = 5
 
+# text alignment
+ALIGN_LEFT = 0
+ALIGN_CENTER = 1
+ALIGN_RIGHT = 2
+
+# mouse buttons
+BUTTON_LEFT = 1
+BUTTON_MIDDLE = 2
+BUTTON_RIGHT = 3
+
+# key modifiers
+MOD_SHIFT = 1
+MOD_CONTROL = 2
+MOD_ALT = 4
+
 
 class Widget:
 	"""A widge to be displayed."""
@@ -88,15 +105,157 @@ class DrawingArea:
 		"""Draw the given image at the position (x, y):"""
 		pass
 
+	def draw_text(self, text, x, y, font = None, width = -1, align = ALIGN_LEFT):
+		"""Draw the text with its top-left corner at (x, y) with the
+		current color. font is a font description like "Sans 10" (None
+		for the default font). If width is not -1, the text is wrapped
+		to this width and aligned according to align."""
+		pass
+
+	def measure_text(self, text, font = None, width = -1, align = ALIGN_LEFT):
+		"""Get the size (w, h) of the text as drawn by draw_text()
+		with the same parameters."""
+		return (0, 0)
+
 
 class Painter:
-	"""Class used by the Canvas to paint itself."""
+	"""Class used by the Canvas to paint itself. A painter may split its
+	output into layers, painted from the first to the last: in retained
+	mode, the canvas records the output of each layer and replays it
+	until the layer is invalidated."""
 	
 	def paint(self, draw, x, y, w, h):
 		"""Called to repaint the area (x, y)-(w, h) on the given draw
 		port."""
 		pass
 
+	def get_layers(self):
+		"""Get the identifiers of the layers. Default is one layer,
+		None, painted by paint()."""
+		return [None]
+
+	def paint_layer(self, draw, layer, x, y, w, h):
+		"""Paint the given layer. Default calls paint()."""
+		self.paint(draw, x, y, w, h)
+
+	def get_deps(self, layer):
+		"""Get the variables whose change invalidates the given layer."""
+		return []
+
+	def is_retained(self, layer):
+		"""Test if the output of the layer may be recorded and replayed.
+		Layers changing at each frame should return False."""
+		return True
+
+
+class FrameStats:
+	"""Statistics about the frames painted by a canvas. The last size
+	frames are kept to compute the recent figures."""
+
+	def __init__(self, size = 120):
+		self.frames = collections.deque(maxlen = size)
+		self.count = 0
+		self.dropped = 0
+		self.painters = {}
+		self.clip = (0, 0, 0, 0)
+
+	def add_frame(self, date, duration, clip, painter):
+		"""Record a frame painted at date (in seconds) in duration seconds
+		for the clip area (x, y, w, h) by the painter whose name is
+		given."""
+		self.frames.append((date, duration, clip[2] * clip[3]))
+		self.count = self.count + 1
+		self.clip = clip
+		try:
+			c, t = self.painters[painter]
+			self.painters[painter] = (c + 1, t + duration)
+		except KeyError:
+			self.painters[painter] = (1, duration)
+
+	def add_dropped(self, n):
+		"""Record n dropped frames."""
+		self.dropped = self.dropped + n
+
+	def get_fps(self):
+		"""Get the effective number of frames per second over the
+		recent frames."""
+		if len(self.frames) < 2:
+			return 0.
+		span = self.frames[-1][0] - self.frames[0][0]
+		return (len(self.frames) - 1) / span if span > 0 else 0.
+
+	def get_paint_time(self):
+		"""Get the mean and the maximal paint duration over the recent
+		frames (in seconds)."""
+		if len(self.frames) == 0:
+			return (0., 0.)
+		ds = [d for (t, d, a) in self.frames]
+		return (sum(ds) / len(ds), max(ds))
+
+	def get_last(self):
+		"""Get the duration of the last frame (in seconds)."""
+		return self.frames[-1][1] if len(self.frames) != 0 else 0.
+
+	def get_painters(self):
+		"""Get the painters sorted by decreasing total time as a list
+		of (name, count, total time)."""
+		return sorted([(n, c, t) for (n, (c, t)) in self.painters.items()],
+			key = lambda p: -p[2])
+
+	def summary(self):
+		"""Get the statistics as a dictionary."""
+		mean, max = self.get_paint_time()
+		return {
+			"frames": self.count,
+			"fps": self.get_fps(),
+			"paint_mean": mean,
+			"paint_max": max,
+			"paint_last": self.get_last(),
+			"clip": self.clip,
+			"dropped": self.dropped,
+			"painters": self.get_painters()
+		}
+
+	def reset(self):
+		"""Reset the statistics."""
+		self.__init__(self.frames.maxlen)
+
+
+class CanvasHandler:
+	"""Handler of the input events of a canvas. Positions are in pixels
+	of the canvas (see Canvas.to_painter()) and mods is a combination of
+	MOD_XXX. Pointer motions are compressed: on_motion() is called at
+	most once per frame with the last position. Drawing tools needing all
+	the positions set history to True: the positions since the previous
+	frame are then first passed to on_motion_history()."""
+	history = False
+
+	def on_press(self, canvas, button, x, y, mods):
+		"""Called when a mouse button is pressed."""
+		pass
+
+	def on_release(self, canvas, button, x, y, mods):
+		"""Called when a mouse button is released."""
+		pass
+
+	def on_motion(self, canvas, x, y, mods):
+		"""Called with the last position of the pointer in the frame."""
+		pass
+
+	def on_motion_history(self, canvas, points):
+		"""Called with the list of (x, y, time) of the pointer
+		since the previous frame if history is True."""
+		pass
+
+	def on_scroll(self, canvas, dx, dy, x, y, mods):
+		"""Called when the wheel is scrolled by (dx, dy) steps."""
+		pass
+
+	def on_key(self, canvas, key, pressed, mods):
+		"""Called when a key, given by its name, is pressed or released.
+		Return True if the key is handled."""
+		return False
+
 
 class Canvas:
 	"""A canvas is a UI interface letting the user to draw different shapes,
@@ -106,6 +265,75 @@ class Canvas:
 		"""Set the size in pixel of the image on the canvas."""
 		pass
 
+	def enable_stats(self, overlay = False):
+		"""Start collecting frame statistics. If overlay is True, they are
+		displayed over the canvas."""
+		pass
+
+	def disable_stats(self):
+		"""Stop collecting frame statistics."""
+		pass
+
+	def get_stats(self):
+		"""Get the frame statistics (FrameStats) or None if they are not
+		enabled."""
+		return None
+
+	def refresh(self):
+		"""Ask the canvas to be repainted."""
+		pass
+
+	def set_retained(self, retained):
+		"""Enable or disable the retained mode: the output of the painter
+		layers is recorded and replayed until invalidated."""
+		pass
+
+	def invalidate(self, layer = None):
+		"""Invalidate the recording of the given layer or, if layer is
+		None, of all layers, and repaint the canvas."""
+		pass
+
+	def set_transform(self, zoom, x = 0., y = 0.):
+		"""Display the painter scaled by zoom, with its point (x, y) at
+		the top-left corner of the canvas."""
+		pass
+
+	def get_transform(self):
+		"""Get the transformation as a triple (zoom, x, y)."""
+		return (1., 0., 0.)
+
+	def to_painter(self, cx, cy):
+		"""Convert a point of the canvas into painter coordinates."""
+		zoom, x, y = self.get_transform()
+		return (x + cx / zoom, y + cy / zoom)
+
+	def zoom_at(self, factor, cx, cy):
+		"""Multiply the zoom by factor keeping the canvas point
+		(cx, cy) in place."""
+		zoom, x, y = self.get_transform()
+		px, py = self.to_painter(cx, cy)
+		zoom = zoom * factor
+		self.set_transform(zoom, px - cx / zoom, py - cy / zoom)
+
+	def pan(self, dx, dy):
+		"""Move the displayed area by (dx, dy) canvas pixels."""
+		zoom, x, y = self.get_transform()
+		self.set_transform(zoom, x + dx / zoom, y + dy / zoom)
+
+	def set_handler(self, handler):
+		"""Set the handler (CanvasHandler) of the input events of the
+		canvas. None removes the current handler."""
+		pass
+
+	def add_ticker(self, fun):
+		"""Call fun at each frame of the display with the date of
+		the frame in seconds. Return an identifier for remove_ticker()."""
+		return None
+
+	def remove_ticker(self, id):
+		"""Stop calling a function added by add_ticker()."""
+		pass
+
 
 class Frame:
 	"""Frame of a user interface."""
@@ -0,0 +1,644 @@
+#
+#	ElfKit HTTP driver.
+#	Copyright (C) 2019  Hugues Casse <hug.casse@gmail.com>
+#
+#	This file is part of ElfKit.
+#
+#	ElfKit is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	ElfKit is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with ElfKit.  If not, see <https://www.gnu.org/licenses/>.
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+
+"""HTTP implementation of the common user interface. The driver serves
+the views, variables and actions of the application to browsers through
+a local HTTP server with WebSocket connections. All clients share the
+same model: changes are gathered into JSON patches, encoded once and
+sent to every client at most PATCH_DELAY seconds after the change."""
+
+import asyncio
+import base64
+import hashlib
+import json
+import struct
+
+from elfkit import base
+from elfkit import ui
+from elfkit import view
+
+# delay to gather changes in a patch (in seconds)
+PATCH_DELAY = .05
+
+# maximal number of patches waiting to be sent to a client before
+# it is disconnected
+MAX_PENDING = 256
+
+# maximal size of a message received from a client (in bytes)
+MAX_MESSAGE = 1 << 20
+
+# maximal delay to receive the request headers (in seconds)
+HEADER_TIMEOUT = 10
+
+# maximal number of headers of a request
+MAX_HEADERS = 100
+
+# enumerations with more values are displayed as text
+MAX_OPTIONS = 1000
+
+WS_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>ElfKit</title>
+<style>
+body { font-family: sans-serif; }
+#menu span { margin-right: 1em; }
+#view button { display: block; margin: .3em 0; }
+#vars td { padding: .2em .5em; }
+.warning { color: #a60; } .error { color: #c00; }
+</style></head>
+<body><h1 id="title"></h1><div id="menu"></div><div id="view"></div>
+<table id="vars"></table><div id="jobs"></div><ul id="messages"></ul>
+<script>
+var model = { vars: {}, actions: {} };
+var ws = new WebSocket("ws://" + location.host + "/ws");
+function send(msg) { ws.send(JSON.stringify(msg)); }
+function button(id) {
+	var b = document.createElement("button");
+	b.id = id; b.onclick = function() { send({type: "apply", id: id}); };
+	return b;
+}
+function entry(id) {
+	var v = model.vars[id], e;
+	if(v.kind == "range") {
+		e = document.createElement("input"); e.type = "range";
+		e.min = v.low; e.max = v.up;
+		e.onchange = function() { send({type: "set", id: id, value: parseInt(e.value)}); };
+	}
+	else if(v.kind == "enum" && v.options) {
+		e = document.createElement("select");
+		v.options.forEach(function(o, i) { var opt = document.createElement("option"); opt.value = i; opt.text = o; e.add(opt); });
+		e.onchange = function() { send({type: "set", id: id, index: parseInt(e.value)}); };
+	}
+	else if(v.kind == "bool") {
+		e = document.createElement("input"); e.type = "checkbox";
+		e.onchange = function() { send({type: "set", id: id, value: e.checked}); };
+	}
+	else
+		e = document.createElement("span");
+	e.id = id;
+	return e;
+}
+function update_var(id) {
+	var v = model.vars[id], e = document.getElementById(id);
+	if(!e) return;
+	if(v.kind == "range") e.value = v.value;
+	else if(v.kind == "enum" && v.options) e.value = v.index;
+	else if(v.kind == "bool") e.checked = v.value;
+	else e.textContent = v.text;
+}
+function update_action(id) {
+	var a = model.actions[id], e = document.getElementById(id);
+	if(!e) return;
+	e.textContent = a.label; e.title = a.help; e.disabled = !a.enabled;
+}
+function apply(patch) {
+	if(patch.title !== undefined) document.getElementById("title").textContent = patch.title;
+	for(var id in patch.vars || {}) { model.vars[id] = Object.assign(model.vars[id] || {}, patch.vars[id]); update_var(id); }
+	for(var id in patch.actions || {}) { model.actions[id] = Object.assign(model.actions[id] || {}, patch.actions[id]); update_action(id); }
+	if(patch.view) {
+		var div = document.getElementById("view"); div.innerHTML = "";
+		patch.view.actions.forEach(function(id) { div.appendChild(button(id)); update_action(id); });
+	}
+	if(patch.menu) {
+		var div = document.getElementById("menu"), table = document.getElementById("vars");
+		div.innerHTML = ""; table.innerHTML = "";
+		patch.menu.forEach(function(m) {
+			m.items.forEach(function(id) {
+				if(model.actions[id]) { div.appendChild(button(id)); update_action(id); }
+				else {
+					var tr = table.insertRow(), td = tr.insertCell();
+					td.textContent = model.vars[id].label;
+					tr.insertCell().appendChild(entry(id)); update_var(id);
+				}
+			});
+		});
+	}
+	if(patch.jobs) document.getElementById("jobs").textContent =
+		patch.jobs.map(function(j) { return j[0] + " " + Math.round(j[1] * 100) + "%"; }).join(" ");
+	(patch.messages || []).forEach(function(m) {
+		var li = document.createElement("li"); li.className = m[0]; li.textContent = m[1];
+		document.getElementById("messages").prepend(li);
+	});
+}
+ws.onmessage = function(e) { apply(JSON.parse(e.data)); };
+</script></body></html>
+"""
+
+LEVEL_NAMES = ["info", "warning", "error"]
+
+
+def ws_frame(data, opcode = 1):
+	"""Build a WebSocket frame (server side, not masked)."""
+	n = len(data)
+	if n < 126:
+		head = struct.pack("!BB", 0x80 | opcode, n)
+	elif n < 65536:
+		head = struct.pack("!BBH", 0x80 | opcode, 126, n)
+	else:
+		head = struct.pack("!BBQ", 0x80 | opcode, 127, n)
+	return head + data
+
+
+class MessageTooBig(Exception):
+	"""Raised when a client sends a message bigger than MAX_MESSAGE."""
+	pass
+
+
+async def ws_read(reader):
+	"""Read a WebSocket message and return (opcode, payload).
+	Fragmented messages are reassembled. Raise MessageTooBig if
+	the message is bigger than MAX_MESSAGE, before reading it."""
+	payload = b""
+	opcode = None
+	while True:
+		b1, b2 = struct.unpack("!BB", await reader.readexactly(2))
+		n = b2 & 0x7f
+		if n == 126:
+			n = struct.unpack("!H", await reader.readexactly(2))[0]
+		elif n == 127:
+			n = struct.unpack("!Q", await reader.readexactly(8))[0]
+		if len(payload) + n > MAX_MESSAGE:
+			raise MessageTooBig()
+		mask = await reader.readexactly(4) if b2 & 0x80 else None
+		data = await reader.readexactly(n)
+		if mask != None:
+			data = bytes(data[i] ^ mask[i % 4] for i in range(n))
+		op = b1 & 0x0f
+		if op >= 8:
+			return (op, data)
+		if opcode == None:
+			opcode = op
+		payload = payload + data
+		if b1 & 0x80:
+			return (opcode, payload)
+
+
+class Client:
+	"""A browser connected by a WebSocket. Patches are queued and sent
+	by a dedicated task so that a slow client does not delay the
+	others."""
+
+	def __init__(self, driver, reader, writer):
+		self.driver = driver
+		self.reader = reader
+		self.writer = writer
+		self.queue = asyncio.Queue()
+
+	def send(self, data):
+		"""Queue an encoded message. A client too late is
+		disconnected."""
+		if self.queue.qsize() >= MAX_PENDING:
+			self.writer.close()
+		else:
+			self.queue.put_nowait(data)
+
+	async def write(self):
+		"""Body of the writing task."""
+		while True:
+			data = await self.queue.get()
+			self.writer.write(ws_frame(data))
+			await self.writer.drain()
+
+	async def read(self):
+		"""Body of the reading task."""
+		while True:
+			try:
+				op, data = await ws_read(self.reader)
+			except MessageTooBig:
+				self.writer.write(ws_frame(struct.pack("!H", 1009), 8))
+				return
+			if op == 8:
+				self.writer.write(ws_frame(b"", 8))
+				return
+			elif op == 9:
+				self.writer.write(ws_frame(data, 10))
+			elif op == 1:
+				try:
+					self.driver.on_message(json.loads(data.decode()))
+				except (ValueError, KeyError, TypeError) as e:
+					self.driver.get_console().error("bad message: %s" % e)
+
+
+class Refresher(base.VarObserver, base.ActionObserver):
+	"""Observer recording the changes in the pending patch."""
+
+	def __init__(self, driver):
+		self.driver = driver
+
+	def on_update(self, var, val):
+		self.driver.dirty_vars.add(var)
+		self.driver.schedule()
+
+	def on_check(self, action):
+		self.driver.dirty_actions.add(action)
+		self.driver.schedule()
+
+
+def build_view(frame, _view):
+	"""Get the description of a view."""
+	if isinstance(_view, view.Switch):
+		return {"kind": "switch",
+			"actions": [frame.driver.register(a) for a in _view.get_actions()]}
+	else:
+		return {"kind": "none", "actions": []}
+
+
+class Frame(ui.Frame, base.Monitor):
+	"""Frame displayed in the browsers."""
+
+	def __init__(self, app, driver, view = None):
+		ui.Frame.__init__(self, app, driver)
+		self.title = app.get_label()
+		self.menu = []
+		self.view = view
+		self.jobs = []
+
+	def set_title(self, title):
+		self.title = title
+		self.driver.post({"title": title})
+
+	def set_menu(self, menu):
+		self.menu = menu
+		if self.driver.frame == self:
+			self.driver.post({"menu": self.describe_menu()})
+
+	def describe_menu(self):
+		return [{"name": name, "items": [self.driver.register(i) for i in items]}
+			for (name, items) in self.menu]
+
+	def describe(self):
+		"""Get the full description of the frame as a patch."""
+		return {
+			"title": self.title,
+			"view": build_view(self, self.view),
+			"menu": self.describe_menu(),
+			"jobs": self.describe_jobs()
+		}
+
+	def open(self):
+		self.driver.show(self)
+		if self.view != None:
+			self.view.show()
+
+	def close(self):
+		if self.view != None:
+			self.view.hide()
+
+	def message(self, level, msg):
+		self.driver.post({"messages": [[LEVEL_NAMES[level], str(msg)]]})
+
+	def info(self, msg):
+		self.message(base.INFO, msg)
+
+	def warn(self, msg):
+		self.message(base.WARNING, msg)
+
+	def error(self, msg):
+		self.message(base.ERROR, msg)
+
+	def describe_jobs(self):
+		"""Get the jobs as a list of [name, ratio]."""
+		return [[name, ratio] for (name, ratio, key) in self.jobs]
+
+	def start_job(self, name, help="", icon="", cancel=None, job=None):
+		self.jobs.append([name, 0., name if job == None else job])
+		self.driver.post({"jobs": self.describe_jobs()})
+
+	def end_job(self, name, job=None):
+		key = name if job == None else job
+		for i in range(len(self.jobs) - 1, -1, -1):
+			if self.jobs[i][2] == key:
+				del self.jobs[i]
+				break
+		self.driver.post({"jobs": self.describe_jobs()})
+
+	def set_progress(self, name, ratio, job=None):
+		key = name if job == None else job
+		for i in range(len(self.jobs) - 1, -1, -1):
+			if self.jobs[i][2] == key:
+				self.jobs[i][1] = ratio
+				break
+		self.driver.post({"jobs": self.describe_jobs()})
+
+	def ask_dialog(self, title="", vars=[], help=""):
+		"""Not supported: the server cannot block waiting for
+		a browser."""
+		self.error("%s: dialogs are not supported by the HTTP driver." % title)
+		return False
+
+
+class Driver(ui.Driver):
+	"""UI driver serving the application on host:port. At most
+	max_clients browsers may be connected at the same time and at most
+	max_connections connections (WebSocket or not) may be open."""
+
+	def __init__(self, host = "localhost", port = 8080, max_clients = 64, max_connections = 128):
+		ui.Driver.__init__(self)
+		self.host = host
+		self.port = port
+		self.max_clients = max_clients
+		self.max_connections = max_connections
+		self.connections = 0
+		self.quit_action = \
+			base.Action(self.quit, label="Quit", icon=ui.QUIT_ICON, help="Leave the application.")
+		self.refresher = Refresher(self)
+		self.ids = {}
+		self.objects = {}
+		self.clients = set()
+		self.frame = None
+		self.patch = {}
+		self.dirty_vars = set()
+		self.dirty_actions = set()
+		self.described = set()
+		self.handle = None
+		self.loop = None
+		self.stopped = None
+		self.server = None
+
+	def open(self, app, pane = None, **args):
+		return Frame(app, self, pane, **args)
+
+	def show(self, frame):
+		"""Display the given frame on the clients."""
+		self.frame = frame
+		self.post(frame.describe())
+
+	def register(self, entity):
+		"""Get the identifier of a variable or an action. The first time,
+		the entity is observed and its description is added to the
+		patch."""
+		try:
+			return self.ids[entity]
+		except KeyError:
+			pass
+		if isinstance(entity, base.AbstractAction):
+			id = "a%d" % len(self.ids)
+			entity.add_observer(self.refresher)
+			entity.observe(self.refresher)
+			self.dirty_actions.add(entity)
+		else:
+			id = "v%d" % len(self.ids)
+			entity.add_observer(self.refresher)
+			self.dirty_vars.add(entity)
+		self.ids[entity] = id
+		self.objects[id] = entity
+		self.schedule()
+		return id
+
+	def describe_var(self, var, full):
+		"""Get the description of a variable. If full is False, only
+		the value is described."""
+		d = {"text": var.type.as_text(var.get())}
+		if var.type.is_range():
+			d["kind"] = "range"
+			d["value"] = var.get()
+			if full:
+				d["low"] = var.type.low
+				d["up"] = var.type.up
+		elif var.type.is_enum():
+			d["kind"] = "enum"
+			i = var.type.position_of(var.get())
+			d["index"] = i
+			if i >= 0:
+				d["text"] = var.type.get_values()[i].get_label()
+			if full and len(var.type.get_values()) <= MAX_OPTIONS:
+				d["options"] = [v.get_label() for v in var.type.get_values()]
+		elif var.type.is_standard(bool):
+			d["kind"] = "bool"
+			d["value"] = var.get()
+		else:
+			d["kind"] = "text"
+		if full:
+			d["label"] = var.get_label()
+			d["help"] = var.get_help()
+		return d
+
+	def post(self, patch):
+		"""Add the given changes to the pending patch."""
+		for (k, v) in patch.items():
+			if k == "messages":
+				self.patch.setdefault(k, []).extend(v)
+			else:
+				self.patch[k] = v
+		self.schedule()
+
+	def schedule(self):
+		"""Schedule the sending of the pending patch."""
+		if self.handle == None and self.loop != None:
+			self.handle = self.loop.call_later(PATCH_DELAY, self.flush)
+
+	def flush(self):
+		"""Send the pending patch to all clients."""
+		self.handle = None
+		patch = self.patch
+		self.patch = {}
+		if self.dirty_vars:
+			patch["vars"] = {self.ids[v]: self.describe_var(v, self.ids[v] not in self.described)
+				for v in self.dirty_vars}
+			self.described.update(patch["vars"].keys())
+			self.dirty_vars = set()
+		if self.dirty_actions:
+			patch["actions"] = {self.ids[a]: {"label": a.get_label(), "help": a.get_help(), "enabled": bool(a.check())}
+				for a in self.dirty_actions}
+			self.dirty_actions = set()
+		if patch != {}:
+			data = json.dumps(patch, separators = (",", ":"), default = str).encode()
+			for client in self.clients:
+				client.send(data)
+
+	def on_message(self, msg):
+		"""Called when a client sends a message."""
+		if not isinstance(msg, dict):
+			raise ValueError("message is not an object")
+		obj = self.objects.get(msg.get("id"))
+		if msg.get("type") == "apply":
+			if not isinstance(obj, base.AbstractAction):
+				raise ValueError("no action %s" % msg.get("id"))
+			if obj.check():
+				obj.apply(self.frame)
+		elif msg.get("type") == "set":
+			if not isinstance(obj, base.AbstractVar):
+				raise ValueError("no variable %s" % msg.get("id"))
+			obj.set(self.parse_value(obj, msg))
+		else:
+			raise ValueError("unknown message type %s" % msg.get("type"))
+
+	def parse_value(self, var, msg):
+		"""Get the value of a "set" message checked against the type
+		of the variable."""
+		t = var.type
+		if t.is_enum():
+			i = msg["index"]
+			values = t.get_values()
+			if not isinstance(i, int) or isinstance(i, bool) or not 0 <= i < len(values):
+				raise ValueError("bad index %s" % i)
+			return values[i].get_value()
+		value = msg["value"]
+		if t.is_range():
+			if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+				raise TypeError("bad value %r" % value)
+			if isinstance(value, float) and not value.is_integer():
+				raise ValueError("bad value %r" % value)
+			value = int(value)
+			if not t.low <= value <= t.up:
+				raise ValueError("value %d out of [%d, %d]" % (value, t.low, t.up))
+			return value
+		elif t.is_standard(bool):
+			if not isinstance(value, bool):
+				raise TypeError("bad value %r" % value)
+			return value
+		elif t.is_standard(str):
+			if not isinstance(value, str):
+				raise TypeError("bad value %r" % value)
+			return value
+		elif t.is_standard(int) or t.is_standard(float):
+			if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+				raise TypeError("bad value %r" % value)
+			return t.type(value)
+		else:
+			raise ValueError("variable %s cannot be set" % msg.get("id"))
+
+	def describe_all(self):
+		"""Get the full state as a patch for a new client."""
+		patch = {}
+		if self.frame != None:
+			patch = self.frame.describe()
+		patch["vars"] = {id: self.describe_var(o, True)
+			for (id, o) in self.objects.items() if isinstance(o, base.AbstractVar)}
+		patch["actions"] = {id: {"label": o.get_label(), "help": o.get_help(), "enabled": bool(o.check())}
+			for (id, o) in self.objects.items() if isinstance(o, base.AbstractAction)}
+		return patch
+
+	async def read_request(self, reader):
+		"""Read the request line and the headers of a request."""
+		line = await reader.readline()
+		headers = {}
+		while len(headers) < MAX_HEADERS:
+			h = await reader.readline()
+			if h in (b"\r\n", b"\n", b""):
+				break
+			k, _, v = h.decode("latin-1").partition(":")
+			headers[k.strip().lower()] = v.strip()
+		return (line, headers)
+
+	async def handle_connection(self, reader, writer):
+		if self.connections >= self.max_connections:
+			writer.close()
+			return
+		self.connections = self.connections + 1
+		try:
+			line, headers = await asyncio.wait_for(self.read_request(reader), HEADER_TIMEOUT)
+			parts = line.decode("latin-1").split()
+			path = parts[1] if len(parts) > 1 else "/"
+			if path == "/ws" and headers.get("upgrade", "").lower() == "websocket":
+				await self.handle_ws(reader, writer, headers)
+			elif path == "/":
+				self.reply(writer, "200 OK", "text/html; charset=utf-8", PAGE.encode())
+			else:
+				self.reply(writer, "404 Not Found", "text/plain", b"not found")
+			await writer.drain()
+		except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError):
+			pass
+		finally:
+			self.connections = self.connections - 1
+			writer.close()
+
+	def reply(self, writer, status, type, body):
+		writer.write(("HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n"
+			% (status, type, len(body))).encode() + body)
+
+	def is_own_host(self, host):
+		"""Test if a Host header designates this server: other pages
+		than the served one must not drive the application."""
+		return host in ["%s:%d" % (h, self.port)
+			for h in (self.host, "localhost", "127.0.0.1", "[::1]")]
+
+	async def handle_ws(self, reader, writer, headers):
+		if len(self.clients) >= self.max_clients:
+			self.reply(writer, "503 Service Unavailable", "text/plain", b"too many clients")
+			return
+		host = headers.get("host", "")
+		origin = headers.get("origin")
+		if not self.is_own_host(host) or (origin != None and origin != "http://" + host):
+			self.reply(writer, "403 Forbidden", "text/plain", b"forbidden origin")
+			return
+		if "sec-websocket-key" not in headers:
+			self.reply(writer, "400 Bad Request", "text/plain", b"missing key")
+			return
+		accept = base64.b64encode(hashlib.sha1(
+			headers["sec-websocket-key"].encode() + WS_GUID).digest()).decode()
+		writer.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n"
+			"Connection: Upgrade\r\nSec-WebSocket-Accept: %s\r\n\r\n" % accept).encode())
+		self.flush()
+		client = Client(self, reader, writer)
+		client.send(json.dumps(self.describe_all(), separators = (",", ":"), default = str).encode())
+		self.clients.add(client)
+		task = asyncio.ensure_future(client.write())
+		try:
+			await client.read()
+		finally:
+			self.clients.discard(client)
+			task.cancel()
+
+	async def serve(self):
+		"""Run the server until quit() is called."""
+		self.loop = asyncio.get_running_loop()
+		self.stopped = asyncio.Event()
+		base.set_ui_caller(self.loop.call_soon_threadsafe)
+		self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+		self.port = self.server.sockets[0].getsockname()[1]
+		base.TEXT_MONITOR.info("serving on http://%s:%d/" % (self.host, self.port))
+		self.schedule()
+		async with self.server:
+			await self.stopped.wait()
+			for client in list(self.clients):
+				client.writer.close()
+			while self.clients:
+				await asyncio.sleep(PATCH_DELAY)
+		self.loop = None
+
+	def run(self):
+		asyncio.run(self.serve())
+
+	def quit(self, con = None):
+		if self.stopped != None:
+			self.stopped.set()
+
+	def get_console(self):
+		if self.frame != None:
+			return self.frame
+		return base.TEXT_MONITOR
+
+# implementation of the HTTP UI
+DRIVER = Driver()